@@ -4,6 +4,15 @@ aiida_atoms
 AiiDA demo plugin that wraps the `diff` executable for computing the difference between two files.
 """
 
-from .tracker import AtomsTracker
-
 __version__ = "0.1.0"
+
+__all__ = ("AtomsTracker",)
+
+
+def __getattr__(name):
+    """Import the public objects on first access to keep ``import aiida_atoms`` fast"""
+    if name == "AtomsTracker":
+        from .tracker import AtomsTracker
+
+        return AtomsTracker
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
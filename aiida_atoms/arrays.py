@@ -0,0 +1,165 @@
+"""
+Read the arrays of `ArrayData` nodes without loading them into memory
+
+`ArrayData.get_array` reads the whole ``.npy`` file and keeps a copy in the node. For
+stored nodes of a disk-objectstore repository, the file is either a loose object or an
+uncompressed slice of a pack file on disk, so the array can be memory mapped directly
+from the repository. Compressed objects, other repository backends and unstored nodes
+fall back to reading the file, and `read_array_slice` reads only the requested rows
+from the file stream.
+
+Finding the files relies on private internals of aiida-core and disk-objectstore, see
+`get_array_location`. The memory maps are read-only. They stay valid until the
+repository is maintained (``verdi storage maintain``), which may repack the objects, so
+do not keep them around in long running processes.
+"""
+
+import math
+import typing as t
+
+import numpy as np
+
+from aiida import orm
+
+
+def read_npy_header(handle) -> t.Tuple[tuple, bool, np.dtype, int]:
+    """
+    Read the header of a ``.npy`` file.
+
+    :param handle: A binary file handle positioned at the start of the array file.
+
+    :returns: The shape, whether the data is in Fortran order, the dtype and the length
+        of the header in bytes.
+    """
+    from numpy.lib import format as npy_format
+
+    start = handle.tell()
+    version = npy_format.read_magic(handle)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(handle)
+    else:
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(handle)
+    return shape, fortran_order, dtype, handle.tell() - start
+
+
+def _get_filename(name: str) -> str:
+    """The name of the repository file of an array"""
+    return f"{name}.npy"
+
+
+def get_array_location(
+    node: orm.ArrayData, name: str
+) -> t.Optional[t.Tuple[str, int]]:
+    """
+    Path and offset of the file of an array if it is stored uncompressed on disk.
+
+    This relies on private internals of aiida-core and disk-objectstore: the
+    ``_container`` of the repository backend and the paths of its loose objects and pack
+    files. If they are missing or have changed, the arrays are read from the file
+    streams instead (see `read_array_slice`).
+
+    :returns: ``(path, offset)`` or None if the array cannot be memory mapped.
+    """
+    if not node.is_stored:
+        return None
+    from aiida.manage import get_manager
+
+    key = node.base.repository.get_object(_get_filename(name)).key
+    repository = get_manager().get_profile_storage().get_repository()
+    container = getattr(repository, "_container", None)
+    if container is None or key is None:
+        return None
+    try:
+        with container.get_objects_stream_and_meta([key]) as items:
+            for _, _, meta in items:
+                kind = getattr(meta["type"], "value", meta["type"])
+                if kind == "loose":
+                    return str(container._get_loose_path_from_hashkey(key)), 0
+                if kind == "packed" and not meta["pack_compressed"]:
+                    path = container._get_pack_path_from_pack_id(meta["pack_id"])
+                    return str(path), meta["pack_offset"]
+    except (AttributeError, KeyError):
+        # Internals of another version of disk-objectstore
+        return None
+    return None
+
+
+def read_array(node: orm.ArrayData, name: str, mmap: bool = True) -> np.ndarray:
+    """
+    Read an array of a node, memory mapped from the repository if possible.
+
+    :param mmap: Return a read-only `numpy.memmap` if the file is uncompressed on
+        disk, otherwise the array is read into memory.
+    """
+    location = get_array_location(node, name) if mmap else None
+    if location is None:
+        with node.base.repository.open(_get_filename(name), mode="rb") as handle:
+            return np.load(handle, allow_pickle=False)
+
+    path, offset = location
+    with open(path, "rb") as handle:
+        handle.seek(offset)
+        shape, fortran_order, dtype, header_length = read_npy_header(handle)
+    if dtype.hasobject or math.prod(shape) == 0:
+        with node.base.repository.open(_get_filename(name), mode="rb") as handle:
+            return np.load(handle, allow_pickle=False)
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=offset + header_length,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def read_array_slice(
+    node: orm.ArrayData, name: str, index: t.Union[int, slice]
+) -> np.ndarray:
+    """
+    Read rows of an array along its first axis without loading the whole array.
+
+    :param index: The index or slice of the rows.
+    """
+    location = get_array_location(node, name)
+    if location is not None:
+        return np.array(read_array(node, name)[index])
+
+    with node.base.repository.open(_get_filename(name), mode="rb") as handle:
+        shape, fortran_order, dtype, header_length = read_npy_header(handle)
+        if isinstance(index, slice):
+            rows = index
+        else:
+            position = index + shape[0] if shape and index < 0 else index
+            rows = slice(position, position + 1)
+        start, stop, step = rows.indices(shape[0]) if shape else (0, 0, -1)
+        if fortran_order or step < 0:
+            # The rows are not contiguous, read the whole array
+            handle.seek(0)
+            return np.load(handle, allow_pickle=False)[index]
+        row_bytes = dtype.itemsize * math.prod(shape[1:])
+        handle.seek(header_length + start * row_bytes)
+        count = max(stop - start, 0)
+        data = np.frombuffer(bytearray(handle.read(count * row_bytes)), dtype=dtype)
+    data = data.reshape((count,) + tuple(shape[1:]))[::step]
+    return data if isinstance(index, slice) else data[0]
+
+
+def iter_array_chunks(node: orm.ArrayData, name: str, chunk_size: int = 1024):
+    """Iterate over an array in chunks of rows along its first axis"""
+    location = get_array_location(node, name)
+    if location is not None:
+        array = read_array(node, name)
+        for start in range(0, len(array), chunk_size):
+            yield np.array(array[start : start + chunk_size])
+        return
+
+    with node.base.repository.open(_get_filename(name), mode="rb") as handle:
+        shape, fortran_order, _, _ = read_npy_header(handle)
+    if fortran_order or not shape:
+        array = read_array(node, name, mmap=False)
+        for start in range(0, len(array), chunk_size):
+            yield array[start : start + chunk_size]
+        return
+    for start in range(0, shape[0], chunk_size):
+        yield read_array_slice(node, name, slice(start, start + chunk_size))
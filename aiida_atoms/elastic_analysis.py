@@ -0,0 +1,180 @@
+"""
+Derived elastic properties of many stored elastic tensors
+
+The tensors are fetched with a single query and the properties are computed for the
+whole (N, 6, 6) stack of Voigt matrices at once. The results are cached in the extras
+of the tensor nodes so they are not computed twice.
+"""
+
+from typing import Dict, Union
+
+import numpy as np
+
+from aiida import orm
+
+from .arrays import read_array
+
+EXTRAS_KEY = "elastic_properties"
+# Bump to invalidate the cached properties when their definitions change
+PROPERTIES_VERSION = 1
+
+PROPERTY_NAMES = (
+    "bulk_modulus_voigt",
+    "bulk_modulus_reuss",
+    "bulk_modulus_vrh",
+    "shear_modulus_voigt",
+    "shear_modulus_reuss",
+    "shear_modulus_vrh",
+    "youngs_modulus",
+    "poisson_ratio",
+    "universal_anisotropy",
+    "min_eigenvalue",
+    "is_stable",
+)
+
+
+def compute_elastic_properties(voigt: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Compute the derived properties of a stack of elastic tensors.
+
+    :param voigt: Elastic tensors in Voigt notation (GPa) with the shape (N, 6, 6) or (6, 6).
+
+    :returns: A dictionary of arrays of length N. The moduli are in GPa, the Hill averages
+        (VRH) are used for the Young's modulus and the Poisson ratio. A tensor is mechanically
+        stable (Born criteria) if all its eigenvalues are positive.
+    """
+    voigt = np.asarray(voigt, dtype=float).reshape(-1, 6, 6)
+    compliance = np.linalg.pinv(voigt)
+
+    def _sums(matrix):
+        """Sums of the diagonal normal, off-diagonal normal and diagonal shear components"""
+        diagonal = matrix[:, [0, 1, 2], [0, 1, 2]].sum(axis=1)
+        off_diagonal = matrix[:, [0, 0, 1], [1, 2, 2]].sum(axis=1)
+        shear = matrix[:, [3, 4, 5], [3, 4, 5]].sum(axis=1)
+        return diagonal, off_diagonal, shear
+
+    c_diag, c_off, c_shear = _sums(voigt)
+    s_diag, s_off, s_shear = _sums(compliance)
+
+    k_voigt = (c_diag + 2 * c_off) / 9
+    g_voigt = (c_diag - c_off + 3 * c_shear) / 15
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k_reuss = 1 / (s_diag + 2 * s_off)
+        g_reuss = 15 / (4 * s_diag - 4 * s_off + 3 * s_shear)
+        k_vrh = (k_voigt + k_reuss) / 2
+        g_vrh = (g_voigt + g_reuss) / 2
+        youngs = 9 * k_vrh * g_vrh / (3 * k_vrh + g_vrh)
+        poisson = (3 * k_vrh - 2 * g_vrh) / (6 * k_vrh + 2 * g_vrh)
+        anisotropy = 5 * g_voigt / g_reuss + k_voigt / k_reuss - 6
+
+    # Symmetrize against the numerical noise of the fit before getting the eigenvalues
+    min_eigenvalue = np.linalg.eigvalsh((voigt + voigt.transpose(0, 2, 1)) / 2)[:, 0]
+    return {
+        "bulk_modulus_voigt": k_voigt,
+        "bulk_modulus_reuss": k_reuss,
+        "bulk_modulus_vrh": k_vrh,
+        "shear_modulus_voigt": g_voigt,
+        "shear_modulus_reuss": g_reuss,
+        "shear_modulus_vrh": g_vrh,
+        "youngs_modulus": youngs,
+        "poisson_ratio": poisson,
+        "universal_anisotropy": anisotropy,
+        "min_eigenvalue": min_eigenvalue,
+        "is_stable": min_eigenvalue > 0,
+    }
+
+
+def query_elastic_tensors(group: Union[orm.Group, str]):
+    """
+    Fetch the elastic tensors in a group together with their extras.
+
+    The group may contain the `elastic_tensor` ArrayData nodes directly, e.g. the result
+    group of the batch elastic workchain, or the elastic workchains producing them.
+
+    :returns: A list of ``(node, extras)`` tuples ordered by the node ID.
+    """
+    if isinstance(group, orm.Group):
+        group = group.label
+
+    query = orm.QueryBuilder()
+    query.append(orm.Group, filters={"label": group}, tag="group")
+    query.append(
+        orm.ArrayData,
+        with_group="group",
+        filters={"attributes": {"has_key": "array|elastic_tensor"}},
+        project=["*", "extras"],
+    )
+    query.order_by({orm.ArrayData: {"id": "asc"}})
+    results = query.all()
+    if results:
+        return results
+
+    query = orm.QueryBuilder()
+    query.append(orm.Group, filters={"label": group}, tag="group")
+    query.append(orm.WorkflowNode, with_group="group", tag="workflow")
+    query.append(
+        orm.ArrayData,
+        with_incoming="workflow",
+        edge_filters={"label": {"like": "elastic_tensor%"}},
+        filters={"attributes": {"has_key": "array|elastic_tensor"}},
+        project=["*", "extras"],
+    )
+    query.order_by({orm.ArrayData: {"id": "asc"}})
+    return query.all()
+
+
+def get_elastic_properties(
+    group: Union[orm.Group, str], use_cache: bool = True, store_cache: bool = True
+) -> Dict[str, np.ndarray]:
+    """
+    Compute the derived elastic properties of all elastic tensors in a group.
+
+    :param group: The group or its label.
+    :param use_cache: Use the properties cached in the extras of the tensor nodes.
+    :param store_cache: Cache the newly computed properties in the extras.
+
+    :returns: A table as a dictionary of columns, which can be passed directly to
+        ``pandas.DataFrame``. The ``pk``, ``uuid`` and ``label`` columns identify the tensors.
+    """
+    results = query_elastic_tensors(group)
+    table = {
+        "pk": np.array([node.pk for node, _ in results], dtype=int),
+        "uuid": np.array([node.uuid for node, _ in results], dtype=object),
+        "label": np.array([node.label for node, _ in results], dtype=object),
+    }
+    for name in PROPERTY_NAMES:
+        table[name] = np.full(len(results), np.nan)
+    table["is_stable"] = np.zeros(len(results), dtype=bool)
+
+    missing = []
+    for i, (_, extras) in enumerate(results):
+        cached = (extras or {}).get(EXTRAS_KEY)
+        if (
+            use_cache
+            and cached is not None
+            and cached.get("version") == PROPERTIES_VERSION
+        ):
+            for name in PROPERTY_NAMES:
+                # Non-finite values are cached as None since JSON has no NaN
+                table[name][i] = np.nan if cached[name] is None else cached[name]
+        else:
+            missing.append(i)
+
+    if missing:
+        voigt = np.stack(
+            [read_array(results[i][0], "elastic_tensor") for i in missing]
+        )
+        properties = compute_elastic_properties(voigt)
+        for name in PROPERTY_NAMES:
+            table[name][missing] = properties[name]
+        if store_cache:
+            for j, i in enumerate(missing):
+                cache = {
+                    name: properties[name][j].item()
+                    if np.isfinite(properties[name][j])
+                    else None
+                    for name in PROPERTY_NAMES
+                }
+                cache["version"] = PROPERTIES_VERSION
+                results[i][0].base.extras.set(EXTRAS_KEY, cache)
+    return table
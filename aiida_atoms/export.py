@@ -0,0 +1,426 @@
+"""
+Export structures with their energies, forces and stresses for training potentials
+
+The structures are selected from a group or from the descendants of a node (e.g. the
+node of an `AtomsTracker`) and read in pages ordered by their ids, with the atoms built
+from the projected attributes instead of loading each node. Each page is appended to
+the output file before the next one is queried, so the memory use does not grow with
+the number of structures.
+
+Two formats are supported:
+
+    - HDF5 (``.h5``/``.hdf5``, requires h5py), with the per-atom arrays concatenated
+      in chunked and compressed datasets indexed by the ``natoms`` of each structure
+    - extended XYZ (any other suffix), written with ASE
+
+The id of the last exported structure is saved with the output (as an attribute of the
+HDF5 file or in a ``.progress.json`` file next to the extended XYZ file), so that an
+interrupted export, or an export of a growing group, continues where it stopped.
+"""
+
+import json
+import os
+import typing as t
+
+import numpy as np
+
+from aiida import orm
+
+from .arrays import read_array
+
+# eV/Å^3 to kBar
+EV_PER_ANGSTROM3_TO_KBAR = 1602.1766208
+
+DEFAULT_PAGE_SIZE = 1000
+
+_STRUCTURE_PROJECTIONS = [
+    "id",
+    "uuid",
+    "attributes.cell",
+    "attributes.pbc1",
+    "attributes.pbc2",
+    "attributes.pbc3",
+    "attributes.kinds",
+    "attributes.sites",
+]
+
+
+def atoms_from_attributes(cell, pbc, kinds, sites):
+    """Build the atoms from the attributes of a `StructureData`"""
+    from ase import Atoms
+
+    symbols = {kind["name"]: kind["symbols"][0] for kind in kinds}
+    return Atoms(
+        symbols=[symbols[site["kind_name"]] for site in sites],
+        positions=[site["position"] for site in sites],
+        cell=cell,
+        pbc=pbc,
+    )
+
+
+def _get_root_pk(ancestor):
+    """The pk of a node, a tracker or a pk"""
+    if isinstance(ancestor, int):
+        return ancestor
+    return getattr(ancestor, "node", ancestor).pk
+
+
+def iter_structure_pages(
+    group: t.Union[orm.Group, str, None] = None,
+    ancestor=None,
+    after: int = 0,
+    page_size: int = DEFAULT_PAGE_SIZE,
+):
+    """
+    Iterate over the structures of a group or the descendants of a node in pages.
+
+    :param group: The group, or its label.
+    :param ancestor: A node, tracker or pk. The node itself is included if it is a
+        structure.
+    :param after: Only structures with larger ids than this are returned.
+
+    :returns: Lists of ``(pk, uuid, atoms)`` ordered by the pk.
+    """
+    if (group is None) == (ancestor is None):
+        raise ValueError("Exactly one of group and ancestor must be given")
+
+    while True:
+        query = orm.QueryBuilder()
+        if group is not None:
+            label = group if isinstance(group, str) else group.label
+            query.append(orm.Group, filters={"label": label}, tag="source")
+            relation = {"with_group": "source"}
+        else:
+            root = _get_root_pk(ancestor)
+            query.append(orm.Node, filters={"id": root}, tag="source")
+            relation = {"with_ancestors": "source"}
+        query.append(
+            orm.StructureData,
+            filters={"id": {">": after}},
+            project=_STRUCTURE_PROJECTIONS,
+            tag="structure",
+            **relation,
+        )
+        query.order_by({"structure": {"id": "asc"}}).limit(page_size).distinct()
+        rows = query.all()
+
+        if ancestor is not None and (not rows or root < rows[0][0]) and root > after:
+            # The descendants do not include the root itself
+            root_query = orm.QueryBuilder().append(
+                orm.StructureData, filters={"id": root}, project=_STRUCTURE_PROJECTIONS
+            )
+            rows = root_query.all() + rows
+        if not rows:
+            return
+        yield [
+            (pk, uuid, atoms_from_attributes(cell, [pbc1, pbc2, pbc3], kinds, sites))
+            for pk, uuid, cell, pbc1, pbc2, pbc3, kinds, sites in rows
+        ]
+        after = rows[-1][0]
+
+
+def _get_energy(total_energies: t.Optional[dict]):
+    """The energy from the ``total_energies`` of the ``misc`` output of aiida-vasp"""
+    if not total_energies:
+        return None
+    for key in ("energy_extrapolated", "energy_no_entropy", "energy_free"):
+        if key in total_energies:
+            return total_energies[key]
+    return None
+
+
+def get_structure_properties(pks: t.Sequence[int]) -> t.Dict[int, dict]:
+    """
+    Energies, forces and stresses of structures from the outputs of their creators.
+
+    The values are those of the ``misc`` and ``forces`` (or ``arrays``) outputs of the
+    calculation that created each structure, converted to the units and sign conventions
+    of ASE (eV, eV/Å and eV/Å^3).
+    """
+    properties = {pk: {} for pk in pks}
+    if not pks:
+        return properties
+
+    query = orm.QueryBuilder()
+    query.append(
+        orm.StructureData,
+        filters={"id": {"in": list(pks)}},
+        project=["id"],
+        tag="structure",
+    )
+    query.append(orm.CalculationNode, with_outgoing="structure", tag="creator")
+    query.append(
+        orm.Dict,
+        with_incoming="creator",
+        edge_filters={"label": "misc"},
+        project=["attributes.total_energies", "attributes.stress"],
+    )
+    for pk, total_energies, stress in query.iterall():
+        energy = _get_energy(total_energies)
+        if energy is not None:
+            properties[pk]["energy"] = energy
+        if stress is not None:
+            properties[pk]["stress"] = -np.asarray(stress) / EV_PER_ANGSTROM3_TO_KBAR
+
+    query = orm.QueryBuilder()
+    query.append(
+        orm.StructureData,
+        filters={"id": {"in": list(pks)}},
+        project=["id"],
+        tag="structure",
+    )
+    query.append(orm.CalculationNode, with_outgoing="structure", tag="creator")
+    query.append(
+        orm.ArrayData,
+        with_incoming="creator",
+        edge_filters={"label": {"in": ["forces", "arrays"]}},
+        project=["*"],
+    )
+    for pk, node in query.iterall():
+        for name in ("final", "forces"):
+            if name in node.get_arraynames():
+                forces = read_array(node, name)
+                # Keep the last ionic step of a trajectory
+                properties[pk]["forces"] = forces[-1] if forces.ndim == 3 else forces
+                break
+    return properties
+
+
+def _collect_page(page, with_properties=True):
+    """Attach the properties to the atoms of a page"""
+    properties = {}
+    if with_properties:
+        properties = get_structure_properties([pk for pk, _, _ in page])
+    return [(pk, uuid, atoms, properties.get(pk, {})) for pk, uuid, atoms in page]
+
+
+class HDF5StructureWriter:
+    """
+    Append structures to an HDF5 file.
+
+    The per-atom arrays (``numbers``, ``positions`` and ``forces``) are concatenated
+    over all structures, and the per-structure datasets (``natoms``, ``cell``, ``pbc``,
+    ``energy``, ``stress``, ``node_id`` and ``uuid``) have one entry per structure.
+    Missing properties are stored as NaN.
+    """
+
+    _PER_ATOM = {
+        "numbers": ((), "i1"),
+        "positions": ((3,), "f8"),
+        "forces": ((3,), "f8"),
+    }
+    _PER_STRUCTURE = {
+        "natoms": ((), "i8"),
+        "cell": ((3, 3), "f8"),
+        "pbc": ((3,), "?"),
+        "energy": ((), "f8"),
+        "stress": ((3, 3), "f8"),
+        "node_id": ((), "i8"),
+        "uuid": ((), "S36"),
+    }
+
+    def __init__(self, path: str, chunk_size: int = 4096, compression="gzip"):
+        """Open the file, resuming an earlier export"""
+        try:
+            import h5py
+        except ImportError as error:
+            raise ImportError(
+                "h5py is needed for exporting to HDF5, install it or use extended XYZ"
+            ) from error
+
+        self.handle = h5py.File(path, "a")
+        for name, (shape, dtype) in {**self._PER_ATOM, **self._PER_STRUCTURE}.items():
+            if name not in self.handle:
+                self.handle.create_dataset(
+                    name,
+                    shape=(0,) + shape,
+                    maxshape=(None,) + shape,
+                    dtype=dtype,
+                    chunks=(chunk_size,) + shape,
+                    compression=compression,
+                )
+        attrs = self.handle.attrs
+        self.last_id = int(attrs.get("last_id", 0))
+        self.count = int(attrs.get("count", 0))
+        self.atom_count = int(attrs.get("atom_count", 0))
+        # Discard a page that was written only partially before an interruption
+        for name in self._PER_ATOM:
+            self.handle[name].resize(self.atom_count, axis=0)
+        for name in self._PER_STRUCTURE:
+            self.handle[name].resize(self.count, axis=0)
+
+    def _append(self, name, values, start):
+        """Append values to a dataset"""
+        dataset = self.handle[name]
+        dataset.resize(start + len(values), axis=0)
+        dataset[start:] = values
+
+    def write_page(self, records):
+        """Append a page of ``(pk, uuid, atoms, properties)``"""
+        natoms = np.array([len(atoms) for _, _, atoms, _ in records])
+        nan3 = np.full(3, np.nan)
+        per_atom = {
+            "numbers": np.concatenate([atoms.numbers for _, _, atoms, _ in records]),
+            "positions": np.concatenate(
+                [atoms.positions for _, _, atoms, _ in records]
+            ),
+            "forces": np.concatenate(
+                [
+                    props.get("forces", np.tile(nan3, (len(atoms), 1)))
+                    for _, _, atoms, props in records
+                ]
+            ),
+        }
+        per_structure = {
+            "natoms": natoms,
+            "cell": np.array([atoms.cell[:] for _, _, atoms, _ in records]),
+            "pbc": np.array([atoms.pbc for _, _, atoms, _ in records]),
+            "energy": np.array(
+                [props.get("energy", np.nan) for _, _, _, props in records]
+            ),
+            "stress": np.array(
+                [
+                    props.get("stress", np.full((3, 3), np.nan))
+                    for _, _, _, props in records
+                ]
+            ),
+            "node_id": np.array([pk for pk, _, _, _ in records]),
+            "uuid": np.array([uuid.encode() for _, uuid, _, _ in records], dtype="S36"),
+        }
+        for name, values in per_atom.items():
+            self._append(name, values, self.atom_count)
+        for name, values in per_structure.items():
+            self._append(name, values, self.count)
+
+        # Mark the page as complete
+        self.count += len(records)
+        self.atom_count += int(natoms.sum())
+        self.last_id = records[-1][0]
+        self.handle.attrs.update(
+            {
+                "last_id": self.last_id,
+                "count": self.count,
+                "atom_count": self.atom_count,
+            }
+        )
+        self.handle.flush()
+
+    def close(self):
+        """Close the file"""
+        self.handle.close()
+
+
+class ExtXYZStructureWriter:
+    """
+    Append structures to an extended XYZ file.
+
+    The progress is saved in a sidecar ``<path>.progress.json`` file with the id of the
+    last exported structure and the size of the file after it was written.
+    """
+
+    def __init__(self, path: str):
+        """Open the file, resuming an earlier export"""
+        self.progress_path = path + ".progress.json"
+        self.last_id, self.count, offset = 0, 0, 0
+        if os.path.isfile(self.progress_path):
+            with open(self.progress_path, encoding="utf-8") as handle:
+                progress = json.load(handle)
+            self.last_id, self.count = progress["last_id"], progress["count"]
+            offset = progress["offset"]
+        elif os.path.isfile(path) and os.path.getsize(path) > 0:
+            raise FileExistsError(
+                f"{path} exists but was not written by an earlier export, "
+                "choose another file"
+            )
+        self.handle = open(path, "ab")  # pylint: disable=consider-using-with
+        # Discard a page that was written only partially before an interruption
+        self.handle.truncate(offset)
+        self.handle.seek(offset)
+
+    def write_page(self, records):
+        """Append a page of ``(pk, uuid, atoms, properties)``"""
+        import io
+
+        from ase.calculators.singlepoint import SinglePointCalculator
+        from ase.io import write
+
+        images = []
+        for pk, uuid, atoms, props in records:
+            atoms.info.update({"node_id": pk, "uuid": uuid})
+            results = {}
+            if "energy" in props:
+                results["energy"] = props["energy"]
+            if "forces" in props:
+                results["forces"] = props["forces"]
+            if "stress" in props:
+                results["stress"] = props["stress"]
+            if results:
+                atoms.calc = SinglePointCalculator(atoms, **results)
+            images.append(atoms)
+
+        buffer = io.StringIO()
+        write(buffer, images, format="extxyz")
+        self.handle.write(buffer.getvalue().encode())
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+        self.count += len(records)
+        self.last_id = records[-1][0]
+        progress = {
+            "last_id": self.last_id,
+            "count": self.count,
+            "offset": self.handle.tell(),
+        }
+        with open(self.progress_path + ".tmp", "w", encoding="utf-8") as handle:
+            json.dump(progress, handle)
+        os.replace(self.progress_path + ".tmp", self.progress_path)
+
+    def close(self):
+        """Close the file"""
+        self.handle.close()
+
+
+def get_structure_writer(path: str, fmt: t.Optional[str] = None):
+    """The writer of the format, guessed from the suffix of the path if not given"""
+    if fmt is None:
+        fmt = "hdf5" if path.endswith((".h5", ".hdf5")) else "extxyz"
+    if fmt == "hdf5":
+        return HDF5StructureWriter(path)
+    if fmt == "extxyz":
+        return ExtXYZStructureWriter(path)
+    raise ValueError(f"Unknown export format: {fmt}")
+
+
+def export_structures(
+    path: str,
+    group: t.Union[orm.Group, str, None] = None,
+    ancestor=None,
+    fmt: t.Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    with_properties: bool = True,
+) -> int:
+    """
+    Export the structures of a group or the descendants of a node.
+
+    An existing export at the path is continued after its last structure.
+
+    :param path: The output file.
+    :param group: The group, or its label.
+    :param ancestor: A node, tracker or pk whose descendant structures are exported.
+    :param fmt: ``hdf5`` or ``extxyz``, guessed from the suffix by default.
+    :param page_size: Number of structures in each query and write.
+    :param with_properties: Export the energies, forces and stresses.
+
+    :returns: The number of structures exported by this call.
+    """
+    writer = get_structure_writer(path, fmt)
+    exported = 0
+    try:
+        for page in iter_structure_pages(
+            group=group, ancestor=ancestor, after=writer.last_id, page_size=page_size
+        ):
+            writer.write_page(_collect_page(page, with_properties))
+            exported += len(page)
+    finally:
+        writer.close()
+    return exported
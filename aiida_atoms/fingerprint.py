@@ -0,0 +1,377 @@
+"""
+Structure fingerprints for finding equivalent structures in the database
+
+The fingerprint of a structure consists of:
+
+    - the reduced formula and the number of atoms
+    - the space group number found by spglib with a loose tolerance
+    - the volume per atom
+    - a smoothed radial distribution function, which is invariant to permutations of the
+      atoms, shifts of the origin and the choice of the cell
+
+It is stored in the extras of the StructureData nodes. The reduced formula and the
+number of atoms, which do not change with small displacements of the atoms, are combined
+into the ``fingerprint_key`` extra, so the candidates are selected by an equality filter
+on a single key and a range filter on the volume, rather than by scanning all the
+structures. The candidates are then compared by their descriptors and verified with a
+minimum image structure matcher. The space group may change with the noise of the
+positions, even with a loose tolerance, so it is only a hint used when the candidates
+are not verified.
+
+On PostgreSQL the candidates are selected with plain SQL using the same expressions as
+the index made by `create_fingerprint_index`, since the JSON filters generated by the
+QueryBuilder cannot use an expression index. Whether the index is used can be checked
+with `explain_candidate_query`.
+"""
+
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
+import numpy as np
+
+from aiida import orm
+from aiida.manage import get_manager
+
+if TYPE_CHECKING:
+    import ase
+
+FINGERPRINT_VERSION = 2
+EXTRAS_KEY = "fingerprint"
+INDEX_KEY = "fingerprint_key"
+
+# Radial distribution function, smoothed by a Gaussian of width RDF_SIGMA (Å)
+RDF_CUTOFF = 6.0
+RDF_BINS = 60
+RDF_SIGMA = 0.1
+# Spacing of the grid the distances are spread on before the smoothing (Å)
+RDF_GRID_SPACING = 0.01
+# Tolerance of the space group detection (Å)
+SPACEGROUP_SYMPREC = 0.1
+
+
+def get_reduced_formula(atoms) -> str:
+    """Reduced formula with the elements in alphabetical order"""
+    symbols, counts = np.unique(atoms.get_chemical_symbols(), return_counts=True)
+    divisor = np.gcd.reduce(counts)
+    return "".join(
+        f"{symbol}{count // divisor if count // divisor > 1 else ''}"
+        for symbol, count in zip(symbols, counts)
+    )
+
+
+def get_image_offsets(cell: np.ndarray, cutoff: float) -> np.ndarray:
+    """Lattice translations of all images within the cutoff distance"""
+    # Distances between opposite faces of the cell
+    volume = abs(np.linalg.det(cell))
+    heights = volume / np.linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+    nmax = np.ceil(cutoff / heights).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in nmax]
+    grid = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+    return grid @ cell
+
+
+def get_rdf_descriptor(
+    atoms, cutoff=RDF_CUTOFF, nbins=RDF_BINS, sigma=RDF_SIGMA
+) -> np.ndarray:
+    """
+    Radial distribution function of a periodic structure, smoothed with a Gaussian.
+
+    The distances are spread linearly onto a fine grid and the grid is smoothed with a
+    Gaussian of width `sigma` (Å) at the centres of the bins, so unlike a histogram the
+    descriptor changes continuously with the positions. It is normalised by the number
+    of atoms and the volume of each shell, so the descriptor of a supercell is the same
+    as that of the unit cell.
+    """
+    cell = np.asarray(atoms.cell[:])
+    positions = atoms.get_positions()
+    # Distances beyond the cutoff still contribute to the last bins
+    reach = cutoff + 4 * sigma
+    offsets = get_image_offsets(cell, reach)
+    # Vectors between every atom and all images of every other atom
+    vectors = (
+        positions[None, :, None, :] - positions[:, None, None, :] + offsets[None, None]
+    )
+    distances = np.linalg.norm(vectors, axis=-1).ravel()
+    distances = distances[(distances > 1e-8) & (distances < reach)]
+
+    grid = np.arange(0, reach + 2 * RDF_GRID_SPACING, RDF_GRID_SPACING)
+    scaled = distances / RDF_GRID_SPACING
+    lower = np.floor(scaled).astype(int)
+    upper_weight = scaled - lower
+    weights = np.bincount(lower, 1 - upper_weight, len(grid)) + np.bincount(
+        lower + 1, upper_weight, len(grid)
+    )
+
+    edges = np.linspace(0, cutoff, nbins + 1)
+    centres = (edges[1:] + edges[:-1]) / 2
+    kernel = np.exp(-0.5 * ((centres[:, None] - grid[None, :]) / sigma) ** 2)
+    counts = kernel @ weights * (edges[1] - edges[0]) / (np.sqrt(2 * np.pi) * sigma)
+    shells = 4 / 3 * np.pi * (edges[1:] ** 3 - edges[:-1] ** 3)
+    density = len(atoms) / abs(np.linalg.det(cell))
+    return counts / (len(atoms) * shells * density)
+
+
+def compute_fingerprint(atoms, symprec: float = SPACEGROUP_SYMPREC) -> dict:
+    """
+    Compute the fingerprint of a structure.
+
+    :param atoms: An `ase.Atoms` or a `StructureData`.
+    :param symprec: Tolerance of the space group detection.
+    """
+    import spglib
+
+    if isinstance(atoms, orm.StructureData):
+        atoms = atoms.get_ase()
+    spacegroup = spglib.get_symmetry_dataset(
+        (atoms.cell[:], atoms.get_scaled_positions(), atoms.numbers), symprec=symprec
+    )
+    # The dataset is a dictionary in older spglib versions
+    number = getattr(spacegroup, "number", None) if spacegroup is not None else None
+    if number is None and spacegroup is not None:
+        number = spacegroup["number"]
+    formula = get_reduced_formula(atoms)
+    return {
+        "version": FINGERPRINT_VERSION,
+        "formula": formula,
+        "natoms": len(atoms),
+        "spacegroup": int(number or 1),
+        "volume_per_atom": float(atoms.get_volume() / len(atoms)),
+        "descriptor": np.round(get_rdf_descriptor(atoms), 6).tolist(),
+    }
+
+
+def get_fingerprint_key(fingerprint: dict) -> str:
+    """The key of the equality lookup"""
+    return f"{fingerprint['formula']}|{fingerprint['natoms']}"
+
+
+def store_fingerprint(
+    node: orm.StructureData, symprec: float = SPACEGROUP_SYMPREC
+) -> dict:
+    """Compute the fingerprint of a stored structure and save it in the extras"""
+    fingerprint = compute_fingerprint(node, symprec=symprec)
+    node.base.extras.set_many(
+        {EXTRAS_KEY: fingerprint, INDEX_KEY: get_fingerprint_key(fingerprint)}
+    )
+    return fingerprint
+
+
+# SQL expressions of the fingerprint key and the volume per atom in the extras
+KEY_EXPRESSION = f"(extras ->> '{INDEX_KEY}')"
+VOLUME_EXPRESSION = (
+    f"((extras #>> '{{{EXTRAS_KEY},volume_per_atom}}')::double precision)"
+)
+CANDIDATE_QUERY = (
+    "SELECT id FROM db_dbnode WHERE node_type = :node_type "
+    f"AND {KEY_EXPRESSION} = :key AND {VOLUME_EXPRESSION} BETWEEN :low AND :high"
+)
+
+
+def _get_psql_session():
+    """The session of the PostgreSQL storage backend, or None for other backends"""
+    storage = get_manager().get_profile_storage()
+    if "psql" not in type(storage).__module__:
+        return None
+    return storage.get_session()
+
+
+def create_fingerprint_index():
+    """
+    Create an expression index on the fingerprint key and the volume for PostgreSQL.
+
+    Without it the lookups still work, but the database has to scan the extras of all
+    nodes. The index is not part of the AiiDA schema and is not managed by its
+    migrations, see the ``aiida-atoms admin create-fingerprint-index`` command.
+
+    :returns: Whether the index was created, i.e. the storage backend is PostgreSQL.
+    """
+    from sqlalchemy import text
+
+    session = _get_psql_session()
+    if session is None:
+        return False
+    session.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS db_dbnode_extras_fingerprint_key "
+            f"ON db_dbnode ({KEY_EXPRESSION}, {VOLUME_EXPRESSION})"
+        )
+    )
+    session.commit()
+    return True
+
+
+def _get_candidate_parameters(key: str, low: float, high: float) -> dict:
+    """The parameters of the candidate query"""
+    return {
+        "node_type": orm.StructureData.class_node_type,
+        "key": key,
+        "low": low,
+        "high": high,
+    }
+
+
+def find_candidate_ids(key: str, low: float, high: float) -> Optional[List[int]]:
+    """
+    The IDs of the structures with a fingerprint key and a volume per atom in a range.
+
+    :returns: The IDs, or None if the storage backend is not PostgreSQL.
+    """
+    from sqlalchemy import text
+
+    session = _get_psql_session()
+    if session is None:
+        return None
+    rows = session.execute(
+        text(CANDIDATE_QUERY), _get_candidate_parameters(key, low, high)
+    )
+    return [row[0] for row in rows]
+
+
+def explain_candidate_query(
+    key: str = "", low: float = 0.0, high: float = 1.0
+) -> List[str]:
+    """
+    The query plan of the candidate lookup, to check that the index is used.
+
+    The planner may still scan the table while it holds only a few structures.
+    """
+    from sqlalchemy import text
+
+    session = _get_psql_session()
+    if session is None:
+        return []
+    rows = session.execute(
+        text("EXPLAIN " + CANDIDATE_QUERY), _get_candidate_parameters(key, low, high)
+    )
+    return [row[0] for row in rows]
+
+
+def match_atoms(
+    atoms1, atoms2, length_tol=0.02, angle_tol=1.0, position_tol=0.2
+) -> Tuple[bool, float]:
+    """
+    Check if two structures are equivalent up to permutations, origin shifts and noise.
+
+    Both cells are Niggli reduced, then for each translation bringing an atom of the least
+    common element of the first structure onto an atom of the same element in the second,
+    the minimum image distances of all atom pairs are computed at once. The structures
+    match if for some translation every atom has a partner of the same element within
+    `position_tol` (Å).
+
+    :param length_tol: Relative tolerance of the reduced cell lengths.
+    :param angle_tol: Tolerance of the reduced cell angles (degrees).
+
+    :returns: Whether the structures match and the RMS displacement of the best match.
+    """
+    from ase.build import niggli_reduce
+
+    if len(atoms1) != len(atoms2) or sorted(atoms1.numbers) != sorted(atoms2.numbers):
+        return False, np.inf
+    atoms1, atoms2 = atoms1.copy(), atoms2.copy()
+    for atoms in (atoms1, atoms2):
+        atoms.pbc = True
+        niggli_reduce(atoms)
+    params1, params2 = atoms1.cell.cellpar(), atoms2.cell.cellpar()
+    if np.any(np.abs(params1[:3] - params2[:3]) > length_tol * params1[:3]):
+        return False, np.inf
+    if np.any(np.abs(params1[3:] - params2[3:]) > angle_tol):
+        return False, np.inf
+
+    cell = (atoms1.cell[:] + atoms2.cell[:]) / 2
+    frac1 = atoms1.get_scaled_positions()
+    frac2 = atoms2.get_scaled_positions()
+    numbers1, numbers2 = atoms1.numbers, atoms2.numbers
+    values, counts = np.unique(numbers1, return_counts=True)
+    anchor = np.flatnonzero(numbers1 == values[np.argmin(counts)])[0]
+
+    # Translations (T, 3) mapping the anchor atom onto each candidate partner
+    translations = frac2[numbers2 == numbers1[anchor]] - frac1[anchor]
+    # Minimum image differences (T, N1, N2, 3)
+    delta = frac2[None, None, :, :] - frac1[None, :, None, :] - translations[:, None, None]
+    delta -= np.round(delta)
+    distances = np.linalg.norm(delta @ cell, axis=-1)
+    distances = np.where(
+        numbers1[None, :, None] == numbers2[None, None, :], distances, np.inf
+    )
+    nearest = distances.min(axis=2)
+    worst = nearest.max(axis=1)
+    best = int(np.argmin(worst))
+    if worst[best] > position_tol:
+        return False, np.inf
+    return True, float(np.sqrt(np.mean(nearest[best] ** 2)))
+
+
+def find_equivalent_structures(
+    structure: Union[orm.StructureData, "ase.Atoms"],
+    volume_tol: float = 0.05,
+    descriptor_tol: float = 0.1,
+    position_tol: float = 0.2,
+    verify: bool = True,
+    symprec: float = SPACEGROUP_SYMPREC,
+) -> List[Tuple[orm.StructureData, float]]:
+    """
+    Find the stored structures with fingerprints equivalent to a structure.
+
+    The candidates are selected by their reduced formula, number of atoms and volume
+    per atom, then compared by their descriptors. Without the verification, the
+    candidates must also have the same space group.
+
+    :param structure: The structure to look up.
+    :param volume_tol: Relative tolerance of the volume per atom.
+    :param descriptor_tol: Tolerance of the RMS difference of the RDF descriptors.
+    :param position_tol: Tolerance of the atomic positions (Å) of the structure matcher.
+    :param verify: Verify the candidates with the structure matcher.
+    :param symprec: Tolerance of the space group detection, the same as when the
+        fingerprints were stored.
+
+    :returns: A list of ``(node, distance)`` sorted by the distance, which is the RMS
+        displacement of the matched atoms if verified, otherwise the descriptor difference.
+    """
+    atoms = structure.get_ase() if isinstance(structure, orm.StructureData) else structure
+    fingerprint = compute_fingerprint(atoms, symprec=symprec)
+    volume = fingerprint["volume_per_atom"]
+
+    key = get_fingerprint_key(fingerprint)
+    low, high = volume * (1 - volume_tol), volume * (1 + volume_tol)
+    ids = find_candidate_ids(key, low, high)
+    if ids is None:
+        filters = {
+            f"extras.{INDEX_KEY}": key,
+            f"extras.{EXTRAS_KEY}.volume_per_atom": {
+                "and": [{">=": low}, {"<=": high}]
+            },
+        }
+    elif not ids:
+        return []
+    else:
+        filters = {"id": {"in": ids}}
+    query = orm.QueryBuilder()
+    query.append(
+        orm.StructureData,
+        filters=filters,
+        project=[
+            "*",
+            f"extras.{EXTRAS_KEY}.descriptor",
+            f"extras.{EXTRAS_KEY}.spacegroup",
+        ],
+    )
+    candidates = query.all()
+    if not candidates:
+        return []
+
+    # Compare the descriptors of all candidates at once
+    descriptors = np.array([descriptor for _, descriptor, _ in candidates])
+    differences = np.sqrt(
+        np.mean((descriptors - np.array(fingerprint["descriptor"])) ** 2, axis=1)
+    )
+    results = []
+    for (node, _, spacegroup), difference in zip(candidates, differences):
+        if difference > descriptor_tol:
+            continue
+        if not verify:
+            if spacegroup == fingerprint["spacegroup"]:
+                results.append((node, float(difference)))
+            continue
+        matched, rms = match_atoms(atoms, node.get_ase(), position_tol=position_tol)
+        if matched:
+            results.append((node, rms))
+    return sorted(results, key=lambda item: item[1])
@@ -0,0 +1,272 @@
+"""
+Lattice thermal conductivity from ``phono3py_params.yaml`` in parallel chunks
+
+The irreducible q-points of the mesh and the temperatures are split into chunks, which
+are computed by a pool of worker processes, or by the ranks of an MPI job when run with
+``mpirun python -m aiida_atoms.ltc`` and mpi4py is installed. Each worker loads the
+force constants and sets up the phonon-phonon interaction once.
+
+The result of each chunk is written to the checkpoint directory as soon as it is done,
+so an interrupted calculation continues with the remaining chunks. A chunk stores the
+mode thermal conductivities summed over its q-points and bands together with the number
+of sampling grid points, so the chunks are added up to give exactly the thermal
+conductivity of the full calculation (within the relaxation time approximation).
+
+The time of each chunk is reported to help choosing the mesh and the chunk sizes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+import typing as t
+
+import numpy as np
+
+DEFAULT_LTC_SETTINGS = {
+    # Sampling mesh of the q-points
+    "mesh": [11, 11, 11],
+    "temperatures": [300.0],
+    # Number of irreducible q-points in each chunk
+    "grid_chunk_size": 8,
+    # Number of temperatures in each chunk, all temperatures by default
+    "temperature_chunk_size": None,
+    # Number of worker processes, all cores by default
+    "workers": None,
+    "is_isotope": False,
+    # Run the job with MPI ranks instead of worker processes (job mode only)
+    "mpi": False,
+}
+
+_WORKER_STATE = {}
+
+
+def get_ltc_settings(settings: t.Optional[dict] = None) -> dict:
+    """The settings updated with the defaults"""
+    return {**DEFAULT_LTC_SETTINGS, **(settings or {})}
+
+
+def load_phono3py(params_path: str, mesh, produce_fc: bool = True):
+    """Load phono3py from a ``phono3py_params.yaml`` file and set the mesh"""
+    import phono3py
+
+    ph3 = phono3py.load(str(params_path), produce_fc=produce_fc, log_level=0)
+    ph3.mesh_numbers = list(mesh)
+    return ph3
+
+
+def get_ir_grid_points(ph3) -> np.ndarray:
+    """The irreducible q-points of the mesh as indices of the BZ grid"""
+    from phono3py.phonon.grid import get_ir_grid_points as _get_ir_grid_points
+
+    ir_grid_points, _, _ = _get_ir_grid_points(ph3.grid)
+    return ph3.grid.grg2bzg[ir_grid_points]
+
+
+def get_chunks(grid_points, temperatures, grid_chunk_size, temperature_chunk_size=None):
+    """
+    Split the grid points and temperatures into chunks.
+
+    :returns: A list of ``(name, grid_points, temperature_index, temperatures)`` where
+        ``temperature_index`` is the index of the first temperature of the chunk.
+    """
+    qsize = grid_chunk_size
+    tsize = temperature_chunk_size or len(temperatures)
+    chunks = []
+    for i in range(0, len(grid_points), qsize):
+        points = [int(point) for point in grid_points[i : i + qsize]]
+        for j in range(0, len(temperatures), tsize):
+            temps = [float(value) for value in temperatures[j : j + tsize]]
+            name = f"chunk-q{i // qsize:05d}-t{j // tsize:03d}"
+            chunks.append((name, points, j, temps))
+    return chunks
+
+
+def _init_worker(params_path, mesh, is_isotope):
+    """Load the force constants and set up the interaction in a worker"""
+    ph3 = load_phono3py(params_path, mesh)
+    ph3.init_phph_interaction()
+    _WORKER_STATE.update(phono3py=ph3, is_isotope=is_isotope)
+
+
+def compute_chunk(grid_points, temperatures) -> dict:
+    """Compute the thermal conductivity contributions of a chunk in a worker"""
+    ph3 = _WORKER_STATE["phono3py"]
+    start = time.perf_counter()
+    ph3.run_thermal_conductivity(
+        temperatures=temperatures,
+        grid_points=grid_points,
+        is_isotope=_WORKER_STATE["is_isotope"],
+        write_kappa=False,
+    )
+    conductivity = ph3.thermal_conductivity
+    return {
+        # (sigmas, temperatures, 6) summed over the q-points and bands
+        "mode_kappa_sum": np.asarray(conductivity.mode_kappa).sum(axis=(2, 3)),
+        "num_sampling_grid_points": conductivity.number_of_sampling_grid_points,
+        "time": time.perf_counter() - start,
+    }
+
+
+def write_chunk(checkpoint_dir: Path, name: str, result: dict):
+    """Write the result of a chunk, the file only appears once it is complete"""
+    path = checkpoint_dir / f"{name}.npz"
+    tmp_path = checkpoint_dir / f"{name}.tmp.npz"
+    np.savez(tmp_path, **result)
+    os.replace(tmp_path, path)
+
+
+def read_chunk(checkpoint_dir: Path, name: str) -> t.Optional[dict]:
+    """Read the result of a finished chunk"""
+    path = checkpoint_dir / f"{name}.npz"
+    if not path.is_file():
+        return None
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def _get_mpi_communicator():
+    """The MPI communicator if running under MPI with more than one rank"""
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    comm = MPI.COMM_WORLD
+    return comm if comm.Get_size() > 1 else None
+
+
+def run_ltc(
+    params_path: str, settings: t.Optional[dict] = None, checkpoint_dir=None, log=print
+) -> t.Optional[dict]:
+    """
+    Compute the lattice thermal conductivity in chunks.
+
+    :param params_path: The ``phono3py_params.yaml`` file.
+    :param settings: The settings, see `DEFAULT_LTC_SETTINGS`.
+    :param checkpoint_dir: The directory of the chunk results, ``ltc_chunks`` next to
+        the parameter file by default.
+    :param log: Function called with the progress messages.
+
+    :returns: A dictionary with the ``kappa`` (sigmas, temperatures, 6) in W/m-K, the
+        ``temperatures``, the ``mesh`` and the ``chunk_times`` and the number of
+        ``chunk_grid_points``. Under MPI only the first rank returns the results.
+    """
+    settings = get_ltc_settings(settings)
+    checkpoint_dir = Path(checkpoint_dir or Path(params_path).parent / "ltc_chunks")
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    temperatures = np.asarray(settings["temperatures"], dtype=float)
+
+    grid_points = get_ir_grid_points(
+        load_phono3py(params_path, settings["mesh"], produce_fc=False)
+    )
+    chunks = get_chunks(
+        grid_points,
+        temperatures,
+        settings["grid_chunk_size"],
+        settings["temperature_chunk_size"],
+    )
+    comm = _get_mpi_communicator()
+    rank, size = (comm.Get_rank(), comm.Get_size()) if comm else (0, 1)
+    pending = [
+        chunk
+        for index, chunk in enumerate(chunks)
+        if index % size == rank and read_chunk(checkpoint_dir, chunk[0]) is None
+    ]
+    log(
+        f"{len(grid_points)} irreducible q-points and {len(temperatures)} temperatures "
+        f"in {len(chunks)} chunks, {len(pending)} to compute on rank {rank}"
+    )
+
+    initargs = (str(params_path), settings["mesh"], settings["is_isotope"])
+    workers = 1 if comm else settings["workers"] or os.cpu_count()
+    if pending and workers == 1:
+        _init_worker(*initargs)
+        for name, points, _, temps in pending:
+            result = compute_chunk(points, temps)
+            write_chunk(checkpoint_dir, name, result)
+            log(f"{name}: {len(points)} q-points in {result['time']:.1f} s")
+    elif pending:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(pending)),
+            # Do not fork the database connections of the AiiDA process
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as pool:
+            futures = {
+                pool.submit(compute_chunk, points, temps): (name, points)
+                for name, points, _, temps in pending
+            }
+            for future in as_completed(futures):
+                name, points = futures[future]
+                result = future.result()
+                write_chunk(checkpoint_dir, name, result)
+                log(f"{name}: {len(points)} q-points in {result['time']:.1f} s")
+
+    if comm:
+        comm.Barrier()
+        if rank != 0:
+            return None
+    return combine_chunks(checkpoint_dir, chunks, temperatures, settings["mesh"])
+
+
+def combine_chunks(checkpoint_dir, chunks, temperatures, mesh) -> dict:
+    """Add up the results of the chunks"""
+    sums, counts = {}, {}
+    chunk_times = []
+    for name, points, start, temps in chunks:
+        result = read_chunk(Path(checkpoint_dir), name)
+        if result is None:
+            raise RuntimeError(f"The result of {name} is missing in {checkpoint_dir}")
+        key = (start, len(temps))
+        sums[key] = sums.get(key, 0) + result["mode_kappa_sum"]
+        counts[key] = counts.get(key, 0) + result["num_sampling_grid_points"]
+        chunk_times.append(float(result["time"]))
+
+    nsigma = next(iter(sums.values())).shape[0]
+    kappa = np.zeros((nsigma, len(temperatures), 6))
+    for (start, length), total in sums.items():
+        kappa[:, start : start + length] = total / counts[(start, length)]
+    return {
+        "kappa": kappa,
+        "temperatures": np.asarray(temperatures, dtype=float),
+        "mesh": np.asarray(mesh, dtype=int),
+        "chunk_times": np.asarray(chunk_times),
+        "chunk_grid_points": np.array([len(points) for _, points, _, _ in chunks]),
+    }
+
+
+def format_chunk_timings(result: dict) -> str:
+    """Summary of the chunk times for sizing the mesh and the chunks"""
+    times = result["chunk_times"]
+    points = result["chunk_grid_points"]
+    per_point = times.sum() / max(points.sum(), 1)
+    return (
+        f"{len(times)} chunks, {times.sum():.1f} s in total, "
+        f"{times.min():.1f}/{np.median(times):.1f}/{times.max():.1f} s "
+        f"min/median/max per chunk, {per_point:.2f} s per q-point"
+    )
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.command()
+    @click.argument("params_path", type=click.Path(exists=True))
+    @click.option("--settings", "settings_file", type=click.Path(exists=True))
+    @click.option("--output", default="kappa.npz", help="Output file of the results")
+    @click.option("--checkpoint-dir", default=None, help="Directory of the chunks")
+    def main(params_path, settings_file=None, output="kappa.npz", checkpoint_dir=None):
+        """Compute the lattice thermal conductivity from PARAMS_PATH"""
+        settings = None
+        if settings_file:
+            with open(settings_file, encoding="utf-8") as handle:
+                settings = json.load(handle)
+        result = run_ltc(params_path, settings, checkpoint_dir)
+        if result is not None:
+            np.savez(output, **result)
+            print(format_chunk_timings(result))
+
+    main()  # pylint: disable=no-value-for-parameter
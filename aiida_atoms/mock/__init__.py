@@ -0,0 +1,6 @@
+"""
+Local stand-ins of the VASP workchains for testing and benchmarking the workflows.
+
+The mock workchains accept the same inputs as their aiida-vasp counterparts and compute
+the energy, forces and stress with a cheap ASE calculator instead of running VASP.
+"""
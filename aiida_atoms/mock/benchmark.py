@@ -0,0 +1,181 @@
+"""
+Benchmark harness running the elastic workflows with the mock VASP workchains
+
+The harness measures the end-to-end throughput of the workflows and the database and
+repository overhead, i.e. the number of nodes and bytes created per material, without
+running any VASP calculation.
+"""
+
+import os
+import tempfile
+import time
+import typing as t
+
+from aiida import orm
+from aiida.common import timezone
+from aiida.common.exceptions import NotExistent
+from aiida.engine import run_get_node, submit
+
+from .vasp import MockVaspElasticWorkChain
+
+MOCK_COMPUTER_LABEL = "localhost-mock"
+MOCK_CODE_LABEL = "mock-vasp"
+
+
+def get_mock_code():
+    """Return the placeholder VASP code of the mock workchains, created if needed"""
+    try:
+        return orm.load_code(f"{MOCK_CODE_LABEL}@{MOCK_COMPUTER_LABEL}")
+    except NotExistent:
+        pass
+    try:
+        computer = orm.load_computer(MOCK_COMPUTER_LABEL)
+    except NotExistent:
+        computer = orm.Computer(
+            label=MOCK_COMPUTER_LABEL,
+            hostname="localhost",
+            transport_type="core.local",
+            scheduler_type="core.direct",
+            workdir=os.path.join(tempfile.gettempdir(), "aiida_atoms_mock"),
+        ).store()
+        computer.configure()
+    return orm.InstalledCode(
+        computer=computer,
+        filepath_executable="/bin/true",
+        label=MOCK_CODE_LABEL,
+        default_calc_job_plugin="vasp.vasp",
+    ).store()
+
+
+def get_mock_relax_inputs(structure: orm.StructureData, code: orm.Code) -> dict:
+    """Inputs of a `VaspRelaxWorkChain` that are sufficient for the mock workchains"""
+    return {
+        "structure": structure,
+        "relax_settings": orm.Dict(
+            dict={
+                "positions": True,
+                "shape": True,
+                "volume": True,
+                "force_cutoff": 0.01,
+                "steps": 60,
+            }
+        ),
+        "vasp": {
+            "code": code,
+            "parameters": orm.Dict(dict={"incar": {"encut": 400, "ediff": 1e-6}}),
+            "options": orm.Dict(
+                dict={
+                    "resources": {"num_machines": 1, "tot_num_mpiprocs": 1},
+                    "max_wallclock_seconds": 3600,
+                }
+            ),
+            "potential_family": orm.Str("PBE.54"),
+            "potential_mapping": orm.Dict(dict={}),
+            "kpoints_spacing": orm.Float(0.05),
+        },
+    }
+
+
+def get_benchmark_structures(
+    elements: t.Sequence[str] = ("Cu", "Al", "Ni", "Ag", "Au", "Pd", "Pt"),
+    count: int = 7,
+    rattle: float = 0.01,
+) -> t.Dict[str, orm.StructureData]:
+    """Rattled cubic cells of EMT-supported metals"""
+    from ase.build import bulk
+
+    structures = {}
+    for i in range(count):
+        element = elements[i % len(elements)]
+        atoms = bulk(element, cubic=True)
+        atoms.rattle(stdev=rattle, seed=i)
+        structures[f"{element}_{i}"] = orm.StructureData(ase=atoms)
+    return structures
+
+
+def get_repository_size(node: orm.Node) -> int:
+    """Total size in bytes of the repository files of a node"""
+    size = 0
+    for dirpath, _, filenames in node.base.repository.walk():
+        for filename in filenames:
+            with node.base.repository.open(dirpath / filename, mode="rb") as handle:
+                handle.seek(0, os.SEEK_END)
+                size += handle.tell()
+    return size
+
+
+def get_created_nodes_statistics(since) -> dict:
+    """Count the nodes created since a time by type and the size of their repository files"""
+    query = orm.QueryBuilder()
+    query.append(orm.Node, filters={"ctime": {">=": since}}, project=["*"])
+    node_types = {}
+    repository_bytes = 0
+    for (node,) in query.iterall():
+        name = type(node).__name__
+        node_types[name] = node_types.get(name, 0) + 1
+        repository_bytes += get_repository_size(node)
+    return {
+        "nodes": sum(node_types.values()),
+        "node_types": node_types,
+        "repository_bytes": repository_bytes,
+    }
+
+
+def run_elastic_benchmark(
+    structures: t.Dict[str, orm.StructureData],
+    elastic_settings: t.Optional[dict] = None,
+    latency: float = 0.0,
+    use_daemon: bool = False,
+    poll_interval: float = 2.0,
+    workchain=MockVaspElasticWorkChain,
+) -> dict:
+    """
+    Run the mock elastic workchain for each structure and measure the cost.
+
+    :param structures: The structures keyed by their names.
+    :param elastic_settings: The `elastic_settings` input of the workchains.
+    :param latency: Seconds to wait in each mock calculation. With the daemon, the
+        workers must be started with the same ``AIIDA_ATOMS_MOCK_LATENCY``.
+    :param use_daemon: Submit the workchains to the daemon instead of running them one
+        after another in the current interpreter.
+
+    :returns: A dictionary with the wall time, the throughput in materials per hour and
+        the nodes and repository bytes created in total and per material.
+    """
+    os.environ["AIIDA_ATOMS_MOCK_LATENCY"] = str(latency)
+    code = get_mock_code()
+    since = timezone.now()
+    start = time.perf_counter()
+
+    nodes = []
+    for name, structure in structures.items():
+        inputs = {
+            "relax": get_mock_relax_inputs(structure, code),
+            "metadata": {"label": f"benchmark {name}"},
+        }
+        if elastic_settings:
+            inputs["elastic_settings"] = orm.Dict(dict=elastic_settings)
+        if use_daemon:
+            nodes.append(submit(workchain, **inputs))
+        else:
+            nodes.append(run_get_node(workchain, **inputs).node)
+
+    while use_daemon and not all(
+        orm.load_node(node.pk).is_terminated for node in nodes
+    ):
+        time.sleep(poll_interval)
+
+    wall_time = time.perf_counter() - start
+    statistics = get_created_nodes_statistics(since)
+    nmaterials = max(len(structures), 1)
+    return {
+        "materials": len(structures),
+        "finished_ok": sum(1 for node in nodes if orm.load_node(node.pk).is_finished_ok),
+        "wall_time": wall_time,
+        "materials_per_hour": len(structures) / wall_time * 3600,
+        "nodes": statistics["nodes"],
+        "nodes_per_material": statistics["nodes"] / nmaterials,
+        "node_types": statistics["node_types"],
+        "repository_bytes": statistics["repository_bytes"],
+        "repository_bytes_per_material": statistics["repository_bytes"] / nmaterials,
+    }
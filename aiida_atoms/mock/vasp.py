@@ -0,0 +1,301 @@
+"""
+Mock VASP workchains computing with an ASE calculator
+
+The results are returned in the same form as the outputs of aiida-vasp:
+
+    - ``misc`` with the ``stress`` in kBar using the VASP sign convention, the
+      ``total_energies`` and the ``maximum_force``/``maximum_stress``
+    - ``retrieved`` with a minimal ``vasprun.xml`` holding the energy, forces and stress
+    - ``relax.structure`` for the relaxation workchain
+
+The calculator and the artificial latency of each calculation are set with the optional
+``mock_settings`` input or with the ``AIIDA_ATOMS_MOCK_CALCULATOR`` and
+``AIIDA_ATOMS_MOCK_LATENCY`` environment variables, so that the workchains can be used
+as drop-in replacements inside other workflows. The latency is a ``sleep`` shell job on
+the localhost computer, which is waited for without blocking the daemon worker.
+"""
+
+import io
+import os
+from xml.sax.saxutils import escape
+
+from aiida_vasp.workchains.v2.relax import VaspRelaxWorkChain
+from aiida_vasp.workchains.v2.vasp import VaspWorkChain
+import numpy as np
+
+from aiida import orm
+from aiida.engine import ToContext, WorkChain, calcfunction, if_
+
+from ..workflows.elastic import VaspElasticWorkChain
+from ..workflows.elastic_batch import VaspElasticBatchWorkChain
+
+# eV/Å^3 to kBar
+EV_PER_ANGSTROM3_TO_KBAR = 1602.1766208
+
+DEFAULT_MOCK_SETTINGS = {
+    # emt, lj or auto (EMT if all elements are supported, LJ otherwise)
+    "calculator": "auto",
+    # Seconds to wait in each calculation
+    "latency": 0.0,
+}
+
+
+def get_mock_settings(inputs) -> dict:
+    """Resolve the mock settings from the inputs, the environment and the defaults"""
+    settings = dict(DEFAULT_MOCK_SETTINGS)
+    if "AIIDA_ATOMS_MOCK_CALCULATOR" in os.environ:
+        settings["calculator"] = os.environ["AIIDA_ATOMS_MOCK_CALCULATOR"]
+    if "AIIDA_ATOMS_MOCK_LATENCY" in os.environ:
+        settings["latency"] = float(os.environ["AIIDA_ATOMS_MOCK_LATENCY"])
+    if "mock_settings" in inputs:
+        settings.update(inputs.mock_settings.get_dict())
+    return settings
+
+
+def get_calculator(atoms, name="auto"):
+    """Return the ASE calculator for the atoms"""
+    from ase.calculators.emt import EMT, parameters
+    from ase.calculators.lj import LennardJones
+
+    if name == "auto":
+        name = "emt" if set(atoms.get_chemical_symbols()) <= set(parameters) else "lj"
+    if name == "emt":
+        return EMT()
+    if name == "lj":
+        # Place the minimum of the potential at the mean nearest neighbour distance
+        distances = atoms.get_all_distances(mic=True)
+        np.fill_diagonal(distances, np.inf)
+        nearest = float(distances.min(axis=1).mean()) if len(atoms) > 1 else 2.5
+        sigma = nearest / 2 ** (1 / 6)
+        return LennardJones(sigma=sigma, epsilon=0.1, rc=3 * sigma, smooth=True)
+    raise ValueError(f"Unknown mock calculator: {name}")
+
+
+def to_vasp_stress(atoms):
+    """Stress of the atoms in kBar with the VASP sign convention as a 3x3 matrix"""
+    return -atoms.get_stress(voigt=False) * EV_PER_ANGSTROM3_TO_KBAR
+
+
+def write_vasprun(atoms, energy, forces, stress):
+    """A minimal vasprun.xml with the structure, energy, forces and stress of a calculation"""
+
+    def varray(name, rows):
+        lines = [f' <varray name="{name}" >']
+        lines.extend(
+            "  <v>" + " ".join(f"{value:16.8f}" for value in row) + " </v>"
+            for row in rows
+        )
+        lines.append(" </varray>")
+        return lines
+
+    lines = ['<?xml version="1.0" encoding="ISO-8859-1"?>', "<modeling>"]
+    lines.append(' <atominfo><array name="atoms"><set>')
+    lines.extend(
+        f"  <rc><c>{escape(symbol)}</c><c>1</c></rc>"
+        for symbol in atoms.get_chemical_symbols()
+    )
+    lines.append(" </set></array></atominfo>")
+    lines.append("<calculation>")
+    lines.append(" <structure><crystal>")
+    lines.extend(varray("basis", atoms.cell[:]))
+    lines.append(" </crystal>")
+    lines.extend(varray("positions", atoms.get_scaled_positions()))
+    lines.append(" </structure>")
+    lines.extend(varray("forces", forces))
+    lines.extend(varray("stress", stress))
+    lines.append(" <energy>")
+    for name in ("e_fr_energy", "e_wo_entrp", "e_0_energy"):
+        lines.append(f'  <i name="{name}">{energy:16.8f} </i>')
+    lines.append(" </energy>")
+    lines.append("</calculation>")
+    lines.append("</modeling>")
+    return "\n".join(lines) + "\n"
+
+
+def get_outputs(atoms):
+    """Compute the outputs in the form of aiida-vasp"""
+    energy = float(atoms.get_potential_energy())
+    forces = atoms.get_forces()
+    stress = to_vasp_stress(atoms)
+
+    misc = orm.Dict(
+        dict={
+            "total_energies": {
+                "energy_extrapolated": energy,
+                "energy_free": energy,
+                "energy_no_entropy": energy,
+            },
+            "stress": stress.tolist(),
+            "maximum_force": float(np.linalg.norm(forces, axis=1).max()),
+            "maximum_stress": float(np.abs(stress).max()),
+            "run_status": {"finished": True, "electronic_converged": True},
+        }
+    )
+    retrieved = orm.FolderData()
+    retrieved.base.repository.put_object_from_filelike(
+        io.BytesIO(write_vasprun(atoms, energy, forces, stress).encode()),
+        "vasprun.xml",
+    )
+    forces_node = orm.ArrayData()
+    forces_node.set_array("final", forces)
+    return {"misc": misc, "retrieved": retrieved, "forces": forces_node}
+
+
+def submit_latency(process: WorkChain, latency: float):
+    """Submit a job sleeping for the latency on the localhost computer"""
+    from aiida_shell import ShellJob
+    from aiida_shell.launch import prepare_code
+
+    return process.submit(
+        ShellJob,
+        code=prepare_code("sleep"),
+        arguments=orm.List(list=[f"{latency:g}"]),
+        metadata={
+            "label": "mock latency",
+            "options": {"resources": {"num_machines": 1, "tot_num_mpiprocs": 1}},
+        },
+    )
+
+
+@calcfunction
+def mock_single_point(structure: orm.StructureData, mock_settings: orm.Dict):
+    """Single point calculation of a structure with an ASE calculator"""
+    atoms = structure.get_ase()
+    atoms.calc = get_calculator(atoms, mock_settings["calculator"])
+    return get_outputs(atoms)
+
+
+@calcfunction
+def mock_relaxation(
+    structure: orm.StructureData, relax_settings: orm.Dict, mock_settings: orm.Dict
+):
+    """
+    Relax a structure with an ASE calculator following the VASP relaxation settings
+
+    The positions, shape and volume settings select the degrees of freedom, the force
+    cutoff and the number of steps are used as the convergence criteria.
+    """
+    from ase.constraints import FixAtoms
+    from ase.optimize import BFGS
+
+    try:
+        from ase.filters import FrechetCellFilter as CellFilter
+    except ImportError:  # ASE < 3.23
+        from ase.constraints import ExpCellFilter as CellFilter
+
+    settings = relax_settings.get_dict()
+    atoms = structure.get_ase()
+    atoms.calc = get_calculator(atoms, mock_settings["calculator"])
+
+    if not settings.get("positions", True):
+        atoms.set_constraint(FixAtoms(mask=[True] * len(atoms)))
+    target = atoms
+    if settings.get("shape", True):
+        target = CellFilter(atoms)
+    elif settings.get("volume", True):
+        target = CellFilter(atoms, hydrostatic_strain=True)
+    optimizer = BFGS(target, logfile=None)
+    optimizer.run(
+        fmax=abs(settings.get("force_cutoff", 0.01)),
+        steps=settings.get("steps", 60),
+    )
+
+    atoms.set_constraint()
+    outputs = get_outputs(atoms)
+    outputs["structure"] = orm.StructureData(ase=atoms)
+    return outputs
+
+
+class MockLatencyMixin:
+    """Steps waiting for the artificial latency of the mock workchains"""
+
+    def has_latency(self):
+        """Whether to wait for an artificial latency"""
+        self.ctx.settings = get_mock_settings(self.inputs)
+        return self.ctx.settings["latency"] > 0
+
+    def wait(self):
+        """Wait for the artificial latency"""
+        return ToContext(latency=submit_latency(self, self.ctx.settings["latency"]))
+
+
+class MockVaspWorkChain(MockLatencyMixin, WorkChain):
+    """
+    Stand-in of the `VaspWorkChain` computing with an ASE calculator.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(VaspWorkChain)
+        spec.input(
+            "mock_settings",
+            valid_type=orm.Dict,
+            required=False,
+            help="Settings of the mock calculation: calculator and latency",
+        )
+        spec.output("misc", valid_type=orm.Dict)
+        spec.output("retrieved", valid_type=orm.FolderData)
+        spec.output("forces", valid_type=orm.ArrayData, required=False)
+        spec.outline(if_(cls.has_latency)(cls.wait), cls.run_calculation)
+
+    def run_calculation(self):
+        """
+        Run the calculation
+        """
+        outputs = mock_single_point(
+            self.inputs.structure, orm.Dict(dict=self.ctx.settings)
+        )
+        for key, value in outputs.items():
+            self.out(key, value)
+
+
+class MockVaspRelaxWorkChain(MockLatencyMixin, WorkChain):
+    """
+    Stand-in of the `VaspRelaxWorkChain` relaxing with an ASE calculator.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(VaspRelaxWorkChain)
+        spec.input(
+            "mock_settings",
+            valid_type=orm.Dict,
+            required=False,
+            help="Settings of the mock calculation: calculator and latency",
+        )
+        spec.output("relax.structure", valid_type=orm.StructureData)
+        spec.output("misc", valid_type=orm.Dict)
+        spec.output("retrieved", valid_type=orm.FolderData)
+        spec.output("forces", valid_type=orm.ArrayData, required=False)
+        spec.outline(if_(cls.has_latency)(cls.wait), cls.run_relaxation)
+
+    def run_relaxation(self):
+        """
+        Run the relaxation
+        """
+        outputs = mock_relaxation(
+            self.inputs.structure,
+            self.inputs.relax_settings,
+            orm.Dict(dict=self.ctx.settings),
+        )
+        self.out("relax.structure", outputs["structure"])
+        for key in ("misc", "retrieved", "forces"):
+            self.out(key, outputs[key])
+
+
+class MockVaspElasticWorkChain(VaspElasticWorkChain):
+    """
+    The `VaspElasticWorkChain` running the mock relaxations.
+    """
+
+    _base_workchain = MockVaspRelaxWorkChain
+
+
+class MockVaspElasticBatchWorkChain(VaspElasticBatchWorkChain):
+    """
+    The `VaspElasticBatchWorkChain` running the mock relaxations.
+    """
+
+    _base_workchain = MockVaspRelaxWorkChain
@@ -0,0 +1,408 @@
+"""
+Profile finished workflow runs
+
+The process tree of a run (e.g. a ``run_phono3py_rs_zb`` WorkGraph or a
+`VaspElasticWorkChain`) is collected with one query per level of the call tree and one
+query per chunk of processes for their outputs. The wall time of each process is split
+into:
+
+    - ``upload``: from the creation of a CalcJob until its remote folder is created
+    - ``queue``: waiting in the scheduler queue
+    - ``run``: running on the cluster
+    - ``retrieve``: from the end of the job until the retrieved folder is created,
+      which also includes the scheduler polling interval
+    - ``parse``: from the retrieval until the last output is created
+    - ``self``: the time a workflow spends outside of the processes it calls, i.e. its
+      own bookkeeping and the time waiting for the daemon
+
+The end of a process is the creation of its last output or the end of the last process
+it called, since the modification time also changes when extras are set later on. Only
+processes without any of them fall back to the modification time.
+
+The queue and run times come from the last job information reported by the scheduler.
+If the scheduler did not report them, the time between the upload and the retrieval is
+reported as ``scheduler``.
+
+The report also counts the nodes created by each process and the bytes of their
+repository files (None if the repository cannot report the sizes without reading the
+objects), and can be exported as JSON or in the folded stack format read by
+flame graph tools (e.g. ``flamegraph.pl`` or speedscope).
+"""
+
+import json
+import re
+import typing as t
+
+from aiida import orm
+from aiida.common.links import LinkType
+
+# Number of ids in each ``in`` filter, below the variable limit of older SQLite versions
+QUERY_CHUNK_SIZE = 500
+
+TIME_CATEGORIES = ("upload", "queue", "run", "retrieve", "parse", "scheduler", "self")
+
+
+def chunked(values: t.Sequence, size: int = QUERY_CHUNK_SIZE):
+    """Split a sequence into chunks"""
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+def get_stage_name(link_label: str) -> str:
+    """The stage of a process, which is the link label without the numeric suffix"""
+    return re.sub(r"[_\-]?\d+$", "", link_label or "") or "CALL"
+
+
+def get_union_length(intervals: t.Iterable[t.Tuple[float, float]]) -> float:
+    """Total length covered by a set of intervals"""
+    total = 0.0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def get_repository_keys(metadata: t.Optional[dict]) -> t.List[str]:
+    """Hash keys of all files in the repository metadata of a node"""
+    keys = []
+    stack = [metadata or {}]
+    while stack:
+        entry = stack.pop()
+        if "k" in entry:
+            keys.append(entry["k"])
+        stack.extend(entry.get("o", {}).values())
+    return keys
+
+
+def get_object_sizes(keys: t.Iterable[str]) -> t.Optional[t.Dict[str, int]]:
+    """
+    Sizes of the objects in the repository of the current profile.
+
+    The sizes are read from the metadata of the disk-objectstore container behind the
+    repository, which is not part of the public API of aiida-core.
+
+    :returns: The sizes keyed by the hash keys, or None if the repository has no such
+        container, rather than reading all objects.
+    """
+    from aiida.manage import get_manager
+
+    keys = list(set(keys))
+    repository = get_manager().get_profile_storage().get_repository()
+    container = getattr(repository, "_container", None)
+    if not hasattr(container, "get_objects_stream_and_meta"):
+        return None
+    sizes = {}
+    with container.get_objects_stream_and_meta(keys, skip_if_missing=True) as items:
+        for key, _, meta in items:
+            sizes[key] = meta["size"]
+    return sizes
+
+
+def _record(node_id, parent, link_label, values):
+    """Assemble the record of a process from the projected values"""
+    node_type, process_label, ctime, mtime, state, exit_status, job_info, repo = values
+    return {
+        "pk": node_id,
+        "parent": parent,
+        "link_label": link_label,
+        "stage": get_stage_name(link_label),
+        "process_label": process_label,
+        "is_calcjob": node_type.startswith("process.calculation.calcjob"),
+        "is_workflow": node_type.startswith("process.workflow"),
+        "ctime": ctime,
+        "mtime": mtime,
+        "process_state": state,
+        "exit_status": exit_status,
+        "last_job_info": job_info,
+        "repository_keys": get_repository_keys(repo),
+        "children": [],
+    }
+
+
+_PROCESS_PROJECTIONS = [
+    "node_type",
+    "attributes.process_label",
+    "ctime",
+    "mtime",
+    "attributes.process_state",
+    "attributes.exit_status",
+    "attributes.last_job_info",
+    "repository_metadata",
+]
+
+
+def collect_process_tree(root: t.Union[int, orm.ProcessNode]) -> t.Dict[int, dict]:
+    """
+    Collect the records of all processes called by a process, with one query per level.
+
+    :returns: The records keyed by the pk, the root has no parent.
+    """
+    root_pk = root if isinstance(root, int) else root.pk
+    query = orm.QueryBuilder()
+    query.append(
+        orm.ProcessNode, filters={"id": root_pk}, project=["id"] + _PROCESS_PROJECTIONS
+    )
+    (node_id, *values) = query.one()
+    records = {node_id: _record(node_id, None, "ROOT", values)}
+
+    frontier = [node_id]
+    while frontier:
+        children = []
+        for chunk in chunked(frontier):
+            query = orm.QueryBuilder()
+            query.append(
+                orm.ProcessNode, filters={"id": {"in": chunk}}, project=["id"], tag="caller"
+            )
+            query.append(
+                orm.ProcessNode,
+                with_incoming="caller",
+                edge_filters={
+                    "type": {
+                        "in": [LinkType.CALL_CALC.value, LinkType.CALL_WORK.value]
+                    }
+                },
+                edge_tag="call",
+                edge_project=["label"],
+                project=["id"] + _PROCESS_PROJECTIONS,
+                tag="child",
+            )
+            # The edge projections come after those of the nodes, so use the tags
+            for row in query.iterdict():
+                parent = row["caller"]["id"]
+                values = [row["child"][key] for key in _PROCESS_PROJECTIONS]
+                child = row["child"]["id"]
+                records[child] = _record(child, parent, row["call"]["label"], values)
+                records[parent]["children"].append(child)
+                children.append(child)
+        frontier = children
+    return records
+
+
+def collect_outputs(records: t.Dict[int, dict]):
+    """Add the nodes created by each process to the records"""
+    for record in records.values():
+        record["outputs"] = []
+    for chunk in chunked(list(records)):
+        query = orm.QueryBuilder()
+        query.append(
+            orm.ProcessNode, filters={"id": {"in": chunk}}, project=["id"], tag="process"
+        )
+        query.append(
+            orm.Node,
+            with_incoming="process",
+            edge_filters={"type": LinkType.CREATE.value},
+            edge_tag="create",
+            edge_project=["label"],
+            project=["node_type", "ctime", "repository_metadata"],
+            tag="output",
+        )
+        for row in query.iterdict():
+            output = row["output"]
+            records[row["process"]["id"]]["outputs"].append(
+                {
+                    "link_label": row["create"]["label"],
+                    "node_type": output["node_type"],
+                    "ctime": output["ctime"],
+                    "repository_keys": get_repository_keys(output["repository_metadata"]),
+                }
+            )
+
+
+def set_end_times(records: t.Dict[int, dict]):
+    """Set the end of each process from its outputs and the processes it called"""
+    # The records of the callers come before those of the processes they call
+    for record in reversed(list(records.values())):
+        ends = [output["ctime"] for output in record["outputs"]]
+        ends += [records[child]["end"] for child in record["children"]]
+        record["end"] = max(ends) if ends else record["mtime"]
+
+
+def _get_job_times(job_info: t.Optional[dict]):
+    """Queue and run time in seconds from the last job information of a CalcJob"""
+    if not job_info:
+        return None, None
+    from aiida.schedulers.datastructures import JobInfo
+
+    info = JobInfo.load_from_dict(job_info)
+    submission = getattr(info, "submission_time", None)
+    dispatch = getattr(info, "dispatch_time", None)
+    finish = getattr(info, "finish_time", None)
+    queue = None
+    if submission is not None and dispatch is not None:
+        queue = max((dispatch - submission).total_seconds(), 0.0)
+    run = getattr(info, "wallclock_time_seconds", None)
+    if run is None and dispatch is not None and finish is not None:
+        run = max((finish - dispatch).total_seconds(), 0.0)
+    return queue, run
+
+
+def get_time_breakdown(record: dict, records: t.Dict[int, dict]) -> t.Dict[str, float]:
+    """Split the wall time of a process into the time categories"""
+    start, end = record["ctime"], record["end"]
+    outputs = {output["link_label"]: output for output in record["outputs"]}
+    total = (end - start).total_seconds()
+
+    if record["is_workflow"]:
+        intervals = [
+            (
+                (records[child]["ctime"] - start).total_seconds(),
+                (records[child]["end"] - start).total_seconds(),
+            )
+            for child in record["children"]
+        ]
+        return {"self": max(total - get_union_length(intervals), 0.0)}
+
+    if not record["is_calcjob"] or "retrieved" not in outputs:
+        return {"run": total}
+
+    uploaded = outputs["remote_folder"]["ctime"] if "remote_folder" in outputs else start
+    retrieved = outputs["retrieved"]["ctime"]
+    breakdown = {
+        "upload": (uploaded - start).total_seconds(),
+        "parse": max((end - retrieved).total_seconds(), 0.0),
+    }
+    scheduler = (retrieved - uploaded).total_seconds()
+    queue, run = _get_job_times(record["last_job_info"])
+    if run is None:
+        breakdown["scheduler"] = scheduler
+    else:
+        queue = min(queue or 0.0, scheduler)
+        run = min(run, scheduler - queue)
+        breakdown.update(queue=queue, run=run, retrieve=scheduler - queue - run)
+    return breakdown
+
+
+def profile_process(root: t.Union[int, orm.ProcessNode]) -> dict:
+    """
+    Profile a finished process and all processes it called.
+
+    :returns: A dictionary with the ``processes`` (one entry per process with its
+        duration, time breakdown and created nodes and repository bytes) and the
+        ``stages`` (the same data summed over the top level stages of the run).
+    """
+    records = collect_process_tree(root)
+    collect_outputs(records)
+    set_end_times(records)
+    keys = [key for record in records.values() for key in record["repository_keys"]]
+    keys += [
+        key
+        for record in records.values()
+        for output in record["outputs"]
+        for key in output["repository_keys"]
+    ]
+    sizes = get_object_sizes(keys)
+
+    root_pk = next(pk for pk, record in records.items() if record["parent"] is None)
+    processes = []
+    stages = {}
+    for pk, record in records.items():
+        # The stage of a process is that of its ancestor called by the root
+        ancestor = record
+        while ancestor["parent"] not in (None, root_pk):
+            ancestor = records[ancestor["parent"]]
+        stage = ancestor["stage"]
+        breakdown = get_time_breakdown(record, records)
+        process_keys = record["repository_keys"] + [
+            key for output in record["outputs"] for key in output["repository_keys"]
+        ]
+        entry = {
+            "pk": pk,
+            "parent": record["parent"],
+            "stage": stage,
+            "link_label": record["link_label"],
+            "process_label": record["process_label"],
+            "process_state": record["process_state"],
+            "exit_status": record["exit_status"],
+            "duration": (record["end"] - record["ctime"]).total_seconds(),
+            "times": breakdown,
+            "nodes": 1 + len(record["outputs"]),
+            "repository_bytes": None
+            if sizes is None
+            else sum(sizes.get(key, 0) for key in process_keys),
+        }
+        processes.append(entry)
+
+        summary = stages.setdefault(
+            stage, {"processes": 0, "nodes": 0, "repository_bytes": 0, "times": {}}
+        )
+        summary["processes"] += 1
+        summary["nodes"] += entry["nodes"]
+        if sizes is None:
+            summary["repository_bytes"] = None
+        else:
+            summary["repository_bytes"] += entry["repository_bytes"]
+        for category, seconds in breakdown.items():
+            summary["times"][category] = summary["times"].get(category, 0.0) + seconds
+
+    root_record = records[root_pk]
+    return {
+        "root": root_pk,
+        "process_label": root_record["process_label"],
+        "wall_time": (root_record["end"] - root_record["ctime"]).total_seconds(),
+        "processes": processes,
+        "stages": stages,
+    }
+
+
+def to_folded_stacks(report: dict, scale: float = 1000.0) -> str:
+    """
+    Convert a report to the folded stack format, one ``frame;frame;... value`` per line.
+
+    Each process contributes a frame, and each of its time categories a leaf frame
+    with the time in milliseconds (by default) as the value.
+    """
+    entries = {entry["pk"]: entry for entry in report["processes"]}
+
+    def get_frame(entry):
+        label = entry["process_label"] or "process"
+        if entry["parent"] is None:
+            return f"{label}<{entry['pk']}>"
+        return f"{entry['link_label']}:{label}"
+
+    lines = []
+    for entry in report["processes"]:
+        frames = []
+        current = entry
+        while current is not None:
+            frames.append(get_frame(current))
+            current = entries.get(current["parent"])
+        stack = ";".join(reversed(frames))
+        for category in TIME_CATEGORIES:
+            value = int(round(entry["times"].get(category, 0.0) * scale))
+            if value > 0:
+                lines.append(f"{stack};{category} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def format_report(report: dict) -> str:
+    """Human readable table of the stages of a report"""
+    header = f"{'stage':<24} {'procs':>6} {'nodes':>7} {'MB':>9} " + " ".join(
+        f"{category:>10}" for category in TIME_CATEGORIES
+    )
+    lines = [
+        f"{report['process_label']}<{report['root']}> "
+        f"wall time {report['wall_time']:.1f} s",
+        header,
+    ]
+    for stage, summary in sorted(report["stages"].items()):
+        times = " ".join(
+            f"{summary['times'].get(category, 0.0):10.1f}" for category in TIME_CATEGORIES
+        )
+        size = summary["repository_bytes"]
+        size = "n/a" if size is None else f"{size / 1e6:.2f}"
+        lines.append(
+            f"{stage:<24} {summary['processes']:>6} {summary['nodes']:>7} "
+            f"{size:>9} {times}"
+        )
+    return "\n".join(lines)
+
+
+def write_report(report: dict, path: str):
+    """Write a report as JSON"""
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(report, handle, indent=2, default=str)
@@ -0,0 +1,431 @@
+"""
+Plan the resources of VASP calculations from the size of the problem
+
+The cost of a calculation is modelled as ``nkpts * nelect**2 * natoms`` units per ionic
+step, where ``nkpts`` is the number of irreducible k-points and ``nelect`` the number of
+valence electrons (the ZVAL of the POTCARs). The number of core seconds per unit depends
+on the cluster and is kept in a `ClusterProfile`, which can be calibrated from the
+finished calculations in the database with `calibrate_profile`. The calibration counts
+the k-points and electrons of the calculations in the same way as the planning, and is
+saved in the metadata of the computer.
+
+From the estimated core seconds, `plan_resources` picks the number of MPI processes to
+finish within the target time of the cluster, the ``kpar`` and ``ncore`` of VASP and the
+wallclock limit with a safety margin. `apply_resource_plan` writes a plan into the
+inputs of a `VaspWorkChain` or `VaspRelaxWorkChain`.
+"""
+
+from dataclasses import dataclass, replace
+import math
+import re
+import typing as t
+
+import numpy as np
+
+from aiida import orm
+from aiida.common.exceptions import NotExistent
+
+NOBLE_GAS_NUMBERS = (0, 2, 10, 18, 36, 54, 86)
+
+# Ionic steps assumed for a relaxation
+DEFAULT_RELAX_STEPS = 20
+
+
+@dataclass(frozen=True)
+class ClusterProfile:
+    """Hardware and cost parameters of a cluster"""
+
+    name: str
+    cores_per_node: int
+    max_nodes: int = 1
+    min_mpiprocs: int = 1
+    # Cores of each MPI process, e.g. for OpenMP or GPU runs
+    num_cores_per_mpiproc: int = 1
+    # Fixed number of MPI processes per node, e.g. one per GPU
+    max_mpiprocs_per_node: t.Optional[int] = None
+    gpu: bool = False
+    # Core seconds per unit of the cost model, see `calibrate_profile`
+    seconds_per_unit: float = 2e-7
+    # Aim to finish each calculation within this time
+    target_seconds: float = 4 * 3600
+    min_wallclock_seconds: int = 1800
+    max_wallclock_seconds: int = 48 * 3600
+    # Wallclock limit relative to the estimated time
+    wallclock_margin: float = 3.0
+    # Fewest MPI processes per k-point group for KPAR
+    min_mpiprocs_per_kgroup: int = 4
+
+    @property
+    def mpiprocs_per_node(self) -> int:
+        """Number of MPI processes that fit on a node"""
+        per_node = self.cores_per_node // self.num_cores_per_mpiproc
+        if self.max_mpiprocs_per_node:
+            per_node = min(per_node, self.max_mpiprocs_per_node)
+        return max(per_node, 1)
+
+
+CLUSTER_PROFILES = {
+    "catapult": ClusterProfile("catapult", cores_per_node=64, max_nodes=4),
+    "catapult-srun": ClusterProfile(
+        "catapult-srun",
+        cores_per_node=16,
+        num_cores_per_mpiproc=8,
+        max_mpiprocs_per_node=2,
+        gpu=True,
+        seconds_per_unit=2e-8,
+    ),
+    "sugon-tai": ClusterProfile("sugon-tai", cores_per_node=32, max_nodes=4),
+}
+
+# Computer property with the calibrated core seconds per unit
+CALIBRATION_PROPERTY = "aiida_atoms_seconds_per_unit"
+
+
+def get_cluster_profile(computer: t.Union[orm.Computer, str]) -> ClusterProfile:
+    """
+    The profile of a computer, with the calibration saved on the computer if any.
+
+    Computers without a profile get one from their default number of MPI processes per
+    machine.
+    """
+    label = computer if isinstance(computer, str) else computer.label
+    if isinstance(computer, str):
+        try:
+            computer = orm.load_computer(label)
+        except NotExistent:
+            computer = None
+    if label in CLUSTER_PROFILES:
+        profile = CLUSTER_PROFILES[label]
+    elif computer is not None:
+        profile = ClusterProfile(
+            label, cores_per_node=computer.get_default_mpiprocs_per_machine() or 1
+        )
+    else:
+        raise ValueError(f"No profile or computer with the label {label}")
+    if computer is not None:
+        seconds_per_unit = computer.get_property(CALIBRATION_PROPERTY, None)
+        if seconds_per_unit is not None:
+            profile = replace(profile, seconds_per_unit=float(seconds_per_unit))
+    return profile
+
+
+def get_valence_electrons(symbol: str) -> int:
+    """Approximate number of valence electrons, those outside the noble gas core"""
+    from ase.data import atomic_numbers
+
+    number = atomic_numbers[symbol]
+    return number - max(core for core in NOBLE_GAS_NUMBERS if core < number)
+
+
+def read_zval(potcar) -> float:
+    """The ZVAL of a POTCAR"""
+    content = potcar.get_content()
+    content = content.decode() if isinstance(content, bytes) else content
+    return float(re.search(r"ZVAL\s*=\s*([\d.]+)", content).group(1))
+
+
+def get_potcar_valences(elements, potential_family, potential_mapping) -> dict:
+    """The ZVAL of the POTCARs of the elements"""
+    from aiida_vasp.data.potcar import PotcarData
+
+    potcars = PotcarData.get_potcars_dict(
+        elements=list(elements),
+        family_name=getattr(potential_family, "value", potential_family),
+        mapping=(
+            potential_mapping.get_dict()
+            if hasattr(potential_mapping, "get_dict")
+            else potential_mapping
+        ),
+    )
+    return {element: read_zval(potcar) for element, potcar in potcars.items()}
+
+
+def count_electrons(structure: orm.StructureData, valences: t.Optional[dict] = None):
+    """Number of valence electrons of a structure"""
+    kinds = {kind.name: kind.symbol for kind in structure.kinds}
+    valences = valences or {}
+    return sum(
+        valences.get(symbol, get_valence_electrons(symbol))
+        for symbol in (kinds[site.kind_name] for site in structure.sites)
+    )
+
+
+def count_kpoints(
+    structure: orm.StructureData,
+    kpoints: t.Optional[orm.KpointsData] = None,
+    spacing: t.Optional[float] = None,
+) -> int:
+    """Number of irreducible k-points of an explicit list, a mesh or a spacing"""
+    if kpoints is not None:
+        try:
+            mesh, _ = kpoints.get_kpoints_mesh()
+        except AttributeError:
+            return len(kpoints.get_kpoints())
+    elif spacing is not None:
+        reciprocal = 2 * np.pi * np.linalg.inv(np.array(structure.cell)).T
+        mesh = [
+            max(1, math.ceil(np.linalg.norm(vector) / spacing)) for vector in reciprocal
+        ]
+    else:
+        return 1
+    try:
+        import spglib
+
+        atoms = structure.get_ase()
+        mapping, _ = spglib.get_ir_reciprocal_mesh(
+            mesh, (atoms.cell[:], atoms.get_scaled_positions(), atoms.numbers)
+        )
+        return len(np.unique(mapping))
+    except ImportError:
+        # Time reversal symmetry only
+        return math.ceil(int(np.prod(mesh)) / 2)
+
+
+def get_cost_units(natoms: int, nelect: float, nkpts: int, steps: int = 1) -> float:
+    """Units of the cost model"""
+    return float(nkpts) * float(nelect) ** 2 * natoms * steps
+
+
+def _divisors(number: int) -> t.List[int]:
+    """The divisors of a number in increasing order"""
+    return [i for i in range(1, number + 1) if number % i == 0]
+
+
+def plan_resources(
+    natoms: int,
+    nelect: float,
+    nkpts: int,
+    profile: ClusterProfile,
+    steps: int = 1,
+) -> dict:
+    """
+    Plan the resources of a calculation.
+
+    :returns: A dictionary with the scheduler ``resources``, the
+        ``max_wallclock_seconds``, the ``ncore`` and ``kpar`` of VASP, the
+        ``estimated_seconds`` and whether the calculation ``fits`` within the maximum
+        wallclock time of the cluster.
+    """
+    units = get_cost_units(natoms, nelect, nkpts, steps)
+    core_seconds = profile.seconds_per_unit * units
+    per_node = profile.mpiprocs_per_node
+    max_mpiprocs = per_node * profile.max_nodes
+    cores_per_proc = profile.num_cores_per_mpiproc
+    wanted = math.ceil(core_seconds / cores_per_proc / profile.target_seconds)
+    mpiprocs = max(min(wanted, max_mpiprocs), profile.min_mpiprocs, 1)
+    if mpiprocs > per_node:
+        # Use whole nodes
+        mpiprocs = math.ceil(mpiprocs / per_node) * per_node
+    num_machines = math.ceil(mpiprocs / per_node)
+
+    # Split the k-points into as many groups as possible with enough processes each
+    kpar = max(
+        divisor
+        for divisor in _divisors(mpiprocs)
+        if divisor <= nkpts
+        and (divisor == 1 or mpiprocs // divisor >= profile.min_mpiprocs_per_kgroup)
+    )
+    if profile.gpu:
+        ncore = 1
+    else:
+        group = mpiprocs // kpar
+        ncore = min(_divisors(group), key=lambda d: abs(d - math.sqrt(group)))
+
+    estimated = core_seconds / (mpiprocs * cores_per_proc)
+    wallclock = profile.wallclock_margin * estimated
+    wallclock = min(
+        max(wallclock, profile.min_wallclock_seconds), profile.max_wallclock_seconds
+    )
+    resources = {"num_machines": num_machines, "tot_num_mpiprocs": mpiprocs}
+    if cores_per_proc > 1:
+        resources["num_cores_per_mpiproc"] = cores_per_proc
+    return {
+        "resources": resources,
+        # Round up to 10 minutes
+        "max_wallclock_seconds": int(math.ceil(wallclock / 600) * 600),
+        "ncore": ncore,
+        "kpar": kpar,
+        "estimated_seconds": estimated,
+        "fits": estimated <= profile.max_wallclock_seconds,
+    }
+
+
+def _get_value(node):
+    """The python value of a node"""
+    if hasattr(node, "get_dict"):
+        return node.get_dict()
+    return getattr(node, "value", node)
+
+
+def plan_vasp_inputs(
+    inputs: dict,
+    structure: t.Optional[orm.StructureData] = None,
+    steps: int = 1,
+    profile: t.Optional[ClusterProfile] = None,
+) -> dict:
+    """
+    Plan the resources of the inputs of a `VaspWorkChain` or a `VaspRelaxWorkChain`.
+
+    :param structure: The structure, that of the inputs by default.
+    :param profile: The cluster profile, that of the computer of the code by default.
+    """
+    vasp = inputs["vasp"] if "vasp" in inputs else inputs
+    structure = structure if structure is not None else inputs["structure"]
+    profile = profile or get_cluster_profile(vasp["code"].computer)
+    try:
+        valences = get_potcar_valences(
+            structure.get_symbols_set(),
+            vasp["potential_family"],
+            vasp.get("potential_mapping", {}),
+        )
+    except Exception:  # pylint: disable=broad-except
+        valences = None
+    spacing = vasp.get("kpoints_spacing", None)
+    nkpts = count_kpoints(
+        structure,
+        kpoints=vasp.get("kpoints", None),
+        spacing=None if spacing is None else _get_value(spacing),
+    )
+    nelect = count_electrons(structure, valences)
+    return plan_resources(len(structure.sites), nelect, nkpts, profile, steps)
+
+
+def apply_resource_plan(inputs: dict, plan: dict) -> dict:
+    """
+    Return a copy of the inputs with the resources, wallclock, NCORE and KPAR of a plan.
+
+    The inputs of a `VaspRelaxWorkChain` are updated in their ``vasp`` namespace. Only
+    the new `Dict` nodes are created, the other inputs are shared.
+    """
+    inputs = type(inputs)(inputs)
+    nested = "vasp" in inputs
+    vasp = type(inputs["vasp"])(inputs["vasp"]) if nested else inputs
+
+    options = dict(_get_value(vasp["options"]))
+    options["resources"] = dict(plan["resources"])
+    options["max_wallclock_seconds"] = plan["max_wallclock_seconds"]
+    vasp["options"] = orm.Dict(dict=options)
+
+    parameters = dict(_get_value(vasp["parameters"]))
+    incar = dict(parameters.get("incar", {}))
+    incar.update(ncore=plan["ncore"], kpar=plan["kpar"])
+    # NPAR takes precedence over NCORE in VASP
+    incar.pop("npar", None)
+    parameters["incar"] = incar
+    vasp["parameters"] = orm.Dict(dict=parameters)
+
+    if nested:
+        inputs["vasp"] = vasp
+    return inputs
+
+
+def get_calculation_valences(calc: orm.CalcJobNode, cache: dict) -> t.Optional[dict]:
+    """
+    The ZVAL of the POTCARs used by a calculation, keyed by the element.
+
+    :param cache: The ZVAL of the POTCAR nodes read so far, keyed by their pk.
+    """
+    valences = {}
+    try:
+        for link in calc.base.links.get_incoming(
+            link_label_filter="potential__%"
+        ).all():
+            potcar = link.node
+            if potcar.pk not in cache:
+                cache[potcar.pk] = read_zval(potcar)
+            valences[potcar.element] = cache[potcar.pk]
+    except Exception:  # pylint: disable=broad-except
+        return None
+    return valences or None
+
+
+def _get_job_record(
+    calc: orm.CalcJobNode,
+    structure: orm.StructureData,
+    kpoints: orm.KpointsData,
+    run_status: t.Optional[dict],
+    valences: t.Optional[dict] = None,
+) -> t.Optional[dict]:
+    """
+    Cost units and core seconds of a finished calculation.
+
+    The electrons and k-points are counted as in `plan_vasp_inputs`.
+    """
+    job_info = calc.base.attributes.get("last_job_info", None)
+    if not job_info or not job_info.get("wallclock_time_seconds"):
+        return None
+    resources = calc.base.attributes.get("resources", None) or {}
+    mpiprocs = resources.get("tot_num_mpiprocs") or resources.get(
+        "num_machines", 1
+    ) * resources.get("num_mpiprocs_per_machine", 1)
+    cores = mpiprocs * resources.get("num_cores_per_mpiproc", 1)
+    nelect = count_electrons(structure, valences)
+    nkpts = count_kpoints(structure, kpoints=kpoints)
+    steps = 1
+    if run_status and run_status.get("last_iteration_index"):
+        steps = max(run_status["last_iteration_index"][0], 1)
+    return {
+        "units": get_cost_units(len(structure.sites), nelect, nkpts, steps),
+        "core_seconds": job_info["wallclock_time_seconds"] * cores,
+    }
+
+
+def calibrate_profile(
+    profile: ClusterProfile, limit: int = 500, min_samples: int = 5
+) -> ClusterProfile:
+    """
+    Calibrate the core seconds per unit from the finished VASP calculations.
+
+    The wallclock time reported by the scheduler and the resources of the most recent
+    calculations on the computer of the profile are fitted to the cost model, with the
+    median ratio to be robust against outliers. The calibration is saved in the
+    metadata of the computer and used by `get_cluster_profile` from then on.
+
+    :param limit: Maximum number of calculations used.
+    :param min_samples: The profile is returned unchanged with fewer calculations.
+    """
+    query = orm.QueryBuilder()
+    query.append(orm.Computer, filters={"label": profile.name}, tag="computer")
+    query.append(
+        orm.CalcJobNode,
+        with_computer="computer",
+        filters={
+            "process_type": {"like": "aiida.calculations:vasp.%"},
+            "attributes.exit_status": 0,
+        },
+        project=["*"],
+        tag="calc",
+    )
+    query.append(
+        orm.StructureData,
+        with_outgoing="calc",
+        edge_filters={"label": "structure"},
+        project=["*"],
+    )
+    query.append(
+        orm.KpointsData,
+        with_outgoing="calc",
+        edge_filters={"label": "kpoints"},
+        project=["*"],
+    )
+    query.append(
+        orm.Dict,
+        with_incoming="calc",
+        edge_filters={"label": "misc"},
+        project=["attributes.run_status"],
+    )
+    query.order_by({"calc": {"ctime": "desc"}}).limit(limit)
+
+    ratios = []
+    zvals = {}
+    # Load all rows first, the POTCARs are queried for each calculation
+    for calc, structure, kpoints, run_status in query.all():
+        valences = get_calculation_valences(calc, zvals)
+        record = _get_job_record(calc, structure, kpoints, run_status, valences)
+        if record is not None and record["units"] > 0:
+            ratios.append(record["core_seconds"] / record["units"])
+    if len(ratios) < min_samples:
+        return profile
+    seconds_per_unit = float(np.median(ratios))
+    orm.load_computer(profile.name).set_property(CALIBRATION_PROPERTY, seconds_per_unit)
+    return replace(profile, seconds_per_unit=seconds_per_unit)
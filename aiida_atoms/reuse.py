@@ -0,0 +1,185 @@
+"""
+Find finished relaxations that can be reused instead of running them again
+"""
+
+from typing import Iterable, Mapping, Union
+
+import numpy as np
+
+from aiida import orm
+from aiida.common.exceptions import NotExistent
+from aiida.common.hashing import make_hash
+
+RELAX_PROCESS_LABEL = "VaspRelaxWorkChain"
+
+# Settings that only affect the labelling of the calculation
+_IGNORED_RELAX_SETTINGS = ("label",)
+
+# INCAR tags that only affect the parallelisation, which may be planned per computer
+_IGNORED_INCAR_TAGS = ("ncore", "npar", "kpar", "nsim")
+
+# Inputs of a `VaspWorkChain` that change its results besides the parameters
+_COMPARED_VASP_INPUTS = (
+    "code",
+    "kpoints",
+    "kpoints_spacing",
+    "potential_family",
+    "potential_mapping",
+    "ldau_mapping",
+    "magmom_mapping",
+)
+
+
+def get_structure_hash(structure: orm.StructureData):
+    """Return the hash of a structure, which also works for unstored nodes"""
+    if structure.is_stored:
+        structure_hash = structure.base.extras.get("_aiida_hash", None)
+        if structure_hash is not None:
+            return structure_hash
+    caching = structure.base.caching
+    # Since aiida-core 2.6 `get_hash` only returns the hash stored with the node and
+    # `compute_hash` refuses unstored nodes, so hash the same objects as when storing
+    if hasattr(caching, "get_objects_to_hash"):
+        return make_hash(caching.get_objects_to_hash())
+    return caching.get_hash()
+
+
+def _clean_relax_settings(relax_settings: dict):
+    """Remove the settings that do not change the results of a relaxation"""
+    return {
+        key: value
+        for key, value in relax_settings.items()
+        if key not in _IGNORED_RELAX_SETTINGS
+    }
+
+
+def clean_parameters(parameters: dict):
+    """Remove the INCAR tags that do not change the results of a calculation"""
+    incar = {
+        key: value
+        for key, value in parameters.get("incar", {}).items()
+        if key.lower() not in _IGNORED_INCAR_TAGS
+    }
+    return {**parameters, "incar": incar}
+
+
+def _get_input_value(value):
+    """Return a JSON serialisable value of an input node that can be compared"""
+    if isinstance(value, orm.AbstractCode):
+        return value.uuid
+    if isinstance(value, orm.KpointsData):
+        try:
+            mesh, offset = value.get_kpoints_mesh()
+        except AttributeError:
+            points, weights = value.get_kpoints(also_weights=True, cartesian=False)
+            return {
+                "kpoints": np.round(points, 8).tolist(),
+                "weights": np.round(weights, 8).tolist(),
+            }
+        return {
+            "mesh": [int(number) for number in mesh],
+            "offset": [float(number) for number in (offset or (0, 0, 0))],
+        }
+    if isinstance(value, orm.Dict):
+        return value.get_dict()
+    return getattr(value, "value", value)
+
+
+def get_vasp_inputs_key(vasp_inputs: Mapping):
+    """
+    Return the inputs of a `VaspWorkChain` that change the results of a calculation.
+
+    The parameters are cleaned of the parallelisation tags, the other inputs (see
+    `_COMPARED_VASP_INPUTS`) are converted to JSON serialisable values, the codes are
+    identified by their UUID.
+    """
+    parameters = _get_input_value(vasp_inputs["parameters"])
+    key = {"parameters": clean_parameters(parameters)}
+    for name in _COMPARED_VASP_INPUTS:
+        key[name] = _get_input_value(vasp_inputs.get(name, None))
+    return key
+
+
+def is_equivalent_relaxation(
+    node: orm.WorkChainNode, vasp_inputs: Mapping, relax_settings: dict
+):
+    """
+    Check if a relaxation has been run with equivalent VASP inputs and relax settings.
+
+    The VASP inputs are compared with `get_vasp_inputs_key`.
+    """
+    try:
+        node_key = get_vasp_inputs_key(node.inputs.vasp)
+        node_relax_settings = node.inputs.relax_settings.get_dict()
+    except (AttributeError, KeyError, NotExistent):
+        return False
+    return node_key == get_vasp_inputs_key(vasp_inputs) and _clean_relax_settings(
+        node_relax_settings
+    ) == _clean_relax_settings(relax_settings)
+
+
+def find_finished_relaxation(
+    structure: orm.StructureData,
+    vasp_inputs: Mapping,
+    relax_settings: Union[orm.Dict, dict],
+    candidates: Union[Iterable[orm.WorkChainNode], None] = None,
+):
+    """
+    Find a finished `VaspRelaxWorkChain` with equivalent inputs.
+
+    Relaxations are equivalent if their input structures have the same hash and they
+    were run with the same VASP inputs (parameters, k-points, potentials and code) and
+    relaxation settings, apart from the label and the parallelisation tags.
+
+    :param structure: The structure to be relaxed.
+    :param vasp_inputs: The inputs of the `vasp` namespace of the relaxation.
+    :param relax_settings: The relaxation settings.
+    :param candidates: Only consider these workchains, e.g. those called by an earlier run.
+        The whole database is searched if not given.
+
+    :returns: The most recent equivalent relaxation that finished successfully or None.
+    """
+    if isinstance(relax_settings, orm.Dict):
+        relax_settings = relax_settings.get_dict()
+    structure_hash = get_structure_hash(structure)
+
+    if candidates is None:
+        query = orm.QueryBuilder()
+        query.append(
+            orm.StructureData,
+            filters={"extras._aiida_hash": structure_hash},
+            tag="structure",
+        )
+        query.append(
+            orm.WorkChainNode,
+            with_incoming="structure",
+            edge_filters={"label": "structure"},
+            filters={
+                "attributes.process_label": RELAX_PROCESS_LABEL,
+                "attributes.exit_status": 0,
+            },
+            project="*",
+        )
+        candidates = query.all(flat=True)
+    else:
+        candidates = [
+            node
+            for node in candidates
+            if node.is_finished_ok
+            and "structure" in node.inputs
+            and get_structure_hash(node.inputs.structure) == structure_hash
+        ]
+
+    for node in sorted(candidates, key=lambda node: node.ctime, reverse=True):
+        if is_equivalent_relaxation(node, vasp_inputs, relax_settings):
+            return node
+    return None
+
+
+def get_called_relaxations(process: orm.ProcessNode):
+    """Return the `VaspRelaxWorkChain` nodes called by a process and its descendants"""
+    return [
+        node
+        for node in process.called_descendants
+        if node.process_label == RELAX_PROCESS_LABEL
+    ]
@@ -1,20 +1,57 @@
 """
 Track changes of an atom
+
+With ``asynchronous=True`` the operations are applied to the atoms immediately and their
+provenance records are queued to the `ProvenanceWriter` of the tracker, shared with the
+trackers derived from it. Its thread writes the records in the order of the operations,
+batching the queued records in one transaction. They are the calculation and structure
+nodes of the calcfunctions, created without the engine. `flush` and leaving the ``with``
+block of a tracker wait for the records to be written, the ``node`` of a tracker waits
+for its own record. An error raised while writing is raised by the next operation or
+`flush`. The records not written yet are discarded when the ``with`` block raises.
 """
 
-from functools import wraps
-from typing import Union
+from copy import deepcopy
+from functools import lru_cache, wraps
+import queue
+import threading
+from typing import Optional, Union
 import warnings
 
 from ase import Atoms
-from ase.build import make_supercell
-from ase.build import sort as ase_sort
 import numpy as np
-from packaging import version
 
 from aiida import __version__ as AIIDA_VERSION
 from aiida import orm
-from aiida.engine import calcfunction
+
+
+def calcfunction(function):
+    """Lazy wrapper of `aiida.engine.calcfunction`, the engine is imported on first use"""
+    from aiida.engine import calcfunction as _calcfunction
+
+    return _calcfunction(function)
+
+
+@lru_cache(maxsize=None)
+def _needs_dynamic_namespace():
+    """Whether the dummy signature is needed to get a dynamic namespace"""
+    from packaging import version
+
+    return version.parse(AIIDA_VERSION) >= version.parse("2.3.0")
+
+
+def sort(atoms, tags=None):
+    """Sort the atoms, see `ase.build.sort`"""
+    from ase.build import sort as ase_sort
+
+    return ase_sort(atoms, tags=tags)
+
+
+def make_supercell(prim, P, **kwargs):  # pylint: disable=invalid-name
+    """Make a supercell, see `ase.build.make_supercell`"""
+    from ase.build import make_supercell as ase_make_supercell
+
+    return ase_make_supercell(prim, P, **kwargs)
 
 
 def dummy_function(*args, **kwargs):
@@ -27,33 +64,291 @@ def dummy_function(*args, **kwargs):
     _ = kwargs
 
 
+class ProvenanceError(RuntimeError):
+    """Recording the queued provenance failed"""
+
+
+class PendingRecord:
+    """A queued provenance record, holding its result once written"""
+
+    __slots__ = ("function", "args", "result", "error", "_written")
+
+    def __init__(self, function, args):
+        """Instantiate"""
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self._written = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        """Whether the record has been written, or has failed"""
+        return self._written.is_set()
+
+    def set_result(self, result=None, error=None):
+        """Set the result of the record, or the error that prevented writing it"""
+        self.result = result
+        self.error = error
+        self._written.set()
+
+    def wait(self, timeout=None) -> bool:
+        """Wait until the record is written, return whether it has been"""
+        return self._written.wait(timeout)
+
+    def get(self):
+        """The result of the written record"""
+        if not self.done:
+            raise ProvenanceError("The record has not been written yet")
+        if self.error is not None:
+            raise ProvenanceError(
+                f"Recording the provenance failed: {self.error!r}"
+            ) from self.error
+        return self.result
+
+
+class ProvenanceWriter:
+    """
+    Write the provenance records of tracked operations in a background thread.
+
+    A worker thread writes the records in the order they are submitted, taking the
+    records queued so far, up to `batch_size`, and writing them in one transaction.
+    The thread is started by `submit` and stops once the queue is empty. The arguments
+    of a record may be earlier records, which are replaced by their results when the
+    record is written.
+
+    The functions of the records run in the worker thread, so they must not be given
+    ORM objects of other threads: they are given plain values and the PKs of stored
+    nodes, and return the PK of the node they store.
+
+    An error fails the records of its transaction and those depending on them, and is
+    raised as a `ProvenanceError` by the next `submit` or `flush`.
+    """
+
+    def __init__(self, batch_size: int = 100):
+        """
+        Instantiate
+
+        :param batch_size: Largest number of records written in one transaction.
+        """
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+
+    def submit(self, function, *args) -> PendingRecord:
+        """Queue a call of the function and return its record"""
+        self._raise_error()
+        record = PendingRecord(function, args)
+        with self._lock:
+            self._queue.put(record)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="provenance-writer", daemon=True
+                )
+                self._thread.start()
+        return record
+
+    def flush(self):
+        """Wait until all submitted records are written, raising the first error"""
+        self._queue.join()
+        self._raise_error()
+
+    def discard(self):
+        """Drop the queued records that are not being written yet"""
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            record.set_result(error=ProvenanceError("The record was discarded"))
+            self._queue.task_done()
+
+    def _raise_error(self):
+        """Raise the first error of the records written since the last call"""
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise ProvenanceError(
+                f"Recording the provenance failed: {error!r}"
+            ) from error
+
+    def _take_batch(self):
+        """Take the queued records up to the batch size, or stop if there are none"""
+        batch = []
+        with self._lock:
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                self._thread = None
+        return batch
+
+    def _run(self):
+        """Write the queued records in batches until the queue is empty"""
+        from aiida.manage import get_manager
+
+        storage = get_manager().get_profile_storage()
+        try:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return
+                try:
+                    self._write(storage, batch)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            # Release the connection of the session of this thread
+            if hasattr(storage, "get_session"):
+                storage.get_session().close()
+
+    def _write(self, storage, batch):
+        """Write a batch of records in one transaction"""
+        # Records whose inputs have failed are not written
+        failed = [
+            record
+            for record in batch
+            if any(
+                isinstance(arg, PendingRecord) and arg.error is not None
+                for arg in record.args
+            )
+        ]
+        for record in failed:
+            record.set_result(error=ProvenanceError("An input record has failed"))
+        batch = [record for record in batch if record not in failed]
+
+        results = {}
+
+        def resolve(arg):
+            if not isinstance(arg, PendingRecord):
+                return arg
+            if id(arg) in results:
+                return results[id(arg)]
+            return arg.get()
+
+        try:
+            with storage.transaction():
+                for record in batch:
+                    args = [resolve(arg) for arg in record.args]
+                    results[id(record)] = record.function(*args)
+        except Exception as exc:  # pylint: disable=broad-except
+            with self._lock:
+                # Keep the first error, later ones are usually caused by it
+                if self._error is None:
+                    self._error = exc
+            for record in batch:
+                record.set_result(error=exc)
+        else:
+            for record in batch:
+                record.set_result(results[id(record)])
+
+
+def record_transformation(func, node, new_atoms, args, kwargs, track=True):
+    """Create the node of the transformed atoms, linked to the input node if tracking"""
+    aiida_kwargs = {key: to_aiida_rep(value) for key, value in kwargs.items()}
+    for i, arg in enumerate(args):
+        aiida_kwargs[f"arg_{i:02d}"] = to_aiida_rep(arg)
+
+    # Create a dummy connection between the input the output using @calcfunction
+    @wraps(func)
+    def _transform(node, **dummy_args):  # pylint:disable=unused-argument
+        return orm.StructureData(ase=new_atoms)
+
+    if _needs_dynamic_namespace():
+        _transform.__wrapped__ = dummy_function
+
+    if track:
+        return calcfunction(_transform)(node, **aiida_kwargs)
+    return _transform(node, **aiida_kwargs)
+
+
+def get_thread_user() -> orm.User:
+    """
+    The default user, loaded in the thread of a `ProvenanceWriter`
+
+    The cached default user belongs to the session of the main thread, the nodes
+    stored by the writer are given this one instead.
+    """
+    return orm.User.collection.get(id=orm.User.collection.get_default().pk)
+
+
+def store_copy(node: orm.Node) -> int:
+    """Store a copy of an unstored node given to a `ProvenanceWriter`, return its PK"""
+    node.user = get_thread_user()
+    return node.store().pk
+
+
+def write_transformation(func, parent: int, new_atoms, args, kwargs) -> int:
+    """
+    Store the node of the transformed atoms and the calculation linking it to its parent
+
+    The nodes and links are those of the calcfunction of `record_transformation`, but
+    they are created without the engine, which cannot run in the thread of a
+    `ProvenanceWriter`.
+
+    :param parent: The PK of the input node.
+
+    :returns: The PK of the new node.
+    """
+    from aiida.common.links import LinkType
+    from aiida.engine import ProcessState
+
+    inputs = {"node": orm.load_node(parent)}
+    for key, value in kwargs.items():
+        inputs[key] = to_aiida_rep(value)
+    for i, arg in enumerate(args):
+        inputs[f"arg_{i:02d}"] = to_aiida_rep(arg)
+
+    user = get_thread_user()
+    calc = orm.CalcFunctionNode(user=user)
+    calc.set_process_label(func.__name__)
+    calc.set_process_state(ProcessState.FINISHED)
+    calc.set_exit_status(0)
+    for label, node in inputs.items():
+        if not node.is_stored:
+            node.user = user
+            node.store()
+        calc.base.links.add_incoming(node, LinkType.INPUT_CALC, label)
+    calc.store()
+    structure = orm.StructureData(ase=new_atoms, user=user)
+    structure.base.links.add_incoming(calc, LinkType.CREATE, "result")
+    structure.store()
+    calc.seal()
+    return structure.pk
+
+
 def wraps_ase_out_of_place(func):
     """Wraps an ASE out of place operation"""
 
     @wraps(func)
     def inner(tracker, *args, **kwargs):
         """Inner function wrapped"""
-        atoms = tracker.node.get_ase()
-        aiida_kwargs = {key: to_aiida_rep(value) for key, value in kwargs.items()}
-        for i, arg in enumerate(args):
-            aiida_kwargs[f"arg_{i:02d}"] = to_aiida_rep(arg)
+        if tracker.asynchronous:
+            parent = tracker.get_pending_input()
+            record_args, record_kwargs = deepcopy(args), deepcopy(kwargs)
+            new_atoms = func(tracker.atoms.copy(), *args, **kwargs)
+            record = tracker.writer.submit(
+                write_transformation,
+                func,
+                parent,
+                new_atoms.copy(),
+                record_args,
+                record_kwargs,
+            )
+            return AtomsTracker(
+                obj=record, atoms=new_atoms, asynchronous=True, writer=tracker.writer
+            )
 
-        # Create a dummy connection between the input the output using @calcfunction
+        atoms = tracker.node.get_ase()
         new_atoms = func(atoms, *args, **kwargs)
-
-        @wraps(func)
-        def _transform(node, **dummy_args):  # pylint:disable=unused-argument
-            return orm.StructureData(ase=new_atoms)
-
-        if version.parse(AIIDA_VERSION) >= version.parse("2.3.0"):
-            _transform.__wrapped__ = dummy_function
-
-        transform = calcfunction(_transform)
-
-        if tracker.track_provenance:
-            node = transform(tracker.node, **aiida_kwargs)
-        else:
-            node = _transform(tracker.node, **aiida_kwargs)
+        node = record_transformation(
+            func, tracker.node, new_atoms, args, kwargs, tracker.track_provenance
+        )
 
         return AtomsTracker(obj=node, atoms=new_atoms)
 
@@ -70,6 +365,20 @@ def wraps_ase_inplace(func):
     def inner(tracker, *args, **kwargs):
         """Inner function wrapped"""
         atoms = tracker.atoms
+        if tracker.asynchronous:
+            parent = tracker.get_pending_input()
+            record_args, record_kwargs = deepcopy(args), deepcopy(kwargs)
+            retobj = func(atoms, *args, **kwargs)
+            tracker.pending_node = tracker.writer.submit(
+                write_transformation,
+                func,
+                parent,
+                atoms.copy(),
+                record_args,
+                record_kwargs,
+            )
+            return retobj
+
         aiida_kwargs = {key: to_aiida_rep(value) for key, value in kwargs.items()}
         for i, arg in enumerate(args):
             aiida_kwargs[f"arg_{i:02d}"] = to_aiida_rep(arg)
@@ -82,7 +391,7 @@ def wraps_ase_inplace(func):
             retobj.append(func(atoms, *args, **kwargs))
             return orm.StructureData(ase=atoms)
 
-        if version.parse(AIIDA_VERSION) >= version.parse("2.3.0"):
+        if _needs_dynamic_namespace():
             _transform.__wrapped__ = dummy_function
 
         transform = calcfunction(_transform)
@@ -137,9 +446,26 @@ class AtomsTracker:  # pylint: disable=too-few-public-methods
         obj,
         atoms: Union[Atoms, None] = None,
         track=True,
+        asynchronous=False,
+        writer: Optional[ProvenanceWriter] = None,
     ):
-        """Instantiate"""
-        if isinstance(obj, Atoms):
+        """
+        Instantiate
+
+        :param obj: An `ase.Atoms`, a `StructureData`, another tracker or the queued
+            record of a node.
+        :param track: Record the operations with calcfunctions.
+        :param asynchronous: Write the provenance of the tracked operations in a
+            background thread, see the module docstring.
+        :param writer: The writer of the asynchronous provenance, shared with the
+            trackers derived from this one. A new one by default.
+        """
+        self._pending = None
+        if isinstance(obj, PendingRecord):
+            self._node = None
+            self._pending = obj
+            self.atoms = atoms
+        elif isinstance(obj, Atoms):
             self.atoms = obj
             self.node = orm.StructureData(ase=obj)
         elif isinstance(obj, AtomsTracker):
@@ -150,13 +476,79 @@ class AtomsTracker:  # pylint: disable=too-few-public-methods
             self.atoms = self.node.get_ase() if atoms is None else atoms
 
         self.track_provenance = track
+        # Untracked operations have no provenance to write
+        self.asynchronous = asynchronous and track
+        self.writer = None
+        if self.asynchronous:
+            self.writer = writer if writer is not None else ProvenanceWriter()
 
     def __repr__(self) -> str:
         """Python representation"""
-        string = f"AtomsTracker({self.atoms.__repr__()}, {self.node.__repr__()})"
+        node = "<pending>" if self._pending is not None else self._node.__repr__()
+        string = f"AtomsTracker({self.atoms.__repr__()}, {node})"
         return string
 
-    sort = wraps_ase_out_of_place(ase_sort)
+    def __enter__(self):
+        """Enter a block whose provenance is written when leaving it"""
+        return self
+
+    def __exit__(self, *exc_info):
+        """
+        Wait for the provenance of the operations in the block to be written
+
+        The records not written yet are discarded if the block raised an error.
+        """
+        if self.writer is None:
+            return
+        if exc_info[0] is None:
+            self.flush()
+        else:
+            self.writer.discard()
+
+    @property
+    def node(self):
+        """The underlying node, waiting for its record if it is not written yet"""
+        if self._pending is not None:
+            self._pending.wait()
+            self._node = orm.load_node(self._pending.get())
+            self._pending = None
+        return self._node
+
+    @node.setter
+    def node(self, value):
+        """Set the underlying node"""
+        self._node = value
+        self._pending = None
+
+    @property
+    def pending_node(self):
+        """The node, or its record if it is not written yet"""
+        return self._pending if self._pending is not None else self._node
+
+    @pending_node.setter
+    def pending_node(self, value):
+        """Set the record of the node"""
+        self._pending = value
+
+    def get_pending_input(self):
+        """
+        The record or the PK of the node, as the input of a queued record
+
+        An unstored node is stored by the writer as a copy, which becomes the node.
+        """
+        if self._pending is not None:
+            return self._pending
+        if not self._node.is_stored:
+            self._pending = self.writer.submit(store_copy, self._node.clone())
+            return self._pending
+        return self._node.pk
+
+    def flush(self):
+        """Wait for the provenance of all queued operations to be written"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    sort = wraps_ase_out_of_place(sort)
     make_supercell = wraps_ase_out_of_place(make_supercell)
 
     @property
@@ -198,6 +590,18 @@ class AtomsTracker:  # pylint: disable=too-few-public-methods
         """Store the underlying node"""
         self.node.store(*args, **kwargs)
 
+    def store_fingerprint(self, **kwargs):
+        """Compute the fingerprint of the structure and save it in the extras of the node"""
+        from .fingerprint import store_fingerprint
+
+        return store_fingerprint(self.node, **kwargs)
+
+    def find_equivalent(self, **kwargs):
+        """Find the stored structures equivalent to the current atoms"""
+        from .fingerprint import find_equivalent_structures
+
+        return find_equivalent_structures(self.atoms, **kwargs)
+
 
 def _populate_methods():
     """Populate the methods for the `AtomsTracker` class"""
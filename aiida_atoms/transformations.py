@@ -2,17 +2,17 @@
 Common transformations using ase.Atoms object
 """
 
-from ase.build import sort as ase_sort
-from ase.build.supercells import make_supercell as ase_supercell
 import numpy as np
 
 from aiida import orm
-from aiida.engine import calcfunction
 
+__all__ = ("make_supercell",)
 
-@calcfunction
-def make_supercell(structure, supercell: list, **kwargs):
+
+def _make_supercell(structure, supercell: list, **kwargs):
     """Make supercell structure, keep the tags in order"""
+    from ase.build import sort as ase_sort
+    from ase.build.supercells import make_supercell as ase_supercell
 
     tags = kwargs.get("tags", None)
 
@@ -37,3 +37,16 @@ def make_supercell(structure, supercell: list, **kwargs):
     if tags:
         return {"structure": out, "tags": orm.List(list=stags)}
     return {"structure": out}
+
+
+def __getattr__(name):
+    """Create the calcfunctions on first access so that the engine is imported lazily"""
+    if name == "make_supercell":
+        from aiida.engine import calcfunction
+
+        # Keep the process label of the eagerly decorated function
+        _make_supercell.__name__ = _make_supercell.__qualname__ = name
+        function = calcfunction(_make_supercell)
+        globals()[name] = function
+        return function
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
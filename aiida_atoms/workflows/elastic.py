@@ -12,17 +12,16 @@ import ase
 
 # from ase.units import GPa
 import numpy as np
-from pymatgen.analysis.elasticity import (
-    DeformedStructureSet,
-    ElasticTensor,
-    Strain,
-    Stress,
-)
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-import spglib
 
 from aiida import orm
-from aiida.engine import ToContext, WorkChain, calcfunction
+from aiida.common import AttributeDict
+from aiida.engine import ToContext, WorkChain, calcfunction, while_
+
+from ..arrays import read_array
+from ..fingerprint import store_fingerprint
+from ..resources import DEFAULT_RELAX_STEPS, apply_resource_plan, plan_vasp_inputs
+from ..reuse import find_finished_relaxation, get_called_relaxations
+
 
 
 class VaspElasticWorkChain(WorkChain):
@@ -42,11 +41,30 @@ class VaspElasticWorkChain(WorkChain):
             "elastic_settings",
             valid_type=orm.Dict,
             required=False,
-            help="Settings of elastic tensor calculation, valid options: use_symmetry, symprec",
+            help=(
+                "Settings of elastic tensor calculation, valid options: use_symmetry, symprec, "
+                "primitive_type, normal_strains, shear_strains, max_concurrent, fit_tolerance, "
+                "compact_storage, reuse_relaxations, auto_resources"
+            ),
+        )
+        spec.input(
+            "restart_from",
+            valid_type=orm.Str,
+            required=False,
+            help=(
+                "UUID of an earlier elastic workchain, whose finished relaxations with equivalent "
+                "inputs are reused instead of being submitted again"
+            ),
         )
         # 基于VaspRelaxWorkChain的设置输入
         spec.expose_inputs(VaspRelaxWorkChain, "relax")
         spec.output("elastic_tensor", valid_type=orm.ArrayData)
+        spec.output(
+            "fit_history",
+            valid_type=orm.ArrayData,
+            required=False,
+            help="Elastic tensors, fit residuals and changes of the incremental fits when `fit_tolerance` is set",
+        )
         spec.output(
             "relaxed_structure",
             valid_type=orm.StructureData,
@@ -63,7 +81,11 @@ class VaspElasticWorkChain(WorkChain):
             cls.setup,
             cls.full_relax,
             cls.standardize,
-            cls.run_relax_multi,
+            cls.generate_deformations,
+            while_(cls.should_run_relax_multi)(
+                cls.run_relax_multi,
+                cls.inspect_relax_multi,
+            ),
             cls.compose_elastic_tensor,
         )
         spec.exit_code(
@@ -84,16 +106,15 @@ class VaspElasticWorkChain(WorkChain):
 
         self.ctx.relax_inputs = self.exposed_inputs(VaspRelaxWorkChain, "relax")
 
-        pdict = self.ctx.relax_inputs.vasp.parameters.get_dict()
         self.ctx.elastic_settings = (
             {}
             if "elastic_settings" not in self.inputs
             else self.inputs.elastic_settings
         )
-        pdict["incar"].pop("ibrion", None)
-        pdict["incar"].pop("isif", None)
-        pdict["incar"].pop("nsw", None)
-        if pdict != self.ctx.relax_inputs.vasp.parameters.get_dict():
+        pdict, modified = sanitize_relax_parameters(
+            self.ctx.relax_inputs.vasp.parameters
+        )
+        if modified:
             self.logger.warn(
                 """
                              The VASP parameters have been modified to remove `ibrion`,isif`,
@@ -103,16 +124,58 @@ class VaspElasticWorkChain(WorkChain):
             )
             self.ctx.relax_inputs.vasp.parameters = orm.Dict(dict=pdict)
 
-        self.ctx.deformed_structures = []
-        self.ctx.deformed_strains = []
-        self.ctx.workchains = {}
+        self._plan_resources(self.ctx.relax_inputs.structure)
+
+        self.ctx.num_deformations = 0
+        self.ctx.pending_deformations = []
+
+        if "restart_from" in self.inputs:
+            previous = orm.load_node(self.inputs.restart_from.value)
+            self.ctx.restart_candidates = get_called_relaxations(previous)
+            self.report(
+                f"Reusing up to {len(self.ctx.restart_candidates)} relaxations from {previous}"
+            )
+        elif self.ctx.elastic_settings.get("reuse_relaxations", False):
+            # Search the whole database for equivalent relaxations
+            self.ctx.restart_candidates = None
+
+    def _plan_resources(self, structure):
+        """Plan the resources of the relaxations of a structure if enabled"""
+        if not self.ctx.elastic_settings.get("auto_resources", False):
+            return
+        plan = plan_vasp_inputs(
+            self.ctx.relax_inputs, structure=structure, steps=DEFAULT_RELAX_STEPS
+        )
+        self.ctx.relax_inputs = apply_resource_plan(self.ctx.relax_inputs, plan)
+        self.report(
+            f"Planned {plan['resources']} and {plan['max_wallclock_seconds']} s "
+            f"with NCORE={plan['ncore']} KPAR={plan['kpar']} for {structure.get_formula()}"
+        )
+
+    def _find_reusable_relaxation(self, structure, relax_settings):
+        """Return a finished relaxation with equivalent inputs if reuse is enabled"""
+        if "restart_candidates" not in self.ctx:
+            return None
+        return find_finished_relaxation(
+            structure,
+            self.ctx.relax_inputs.vasp,
+            relax_settings,
+            candidates=self.ctx.restart_candidates,
+        )
 
     def full_relax(self):
         """
         Run a full relaxation of the input structure
         """
-        self.report("Running full relaxation")
         relax_inputs = self.ctx.relax_inputs
+        reused = self._find_reusable_relaxation(
+            relax_inputs.structure, relax_inputs.relax_settings
+        )
+        if reused is not None:
+            self.report(f"Reusing the full relaxation {reused}")
+            self.ctx.full_relax = reused
+            return None
+        self.report("Running full relaxation")
         # relax_inputs.structure = self.inputs.structure
         # self.base_workchain的计算参数和输入结构由外部导入
         running = self.submit(self._base_workchain, **relax_inputs)
@@ -126,99 +189,304 @@ class VaspElasticWorkChain(WorkChain):
         self.report("Standardizing the structure")
         relaxed_structure = self.ctx.full_relax.outputs.relax.structure
         self.out("relaxed_structure", relaxed_structure)
+        # Index the relaxed structure for finding equivalent structures later, with
+        # the same space group tolerance as all other fingerprints
+        store_fingerprint(relaxed_structure)
         primitive_type = self.ctx.elastic_settings.get("primitive_type", "conventional")
         if primitive_type == "conventional":
-            # Use pymatgen's SpacegroupAnalyzer to get the conventional standard structure
             self.report(
                 "Using pymatgen SpacegroupAnalyzer to standardize the structure"
             )
-            conventional_structure = SpacegroupAnalyzer(
-                relaxed_structure.get_pymatgen()
-            ).get_conventional_standard_structure()
-            self.ctx.reference_structure = orm.StructureData(
-                pymatgen=conventional_structure
-            )
-        elif primitive_type == "primitive":
-            atoms = relaxed_structure.get_ase()
-            # standardize the structure using spglib
-            # Use spglib to standardize the structure
-            prim_atoms_data = spglib.find_primitive(
-                (atoms.cell, atoms.get_scaled_positions(), atoms.numbers),
-                symprec=self.ctx.elastic_settings.get("symprec", 1e-3),
+        self.ctx.reference_structure = standardize_structure(
+            relaxed_structure,
+            primitive_type=primitive_type,
+            symprec=self.ctx.elastic_settings.get("symprec", 1e-3),
+        )
+        self.out("primitive_structure", self.ctx.reference_structure)
+        # The deformed structures share the plan of the reference structure
+        self._plan_resources(self.ctx.reference_structure)
+
+    def generate_deformations(self):
+        """
+        Generate the deformed structures and queue them for relaxation
+        """
+        deformed = deform_structure(
+            self.ctx.reference_structure, self.ctx.elastic_settings
+        )
+        self.ctx.deformations = deformed["deformation_strains"]  # 为orm.array数据类型
+        if "deformed_structures" in deformed:
+            # The structures are only materialized when their relaxations are submitted
+            self.ctx.deformed_trajectory = deformed["deformed_structures"]
+        else:
+            self.ctx.deformed_structures = {
+                int(key.split("_")[-1]): value
+                for key, value in deformed.items()
+                if key.startswith("structure_")
+            }
+        self.ctx.num_deformations = len(
+            read_array(self.ctx.deformations, "deformation_strains")
+        )
+        self.ctx.pending_deformations = list(range(self.ctx.num_deformations))
+        self.ctx.deformed_relax_settings = get_deformed_relax_settings(
+            self.ctx.relax_inputs.relax_settings
+        )
+        if "restart_candidates" in self.ctx:
+            self._reuse_deformed_relaxations()
+        self.ctx.fit_history = []
+        if self.ctx.elastic_settings.get("fit_tolerance", None) is not None:
+            # Relax the smallest strain magnitudes first so the tensor can be fitted
+            # after each level and the larger ones skipped once it has converged
+            levels = get_strain_levels(
+                read_array(self.ctx.deformations, "deformation_strains")
             )
-            primitive_lat, primitive_pos, primitive_numbers = prim_atoms_data
-            primitive_atoms = ase.Atoms(
-                cell=primitive_lat,
-                scaled_positions=primitive_pos,
-                numbers=primitive_numbers,
-                pbc=True,
+            self.ctx.strain_levels = {
+                idx: int(level) for idx, level in enumerate(levels)
+            }
+            self.ctx.pending_deformations.sort(
+                key=lambda idx: (self.ctx.strain_levels[idx], idx)
             )
-            self.ctx.reference_structure = orm.StructureData(ase=primitive_atoms)
-        else:
-            raise ValueError(
-                f"Unknown primitive type: {primitive_type}. "
-                f'Supported types are "conventional" and "primitive".'
+
+    def _reuse_deformed_relaxations(self):
+        """Reuse finished deformed structure relaxations, only the missing ones are run"""
+        pending = []
+        for idx in self.ctx.pending_deformations:
+            key = f"structure_{idx}"
+            relax_settings = self.ctx.deformed_relax_settings.copy()
+            relax_settings["label"] = f"relax_deformed_{key}"
+            reused = self._find_reusable_relaxation(
+                self._get_deformed_structure(idx, store=False), relax_settings
             )
-        self.out("primitive_structure", self.ctx.reference_structure)
+            if reused is None:
+                pending.append(idx)
+            else:
+                self.ctx["workchain_deformed_" + key] = reused
+        self.report(
+            f"Reusing {self.ctx.num_deformations - len(pending)} deformed relaxations, "
+            f"{len(pending)} remaining to be submitted"
+        )
+        self.ctx.pending_deformations = pending
+
+    def should_run_relax_multi(self):
+        """
+        Whether there are deformed structures left to be relaxed
+        """
+        return bool(self.ctx.pending_deformations)
 
     def run_relax_multi(self):
         """
         Run multiple relaxation calculations for the deformed structures
+
+        At most ``max_concurrent`` relaxations are submitted at once, the remaining ones
+        are submitted in the following waves once the current ones have finished.
         """
-        deformed = generate_deformed_structures(
-            self.ctx.reference_structure,
-            normal_strains=orm.List(
-                self.ctx.elastic_settings.get("normal_strains", None)
-            ),
-            shear_strains=orm.List(
-                self.ctx.elastic_settings.get("shear_strains", None)
-            ),
-            symmetry=self.ctx.elastic_settings.get("use_symmetry", True),
-        )
+        max_concurrent = self.ctx.elastic_settings.get("max_concurrent", None)
+        pending = self.ctx.pending_deformations
+        if "strain_levels" in self.ctx:
+            # Do not mix strain levels within a wave in the adaptive mode
+            level = self.ctx.strain_levels[pending[0]]
+            nlevel = sum(1 for idx in pending if self.ctx.strain_levels[idx] == level)
+            max_concurrent = min(max_concurrent or nlevel, nlevel)
+        if max_concurrent:
+            wave, self.ctx.pending_deformations = (
+                pending[:max_concurrent],
+                pending[max_concurrent:],
+            )
+        else:
+            wave, self.ctx.pending_deformations = pending, []
+
         launched_calculations = {}
-        inputs = self.ctx.relax_inputs
-        base_relax_settings = inputs.relax_settings.get_dict()
-        # Update the base relaxation settings for the deformed structures
-        base_relax_settings["volume"] = False
-        base_relax_settings["shape"] = False
-
-        for key, value in deformed.items():
-            if key.startswith("structure_"):
-                d_structure = value
-                inputs.structure = d_structure
-                relax_settings = base_relax_settings.copy()
-                relax_settings["label"] = f"relax_deformed_{key}"
-                inputs.relax_settings = orm.Dict(dict=relax_settings)
-                running = self.submit(self._base_workchain, **inputs)
-                launched_calculations["workchain_deformed_" + key] = running
-            if key.startswith("deformation_strains"):
-                self.ctx.deformations = value  # 为orm.array数据类型
+        inputs = AttributeDict(self.ctx.relax_inputs)
+        for idx in wave:
+            key = f"structure_{idx}"
+            inputs.structure = self._get_deformed_structure(idx)
+            relax_settings = self.ctx.deformed_relax_settings.copy()
+            relax_settings["label"] = f"relax_deformed_{key}"
+            inputs.relax_settings = orm.Dict(dict=relax_settings)
+            running = self.submit(self._base_workchain, **inputs)
+            launched_calculations["workchain_deformed_" + key] = running
+
+        nfinished = self.ctx.num_deformations - len(pending)
+        self.report(
+            f"Submitted {len(wave)} deformed structure relaxations, "
+            f"{nfinished}/{self.ctx.num_deformations} finished, "
+            f"{len(self.ctx.pending_deformations)} waiting to be submitted"
+        )
         return ToContext(**launched_calculations)
 
-    def compose_elastic_tensor(self):
+    def _get_deformed_structure(self, idx, store=True):
+        """Return the deformed structure of a given index"""
+        if "deformed_trajectory" not in self.ctx:
+            return self.ctx.deformed_structures[idx]
+        return materialize_deformed_structure(
+            self.ctx.deformed_trajectory, idx, store=store
+        )
+
+    def inspect_relax_multi(self):
         """
-        Get the elastic tensor from by compose_elastic_tensor method
+        Refit the elastic tensor after each complete strain level and stop early if converged
+
+        Only active when ``fit_tolerance`` (in GPa) is given in the ``elastic_settings``.
+        The remaining strain levels are skipped once the fits have converged, see
+        `is_fit_converged`, so with the default strains the larger ones are skipped if
+        the stresses of the smallest strains are linear. As in `compose_elastic_tensor`,
+        a failed relaxation fails the workchain, without submitting the remaining ones.
         """
+        if "strain_levels" not in self.ctx:
+            return None
+        pending = self.ctx.pending_deformations
+        finished = [
+            idx for idx in range(self.ctx.num_deformations) if idx not in pending
+        ]
+        last_level = max(self.ctx.strain_levels[idx] for idx in finished)
+        if pending and self.ctx.strain_levels[pending[0]] == last_level:
+            # The current strain level is not complete yet
+            return None
+
+        failed = self._get_failed_deformations()
+        if failed:
+            self.report(f"The deformed structure relaxations {failed} have failed")
+            return self.exit_codes.ERROR_SUB_PROCESS_FAILED
+        miscs = self._get_deformed_miscs()
+        try:
+            voigt, diagnostics = fit_elastic_tensor(
+                read_array(self.ctx.deformations, "deformation_strains"), **miscs
+            )
+        except ValueError as exception:
+            self.report(f"Cannot fit the elastic tensor yet: {exception}")
+            return None
+        max_change = float("nan")
+        if self.ctx.fit_history:
+            previous = np.array(self.ctx.fit_history[-1]["elastic_tensor"])
+            max_change = float(np.abs(voigt - previous).max())
+        self.ctx.fit_history.append(
+            {
+                "elastic_tensor": voigt.tolist(),
+                "residual": diagnostics["rms_residual"],
+                "max_change": max_change,
+                "rank": diagnostics["rank"],
+                "num_deformations": len(miscs),
+            }
+        )
         self.report(
-            "Composing the elastic tensor from the deformed structure relaxations"
+            f"Fitted elastic tensor with {len(miscs)} deformations up to strain level {last_level}: "
+            f"residual {diagnostics['rms_residual']:.4f} GPa, max change of Voigt components {max_change:.4f} GPa"
         )
-        miscs = {
+        if is_fit_converged(
+            self.ctx.fit_history, self.ctx.elastic_settings["fit_tolerance"]
+        ):
+            self.report(
+                f"Elastic tensor converged, skipping {len(pending)} remaining deformations"
+            )
+            self.ctx.pending_deformations = []
+        return None
+
+    def _get_deformed_miscs(self):
+        """Return the `misc` outputs of the successful deformed structure relaxations"""
+        return {
             key: self.ctx[key].outputs.misc
             for key in self.ctx
-            if key.startswith("workchain_deformed")
+            if key.startswith("workchain_deformed") and self.ctx[key].is_finished_ok
         }
+
+    def _get_failed_deformations(self):
+        """Return the keys of the deformed structure relaxations that did not succeed"""
+        return [
+            key
+            for key in self.ctx
+            if key.startswith("workchain_deformed") and not self.ctx[key].is_finished_ok
+        ]
+
+    def compose_elastic_tensor(self):
+        """
+        Get the elastic tensor from by compose_elastic_tensor method
+        """
+        self.report(
+            "Composing the elastic tensor from the deformed structure relaxations"
+        )
+        failed = self._get_failed_deformations()
+        if failed:
+            self.report(f"The deformed structure relaxations {failed} have failed")
+            return self.exit_codes.ERROR_SUB_PROCESS_FAILED
+        miscs = self._get_deformed_miscs()
         self.report(
             "finished collecting workchain outputs for elastic tensor composition"
         )
         # Check  the deformations data and miscs data
         self.report(
-            f"deform_datas: {self.ctx.deformations.get_array('deformation_strains')}"
+            f"deform_datas: {read_array(self.ctx.deformations, 'deformation_strains')}"
         )
         self.report(f"miscs: {miscs}")
         self.out(
             "elastic_tensor",
             get_elastic_tensor(deform_datas=self.ctx.deformations, **miscs),
         )
+        if self.ctx.fit_history:
+            self.out("fit_history", get_fit_history(self.ctx.fit_history))
+
+
+def sanitize_relax_parameters(parameters: orm.Dict):
+    """
+    Remove the `ibrion`, `isif` and `nsw` settings from the VASP parameters.
+
+    These are controlled by the relaxation workchain and must not be fixed for the
+    elastic tensor calculation. Returns the parameters as a dictionary and whether
+    they have been modified.
+    """
+    pdict = parameters.get_dict()
+    pdict["incar"].pop("ibrion", None)
+    pdict["incar"].pop("isif", None)
+    pdict["incar"].pop("nsw", None)
+    return pdict, pdict != parameters.get_dict()
+
+
+def standardize_structure(
+    structure: orm.StructureData, primitive_type="conventional", symprec=1e-3
+):
+    """
+    Standardize the structure to the conventional standard cell with pymatgen's
+    SpacegroupAnalyzer or to the primitive cell with spglib.
+    """
+    if primitive_type == "conventional":
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+        # Use pymatgen's SpacegroupAnalyzer to get the conventional standard structure
+        conventional_structure = SpacegroupAnalyzer(
+            structure.get_pymatgen()
+        ).get_conventional_standard_structure()
+        return orm.StructureData(pymatgen=conventional_structure)
+    if primitive_type == "primitive":
+        import spglib
+
+        atoms = structure.get_ase()
+        # standardize the structure using spglib
+        # Use spglib to standardize the structure
+        prim_atoms_data = spglib.find_primitive(
+            (atoms.cell, atoms.get_scaled_positions(), atoms.numbers),
+            symprec=symprec,
+        )
+        primitive_lat, primitive_pos, primitive_numbers = prim_atoms_data
+        primitive_atoms = ase.Atoms(
+            cell=primitive_lat,
+            scaled_positions=primitive_pos,
+            numbers=primitive_numbers,
+            pbc=True,
+        )
+        return orm.StructureData(ase=primitive_atoms)
+    raise ValueError(
+        f"Unknown primitive type: {primitive_type}. "
+        f'Supported types are "conventional" and "primitive".'
+    )
+
+
+def get_deformed_relax_settings(relax_settings: orm.Dict):
+    """
+    Return the relaxation settings for the deformed structures, which only relax the positions.
+    """
+    base_relax_settings = relax_settings.get_dict()
+    # Update the base relaxation settings for the deformed structures
+    base_relax_settings["volume"] = False
+    base_relax_settings["shape"] = False
+    return base_relax_settings
 
 
 @calcfunction
@@ -227,6 +495,7 @@ def generate_deformed_structures(
     normal_strains: orm.List,
     shear_strains: orm.List,
     symmetry: bool = True,
+    compact: bool = False,
 ):
     """
     generate deformed structures by pymatgen's DeformedStructureSet.
@@ -235,7 +504,12 @@ def generate_deformed_structures(
         normal_strains (orm.List, optional): List of normal strains to apply. Defaults to None.
         shear_strains (orm.List, optional): List of shear strains to apply. Defaults to None.
         symmetry (bool, optional): Whether to use symmetry in the deformation. Defaults to True.
+        compact (bool, optional): Store all deformed structures as the steps of a single
+            `TrajectoryData` output `deformed_structures`, indexed in the same way as
+            `deformation_strains`, instead of one `StructureData` output each. Defaults to False.
     """
+    from pymatgen.analysis.elasticity import DeformedStructureSet
+
     if normal_strains is None:
         normal_strains = (-0.01, -0.005, 0.005, 0.01)
     else:
@@ -251,14 +525,26 @@ def generate_deformed_structures(
         symmetry=bool(symmetry),
     )
     output = {}
-    for i, d_structure in enumerate(deformed_structures.deformed_structures):
-        # 转换为 AiiDA StructureData
-        structure_data = orm.StructureData(pymatgen=d_structure)
-        structure_data.label = f"deformed_{i}"
-        structure_data.description = (
-            f"Deformed structure {i} for elastic tensor calculation"
+    d_structures = deformed_structures.deformed_structures
+    if compact:
+        trajectory = orm.TrajectoryData()
+        trajectory.set_trajectory(
+            symbols=[site.specie.symbol for site in d_structures[0]],
+            positions=np.array([d_struct.cart_coords for d_struct in d_structures]),
+            cells=np.array([d_struct.lattice.matrix for d_struct in d_structures]),
         )
-        output[f"structure_{i}"] = structure_data
+        trajectory.label = "deformed_structures"
+        trajectory.description = "Deformed structures for elastic tensor calculation"
+        output["deformed_structures"] = trajectory
+    else:
+        for i, d_structure in enumerate(d_structures):
+            # 转换为 AiiDA StructureData
+            structure_data = orm.StructureData(pymatgen=d_structure)
+            structure_data.label = f"deformed_{i}"
+            structure_data.description = (
+                f"Deformed structure {i} for elastic tensor calculation"
+            )
+            output[f"structure_{i}"] = structure_data
     strain_data = orm.ArrayData()
     strain_data.set_array(
         "deformation_strains", np.array(deformed_structures.deformations)
@@ -267,39 +553,208 @@ def generate_deformed_structures(
     return output
 
 
+def deform_structure(structure: orm.StructureData, elastic_settings):
+    """
+    Generate the deformed structures according to the ``elastic_settings``.
+    """
+    return generate_deformed_structures(
+        structure,
+        normal_strains=orm.List(elastic_settings.get("normal_strains", None)),
+        shear_strains=orm.List(elastic_settings.get("shear_strains", None)),
+        symmetry=elastic_settings.get("use_symmetry", True),
+        compact=elastic_settings.get("compact_storage", False),
+    )
+
+
+@calcfunction
+def get_deformed_structure(trajectory: orm.TrajectoryData, index: orm.Int):
+    """
+    Create the `StructureData` of a step of the compact deformed structures.
+    """
+    idx = index.value
+    structure = trajectory.get_step_structure(idx)
+    structure.label = f"deformed_{idx}"
+    structure.description = f"Deformed structure {idx} for elastic tensor calculation"
+    return structure
+
+
+def materialize_deformed_structure(
+    trajectory: orm.TrajectoryData, idx: int, store: bool = True
+):
+    """
+    Create the `StructureData` of a deformed structure stored in compact form.
+
+    The structure is created by `get_deformed_structure`, which links it to the
+    trajectory, unless ``store`` is False. The unstored structure is enough to look up
+    equivalent relaxations.
+    """
+    if store:
+        return get_deformed_structure(trajectory, orm.Int(idx))
+    return trajectory.get_step_structure(idx)
+
+
+# Indices of the Voigt components of symmetric 3x3 tensors
+VOIGT_ROWS = np.array([0, 1, 2, 1, 0, 0])
+VOIGT_COLS = np.array([0, 1, 2, 2, 2, 1])
+# Engineering shear strains are used in the Voigt notation of the strains
+STRAIN_VOIGT_SCALE = np.array([1.0, 1.0, 1.0, 2.0, 2.0, 2.0])
+# Number of independent components of the elastic tensor
+NUM_ELASTIC_COMPONENTS = 21
+
+
+def get_green_lagrange_strains(deformations: np.ndarray):
+    """Return the (N, 3, 3) Green-Lagrange strains of a stack of deformation gradients"""
+    deformations = np.asarray(deformations, dtype=float)
+    return 0.5 * (np.einsum("nki,nkj->nij", deformations, deformations) - np.eye(3))
+
+
+def get_strain_levels(deformations: np.ndarray):
+    """
+    Rank the deformations by the magnitude of their strains.
+
+    Normal and shear strains are ranked separately, so the level 0 contains the
+    smallest normal and the smallest shear strains, and so on.
+    """
+    strains = get_green_lagrange_strains(deformations)
+    normal = np.abs(np.diagonal(strains, axis1=1, axis2=2)).max(axis=1)
+    shear = np.abs(strains[:, [0, 0, 1], [1, 2, 2]]).max(axis=1)
+    is_shear = shear > normal
+    magnitudes = np.round(np.where(is_shear, shear, normal), 8)
+    levels = np.zeros(len(strains), dtype=int)
+    for mask in (is_shear, ~is_shear):
+        levels[mask] = np.searchsorted(np.unique(magnitudes[mask]), magnitudes[mask])
+    return levels
+
+
+def get_strains_stresses(deformations: np.ndarray, **kwargs):
+    """
+    Assemble the strains and stresses of the deformed structure relaxations.
+
+    Returns the sorted deformation indices with the (N, 3, 3) Green-Lagrange strains and
+    the (N, 3, 3) stresses in GPa, with the sign convention of pymatgen.
+    """
+    keys = [key for key in kwargs if key.startswith("workchain_deformed")]
+    indices = np.array([int(key.split("_")[-1]) for key in keys], dtype=int)
+    order = np.argsort(indices)
+    # Convert units to GPa from kBar
+    stresses = -0.1 * np.array(
+        [kwargs[keys[i]].get_dict()["stress"] for i in order], dtype=float
+    ).reshape(-1, 3, 3)
+    strains = get_green_lagrange_strains(np.asarray(deformations)[indices[order]])
+    return indices[order], strains, stresses
+
+
+def fit_elastic_tensor_arrays(strains: np.ndarray, stresses: np.ndarray):
+    """
+    Least-squares fit of the elastic tensor to stacks of strains and stresses.
+
+    The 21 independent components of the symmetric tensor are fitted to the linear
+    relation between the Voigt stresses and the Voigt (engineering) strains.
+
+    Returns the tensor in Voigt notation and a dictionary of fit diagnostics: the
+    (N, 6) stress ``residuals`` and their root mean square ``rms_residual`` in GPa,
+    the ``rank`` and the ``condition_number`` of the least-squares problem.
+    """
+    strain_voigt = strains[:, VOIGT_ROWS, VOIGT_COLS] * STRAIN_VOIGT_SCALE
+    stress_voigt = stresses[:, VOIGT_ROWS, VOIGT_COLS]
+    nstrains = len(strain_voigt)
+    if nstrains == 0:
+        raise ValueError("Failed to compose the elastic tensor: no strains given")
+
+    # Design matrix mapping the upper triangle of the tensor to the Voigt stresses
+    rows, cols = np.triu_indices(6)
+    components = np.arange(len(rows))
+    off_diagonal = rows != cols
+    design = np.zeros((nstrains, 6, len(rows)))
+    design[:, rows, components] = strain_voigt[:, cols]
+    design[:, cols[off_diagonal], components[off_diagonal]] += strain_voigt[
+        :, rows[off_diagonal]
+    ]
+    coefficients, _, rank, singular_values = np.linalg.lstsq(
+        design.reshape(nstrains * 6, -1), stress_voigt.reshape(-1), rcond=None
+    )
+    voigt = np.zeros((6, 6))
+    voigt[rows, cols] = coefficients
+    voigt[cols, rows] = coefficients
+
+    residuals = stress_voigt - strain_voigt @ voigt.T
+    with np.errstate(divide="ignore"):
+        condition_number = float(singular_values[0] / singular_values[-1])
+    diagnostics = {
+        "residuals": residuals,
+        "rms_residual": float(np.sqrt(np.mean(residuals**2))),
+        "rank": int(rank),
+        "condition_number": condition_number,
+    }
+    return voigt, diagnostics
+
+
+def fit_elastic_tensor(deformations: np.ndarray, **kwargs):
+    """
+    Fit the elastic tensor to the `misc` outputs of the deformed structure relaxations.
+
+    Returns the tensor in Voigt notation (GPa) and the fit diagnostics, see
+    `fit_elastic_tensor_arrays`.
+    """
+    # 得到弛豫完后结构的应力，再得到对应的应变，然后拟合得到弹性张量
+    _, strains, stresses = get_strains_stresses(deformations, **kwargs)
+    return fit_elastic_tensor_arrays(strains, stresses)
+
+
+def is_fit_converged(fit_history: list, tolerance: float):
+    """
+    Whether the incremental fits of the elastic tensor have converged.
+
+    Once there is an earlier fit, the fits are converged if the largest change of any
+    Voigt component is below the tolerance (GPa). The fit of the first strain level has
+    nothing to be compared with, it is converged if it determines all the components of
+    the tensor and its RMS stress residual is below the tolerance, that is the stresses
+    of the smallest strains are linear in the strains.
+    """
+    latest = fit_history[-1]
+    if len(fit_history) > 1:
+        return latest["max_change"] < tolerance
+    return (
+        latest["rank"] == NUM_ELASTIC_COMPONENTS and latest["residual"] < tolerance
+    )
+
+
 def get_elastic_tensor(deform_datas: orm.ArrayData, **kwargs):
     """
     get the elastic tensor from the results of the deformed structure relaxations.
     """
-    strains = []
-    stresses = []
-    # 得到弛豫完后结构的应力，再得到对应的应变，然后
-    # elastic_tensor = ElasticTensor.from_diff_fit(strains, stresses)得到弹性张量
-    deform_datas = deform_datas.get_array("deformation_strains")
-
-    miscs = []
-    for key, value in kwargs.items():
-        if key.startswith("workchain_deformed"):
-            idx = int(key.split("_")[-1])
-            miscs.append([idx, value])
-
-    miscs = sorted(miscs, key=lambda x: x[0])
-
-    for idx, misc in miscs:
-        stress = (
-            -np.array(misc.get_dict()["stress"]) * 0.1
-        )  # Convert units to GPa from kBar
-        stress_matrix = Stress(stress)
-        stresses.append(stress_matrix)
-
-        strain_matrix = Strain.from_deformation(deform_datas[idx])
-        strains.append(strain_matrix)
-    try:
-        elastic_tensor = ElasticTensor.from_diff_fit(strains, stresses)
-    except Exception as e:
-        raise ValueError(f"Failed to compose the elastic tensor: {e}") from e
+    voigt, diagnostics = fit_elastic_tensor(
+        read_array(deform_datas, "deformation_strains"), **kwargs
+    )
 
     elastic_array = orm.ArrayData()
-    elastic_array.set_array("elastic_tensor", elastic_tensor.voigt)
+    elastic_array.set_array("elastic_tensor", voigt)
+    elastic_array.set_array("fit_residuals", diagnostics["residuals"])
+    elastic_array.base.attributes.set("fit_rms_residual", diagnostics["rms_residual"])
+    elastic_array.base.attributes.set("fit_rank", diagnostics["rank"])
+    if np.isfinite(diagnostics["condition_number"]):
+        elastic_array.base.attributes.set(
+            "fit_condition_number", diagnostics["condition_number"]
+        )
     elastic_array.store()
     return elastic_array
+
+
+def get_fit_history(fit_history: list):
+    """
+    Store the history of the incremental elastic tensor fits.
+    """
+    history = orm.ArrayData()
+    history.set_array(
+        "elastic_tensors", np.array([fit["elastic_tensor"] for fit in fit_history])
+    )
+    history.set_array("residuals", np.array([fit["residual"] for fit in fit_history]))
+    history.set_array(
+        "max_changes", np.array([fit["max_change"] for fit in fit_history])
+    )
+    history.set_array(
+        "num_deformations",
+        np.array([fit["num_deformations"] for fit in fit_history]),
+    )
+    history.store()
+    return history
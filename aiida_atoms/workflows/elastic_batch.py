@@ -0,0 +1,345 @@
+"""
+High-throughput elastic workflow for AiiDA-VASP.
+
+This module implements a driver computing the elastic tensors of many structures:
+    - The relaxation inputs are sanitized once and shared by all materials
+    - The full and deformed structure relaxations of all materials share one concurrency budget
+    - The elastic tensors are collected into a single group and summary table
+"""
+
+from aiida_vasp.workchains.v2.relax import VaspRelaxWorkChain
+
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.engine import ToContext, WorkChain, while_
+
+from ..arrays import read_array
+from .elastic import (
+    deform_structure,
+    get_deformed_relax_settings,
+    get_elastic_tensor,
+    materialize_deformed_structure,
+    sanitize_relax_parameters,
+    standardize_structure,
+)
+
+
+class VaspElasticBatchWorkChain(WorkChain):
+    """
+    AiiDA WorkChain for calculating the elastic tensors of many materials using VASP.
+
+    Each material goes through the same steps as in the `VaspElasticWorkChain`, but the
+    relaxations of all materials are drawn from a single queue limited by the global
+    ``max_concurrent`` budget. The deformed structure relaxations of the materials closest
+    to completion are submitted first, while part of the budget is reserved for starting
+    the full relaxations of new materials, so there is always work to fill the next wave.
+    """
+
+    _base_workchain = VaspRelaxWorkChain
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input_namespace(
+            "structures",
+            valid_type=orm.StructureData,
+            dynamic=True,
+            required=False,
+            help="The structures to calculate the elastic tensors for",
+        )
+        spec.input(
+            "structure_group",
+            valid_type=orm.Str,
+            required=False,
+            help="Label of a group of structures to calculate the elastic tensors for",
+        )
+        spec.input(
+            "result_group",
+            valid_type=orm.Str,
+            required=False,
+            help="Label of the group to add the elastic tensors to, created if it does not exist",
+        )
+        spec.input(
+            "elastic_settings",
+            valid_type=orm.Dict,
+            required=False,
+            help=(
+                "Settings of elastic tensor calculation shared by all materials, valid options: "
+                "use_symmetry, symprec, primitive_type, normal_strains, shear_strains, "
+                "compact_storage and the global max_concurrent"
+            ),
+        )
+        spec.expose_inputs(VaspRelaxWorkChain, "relax", exclude=("structure",))
+        spec.output_namespace(
+            "elastic_tensors",
+            valid_type=orm.ArrayData,
+            dynamic=True,
+            help="The elastic tensors of the materials",
+        )
+        spec.output(
+            "summary",
+            valid_type=orm.Dict,
+            help="Table of the state and the elastic tensor of each material",
+        )
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_relaxations)(
+                cls.run_relaxations,
+                cls.inspect_relaxations,
+            ),
+            cls.results,
+        )
+        spec.exit_code(
+            301,
+            "ERROR_NO_STRUCTURES",
+            message="No structures were given in `structures` or `structure_group`.",
+        )
+        spec.exit_code(
+            500,
+            "ERROR_SUB_PROCESS_FAILED",
+            message="The elastic tensor calculations of all materials have failed.",
+        )
+
+    def setup(self):
+        """
+        Initialize context variables and collect the structures
+        """
+        self.ctx.relax_inputs = self.exposed_inputs(VaspRelaxWorkChain, "relax")
+        self.ctx.elastic_settings = (
+            {}
+            if "elastic_settings" not in self.inputs
+            else self.inputs.elastic_settings.get_dict()
+        )
+        pdict, modified = sanitize_relax_parameters(
+            self.ctx.relax_inputs.vasp.parameters
+        )
+        if modified:
+            self.report(
+                "The VASP parameters have been modified to remove `ibrion`, `isif`, and `nsw` "
+                "settings for the elastic tensor calculations."
+            )
+            self.ctx.relax_inputs.vasp.parameters = orm.Dict(dict=pdict)
+        self.ctx.deformed_relax_settings = get_deformed_relax_settings(
+            self.ctx.relax_inputs.relax_settings
+        )
+
+        structures = {}
+        if "structures" in self.inputs:
+            structures.update(self.inputs.structures)
+        if "structure_group" in self.inputs:
+            group = orm.load_group(self.inputs.structure_group.value)
+            for node in group.nodes:
+                if isinstance(node, orm.StructureData):
+                    structures[f"node_{node.pk}"] = node
+        if not structures:
+            return self.exit_codes.ERROR_NO_STRUCTURES
+
+        self.ctx.materials = {
+            key: {"structure": structure, "state": "waiting", "pending": []}
+            for key, structure in structures.items()
+        }
+        self.ctx.last_wave = []
+        self.report(f"Calculating the elastic tensors of {len(structures)} materials")
+        return None
+
+    def should_run_relaxations(self):
+        """
+        Whether there are relaxations left to be submitted
+        """
+        return any(
+            material["state"] == "waiting" or material["pending"]
+            for material in self.ctx.materials.values()
+        )
+
+    def run_relaxations(self):
+        """
+        Submit the next wave of relaxations within the global budget
+        """
+        materials = self.ctx.materials
+        waiting = [
+            key for key, material in materials.items() if material["state"] == "waiting"
+        ]
+        budget = self.ctx.elastic_settings.get("max_concurrent", None)
+        if budget:
+            # Reserve part of the budget for starting new materials
+            nstart = min(len(waiting), max(1, budget // 4))
+        else:
+            budget = float("inf")
+            nstart = len(waiting)
+
+        wave = []
+        # Deformed structures of the materials closest to completion first
+        deforming = sorted(
+            (key for key, material in materials.items() if material["pending"]),
+            key=lambda key: len(materials[key]["pending"]),
+        )
+        for key in deforming:
+            pending = materials[key]["pending"]
+            while pending and len(wave) < budget - nstart:
+                wave.append([key, pending.pop(0)])
+        for key in waiting:
+            if len(wave) >= budget:
+                break
+            materials[key]["state"] = "relaxing"
+            wave.append([key, None])
+
+        launched_calculations = {}
+        for key, idx in wave:
+            inputs = AttributeDict(self.ctx.relax_inputs)
+            if idx is None:
+                inputs.structure = materials[key]["structure"]
+                launched_calculations[f"full_relax_{key}"] = self.submit(
+                    self._base_workchain, **inputs
+                )
+            else:
+                inputs.structure = self._get_deformed_structure(key, idx)
+                relax_settings = self.ctx.deformed_relax_settings.copy()
+                relax_settings["label"] = f"relax_deformed_{key}_structure_{idx}"
+                inputs.relax_settings = orm.Dict(dict=relax_settings)
+                launched_calculations[f"deformed_{key}_{idx}"] = self.submit(
+                    self._base_workchain, **inputs
+                )
+        self.ctx.last_wave = wave
+
+        ndone = sum(
+            1
+            for material in materials.values()
+            if material["state"] in ("done", "failed")
+        )
+        nstarted = sum(1 for key, idx in wave if idx is None)
+        self.report(
+            f"Submitted {len(wave) - nstarted} deformed and {nstarted} full relaxations, "
+            f"{ndone}/{len(materials)} materials finished"
+        )
+        return ToContext(**launched_calculations)
+
+    def _get_deformed_structure(self, key, idx):
+        """Return the deformed structure of a given material and index"""
+        deformed = self.ctx.materials[key]["deformed"]
+        if isinstance(deformed, orm.TrajectoryData):
+            return materialize_deformed_structure(deformed, idx)
+        return deformed[idx]
+
+    def inspect_relaxations(self):
+        """
+        Process the finished relaxations of the last wave
+        """
+        materials = self.ctx.materials
+        for key, idx in self.ctx.last_wave:
+            material = materials[key]
+            if idx is None:
+                node = self.ctx[f"full_relax_{key}"]
+                if not node.is_finished_ok:
+                    self.report(f"Full relaxation of {key} failed: {node}")
+                    material["state"] = "failed"
+                    continue
+                self._generate_deformations(key, node.outputs.relax.structure)
+            else:
+                node = self.ctx[f"deformed_{key}_{idx}"]
+                if not node.is_finished_ok and material["state"] != "failed":
+                    self.report(
+                        f"Deformed structure relaxation {idx} of {key} failed: {node}"
+                    )
+                    material["state"] = "failed"
+                    material["pending"] = []
+
+        for key in {key for key, _ in self.ctx.last_wave}:
+            material = materials[key]
+            if material["state"] == "deforming" and not material["pending"]:
+                self._compose_elastic_tensor(key)
+
+    def _generate_deformations(self, key, relaxed_structure):
+        """Standardize the relaxed structure of a material and queue the deformations"""
+        material = self.ctx.materials[key]
+        reference = standardize_structure(
+            relaxed_structure,
+            primitive_type=self.ctx.elastic_settings.get(
+                "primitive_type", "conventional"
+            ),
+            symprec=self.ctx.elastic_settings.get("symprec", 1e-3),
+        )
+        deformed = deform_structure(reference, self.ctx.elastic_settings)
+        material["relaxed_structure"] = relaxed_structure
+        material["deformations"] = deformed["deformation_strains"]
+        if "deformed_structures" in deformed:
+            material["deformed"] = deformed["deformed_structures"]
+        else:
+            material["deformed"] = {
+                int(name.split("_")[-1]): value
+                for name, value in deformed.items()
+                if name.startswith("structure_")
+            }
+        ndeformations = len(read_array(material["deformations"], "deformation_strains"))
+        material["num_deformations"] = ndeformations
+        material["pending"] = list(range(ndeformations))
+        material["state"] = "deforming"
+
+    def _compose_elastic_tensor(self, key):
+        """Compose the elastic tensor of a material with all deformations relaxed"""
+        material = self.ctx.materials[key]
+        miscs = {
+            f"workchain_deformed_structure_{idx}": self.ctx[
+                f"deformed_{key}_{idx}"
+            ].outputs.misc
+            for idx in range(material["num_deformations"])
+        }
+        try:
+            elastic_tensor = get_elastic_tensor(
+                deform_datas=material["deformations"], **miscs
+            )
+        except ValueError as exception:
+            self.report(f"Failed to compose the elastic tensor of {key}: {exception}")
+            material["state"] = "failed"
+            return
+        elastic_tensor.label = f"{key} elastic tensor"
+        elastic_tensor.description = (
+            f"Elastic tensor of {material['structure'].get_formula()} "
+            f"from StructureData<{material['structure'].uuid}>"
+        )
+        self.out(f"elastic_tensors.{key}", elastic_tensor)
+        if "result_group" in self.inputs:
+            group, _ = orm.Group.collection.get_or_create(
+                self.inputs.result_group.value
+            )
+            group.add_nodes(elastic_tensor)
+        material["elastic_tensor"] = elastic_tensor
+        material["state"] = "done"
+
+    def results(self):
+        """
+        Collect the summary table of all materials
+        """
+        table = {}
+        for key, material in self.ctx.materials.items():
+            row = {
+                "structure": material["structure"].uuid,
+                "formula": material["structure"].get_formula(),
+                "state": material["state"],
+                "relaxed_structure": None,
+                "elastic_tensor": None,
+                "voigt": None,
+            }
+            if "relaxed_structure" in material:
+                row["relaxed_structure"] = material["relaxed_structure"].uuid
+            if "elastic_tensor" in material:
+                row["elastic_tensor"] = material["elastic_tensor"].uuid
+                row["voigt"] = (
+                    read_array(material["elastic_tensor"], "elastic_tensor").tolist()
+                )
+            table[key] = row
+            voigt = row["voigt"]
+            moduli = (
+                f"C11={voigt[0][0]:.1f} C12={voigt[0][1]:.1f} C44={voigt[3][3]:.1f} GPa"
+                if voigt
+                else ""
+            )
+            self.report(f"{key:<20} {row['formula']:<16} {row['state']:<8} {moduli}")
+
+        summary = orm.Dict(dict=table)
+        summary.store()
+        self.out("summary", summary)
+        if not any(
+            material["state"] == "done" for material in self.ctx.materials.values()
+        ):
+            return self.exit_codes.ERROR_SUB_PROCESS_FAILED
+        return None
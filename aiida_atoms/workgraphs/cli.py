@@ -0,0 +1,382 @@
+"""
+Command line interface of the aiida-atoms workflows.
+
+This module only imports click at the top level, the workflow modules (and with them
+aiida-vasp, aiida-workgraph and pymatgen) are imported when a command runs, so that
+``--help`` and argument errors return immediately.
+"""
+
+import click
+
+
+def _load_profile():
+    """Load the default AiiDA profile unless one is loaded already, e.g. by ``verdi run``"""
+    from aiida import load_profile
+    from aiida.manage import get_manager
+
+    if get_manager().get_profile() is None:
+        load_profile()
+
+
+@click.group()
+def cli():
+    """Command line tools of aiida-atoms"""
+
+
+@cli.command("phono3py")
+@click.argument("material_id")
+@click.argument("structure_file", type=click.Path(exists=True))
+@click.argument("phono3py_code")
+@click.option("--max-concurrent", default=50, help="Maximum number of concurrent jobs")
+@click.option(
+    "--cutoff-pair",
+    type=float,
+    default=None,
+    help="Skip the FC3 displacement pairs further apart than this distance (Å)",
+)
+@click.option(
+    "--snapshots",
+    type=int,
+    default=None,
+    help="Use this number of randomly displaced supercells for FC3",
+)
+@click.option(
+    "--random-seed", type=int, default=None, help="Seed of the random displacements"
+)
+@click.option(
+    "--pack-fc2", type=int, default=1, help="Number of FC2 calculations per job"
+)
+@click.option(
+    "--pack-fc3", type=int, default=1, help="Number of FC3 calculations per job"
+)
+@click.option(
+    "--pack-concurrent",
+    is_flag=True,
+    help="Run the packed calculations at the same time instead of one after another",
+)
+@click.option(
+    "--ltc-mesh",
+    type=int,
+    nargs=3,
+    default=None,
+    help="Compute the thermal conductivity on this q-point mesh",
+)
+@click.option(
+    "--ltc-temperature",
+    type=float,
+    multiple=True,
+    help="Temperature of the thermal conductivity (K), can be repeated",
+)
+@click.option(
+    "--ltc-code",
+    default=None,
+    help="Python code running the thermal conductivity as a job (with --ltc-mesh)",
+)
+@click.option(
+    "--mock-vasp",
+    is_flag=True,
+    help="Run the VASP calculations with the ASE-based stand-ins, e.g. to benchmark",
+)
+def phono3py_command(
+    structure_file,
+    material_id,
+    phono3py_code,
+    max_concurrent=50,
+    cutoff_pair=None,
+    snapshots=None,
+    random_seed=None,
+    pack_fc2=1,
+    pack_fc3=1,
+    pack_concurrent=False,
+    ltc_mesh=None,
+    ltc_temperature=(),
+    ltc_code=None,
+    mock_vasp=False,
+):
+    """
+    Launch a workflow to generate 2nd and 3rd order force constants using phono3py for a given structure file.
+    """
+    _load_profile()
+    from pymatgen.core import Structure
+
+    from aiida import orm
+
+    from .phono3py import (
+        MOCK_VASP_WORKCHAINS,
+        count_displacements,
+        get_packing_settings,
+        submit_phono3py,
+    )
+
+    structure = Structure.from_file(structure_file)
+    formula = structure.composition.reduced_formula
+    # Report the number of calculations before submitting anything. The count uses the
+    # input structure, the relaxed structure normally has the same symmetry.
+    counts = count_displacements(
+        structure.to_ase_atoms(),
+        cutoff_pair_distance=cutoff_pair,
+        number_of_snapshots=snapshots,
+        random_seed=random_seed,
+    )
+    click.echo(
+        f"{formula} {material_id}: {counts['fc3']} FC3 and {counts['fc2']} FC2 "
+        f"supercell calculations in {-(-counts['fc3'] // pack_fc3)} and "
+        f"{-(-counts['fc2'] // pack_fc2)} jobs"
+    )
+    options = {}
+    if ltc_mesh and not ltc_code:
+        raise click.UsageError("--ltc-mesh needs --ltc-code to run the calculation")
+    if ltc_mesh:
+        ltc_settings = {"mesh": list(ltc_mesh)}
+        if ltc_temperature:
+            ltc_settings["temperatures"] = list(ltc_temperature)
+        options["ltc_settings"] = ltc_settings
+        options["ltc_code"] = orm.load_code(ltc_code)
+    if mock_vasp:
+        options["workchains"] = MOCK_VASP_WORKCHAINS
+    return submit_phono3py(
+        structure,
+        material_id,
+        orm.load_code(phono3py_code),
+        max_concurrent=max_concurrent,
+        cutoff_pair_distance=cutoff_pair,
+        number_of_snapshots=snapshots,
+        random_seed=random_seed,
+        packing=get_packing_settings(pack_fc2, pack_fc3, pack_concurrent),
+        **options,
+    )
+
+
+@cli.command("phono3py-batch")
+@click.argument("source", type=click.Path(exists=True))
+@click.argument("phono3py_code")
+@click.option(
+    "--max-jobs", default=500, help="Maximum number of concurrent VASP jobs in total"
+)
+@click.option(
+    "--max-concurrent", default=50, help="Maximum number of concurrent jobs per material"
+)
+@click.option("--poll-interval", default=60.0, help="Seconds between the checks")
+@click.option(
+    "--dry-run", is_flag=True, help="Only list the materials that would be submitted"
+)
+@click.option("--pack-fc2", type=int, default=1, help="Number of FC2 calculations per job")
+@click.option("--pack-fc3", type=int, default=1, help="Number of FC3 calculations per job")
+def phono3py_batch_command(
+    source,
+    phono3py_code,
+    max_jobs=500,
+    max_concurrent=50,
+    poll_interval=60.0,
+    dry_run=False,
+    pack_fc2=1,
+    pack_fc3=1,
+):
+    """
+    Submit phono3py WorkGraphs for all materials in SOURCE under a global job cap.
+
+    SOURCE is a directory of structure files or a CSV file with the material_id and
+    structure_file columns.
+    """
+    _load_profile()
+    import time
+
+    from pymatgen.core import Structure
+
+    from aiida import orm
+
+    from .phono3py import get_packing_settings, get_process_label, submit_phono3py
+    from .phono3py_batch import (
+        AdmissionController,
+        get_existing_processes,
+        get_job_statistics,
+        read_materials,
+    )
+
+    materials = []
+    for material_id, path in read_materials(source):
+        structure = Structure.from_file(path)
+        label = get_process_label(structure.composition.reduced_formula, material_id)
+        materials.append((material_id, structure, label))
+
+    existing = get_existing_processes(
+        (material_id, label) for material_id, _, label in materials
+    )
+    pending = [material for material in materials if material[0] not in existing]
+    click.echo(
+        f"{len(materials)} materials, {len(materials) - len(pending)} skipped with "
+        f"existing results, {len(pending)} to submit"
+    )
+    if dry_run:
+        for _, _, label in pending:
+            click.echo(f"  {label}")
+        return
+
+    code = orm.load_code(phono3py_code)
+    packing = get_packing_settings(pack_fc2, pack_fc3)
+    controller = AdmissionController(max_jobs, max_concurrent)
+    submitted = {}
+    start = time.time()
+    while True:
+        now = time.time()
+        stats = get_job_statistics()
+        while pending and controller.can_submit(stats["active"]):
+            material_id, structure, label = pending.pop(0)
+            process = submit_phono3py(
+                structure,
+                material_id,
+                code,
+                max_concurrent=max_concurrent,
+                packing=packing,
+            )
+            submitted[label] = process.pk
+            controller.record(process)
+            # Recount, the jobs launched since are no longer reserved
+            stats = get_job_statistics()
+            click.echo(f"Submitted {label}: {submitted[label]}")
+
+        # Reload the nodes to see the state changes made by the daemon
+        nodes = [orm.load_node(pk) for pk in submitted.values()]
+        finished = [node for node in nodes if node.is_terminated]
+        failed = sum(1 for node in finished if not node.is_finished_ok)
+        hours = max(now - start, 1.0) / 3600
+        click.echo(
+            f"[{time.strftime('%H:%M:%S')}] jobs: {stats['active']} active "
+            f"({stats['running']} running, {stats['queued']} queued) / {max_jobs} | "
+            f"materials: {len(submitted)} submitted, {len(finished)} finished "
+            f"({failed} failed), {len(pending)} pending | "
+            f"{len(finished) / hours:.2f} materials/hour"
+        )
+        if not pending and len(finished) == len(submitted):
+            break
+        time.sleep(poll_interval)
+
+
+@cli.command("mock-elastic-benchmark")
+@click.option("--count", default=7, help="Number of materials")
+@click.option("--latency", default=0.0, help="Seconds to wait in each mock calculation")
+@click.option(
+    "--max-concurrent", type=int, default=None, help="Concurrent relaxations per material"
+)
+@click.option(
+    "--daemon", is_flag=True, help="Submit to the daemon instead of running in-process"
+)
+def mock_elastic_benchmark_command(
+    count=7, latency=0.0, max_concurrent=None, daemon=False
+):
+    """
+    Benchmark the elastic workflow with the mock VASP workchains.
+    """
+    _load_profile()
+    from ..mock.benchmark import get_benchmark_structures, run_elastic_benchmark
+
+    settings = {"max_concurrent": max_concurrent} if max_concurrent else None
+    results = run_elastic_benchmark(
+        get_benchmark_structures(count=count),
+        elastic_settings=settings,
+        latency=latency,
+        use_daemon=daemon,
+    )
+    for key, value in results.items():
+        click.echo(f"{key:<32} {value}")
+
+
+@cli.command("profile")
+@click.argument("pk", type=int)
+@click.option("--json", "json_file", type=click.Path(), help="Write the report as JSON")
+@click.option(
+    "--folded",
+    type=click.Path(),
+    help="Write the time of each process in the folded stack format of flame graphs",
+)
+def profile_command(pk, json_file=None, folded=None):
+    """
+    Report where the time, nodes and repository bytes of a finished run PK are spent.
+    """
+    _load_profile()
+    from ..profiling import format_report, profile_process, to_folded_stacks, write_report
+
+    report = profile_process(pk)
+    click.echo(format_report(report))
+    if json_file:
+        write_report(report, json_file)
+    if folded:
+        with open(folded, "w", encoding="utf-8") as handle:
+            handle.write(to_folded_stacks(report))
+
+
+@cli.command("phono3py-partial")
+@click.argument("pk", type=int)
+@click.argument("output", type=click.Path())
+def phono3py_partial_command(pk, output):
+    """
+    Write the phono3py_params.yaml of run PK from the forces that have finished so far.
+    """
+    _load_profile()
+    from aiida import orm
+
+    from .phono3py import get_partial_phono3py_param
+
+    params = get_partial_phono3py_param(orm.load_node(pk))
+    with open(output, "wb") as handle:
+        handle.write(params.get_content(mode="rb"))
+    click.echo(f"Written {output} from {params.creator}")
+
+
+@cli.group("admin")
+def admin():
+    """Maintenance of the database that is not covered by the AiiDA migrations"""
+
+
+@admin.command("create-fingerprint-index")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation")
+def create_fingerprint_index_command(yes=False):
+    """
+    Create the index of the structure fingerprints on a PostgreSQL database.
+
+    The index is added to the AiiDA tables outside of the AiiDA migrations, drop it with
+    DROP INDEX db_dbnode_extras_fingerprint_key if a migration fails on it.
+    """
+    click.echo(
+        "Warning: the index is added to the db_dbnode table outside of the AiiDA "
+        "migrations, which do not know about it."
+    )
+    if not yes:
+        click.confirm("Create the index?", abort=True)
+    _load_profile()
+    from ..fingerprint import create_fingerprint_index, explain_candidate_query
+
+    if not create_fingerprint_index():
+        raise click.ClickException("The storage of the profile is not PostgreSQL")
+    click.echo("Created the index, the plan of a fingerprint lookup is:")
+    for line in explain_candidate_query():
+        click.echo(f"  {line}")
+
+
+@cli.command("export")
+@click.argument("output", type=click.Path())
+@click.option("--group", help="Label of the group of structures to export")
+@click.option(
+    "--descendants-of", type=int, help="Export the structures derived from this node"
+)
+@click.option(
+    "--format", "fmt", type=click.Choice(["hdf5", "extxyz"]), help="Output format"
+)
+@click.option("--page-size", default=1000, help="Structures per query and write")
+def export_command(output, group=None, descendants_of=None, fmt=None, page_size=1000):
+    """
+    Export structures with their energies, forces and stresses to OUTPUT.
+
+    An existing export at OUTPUT is continued after its last structure.
+    """
+    _load_profile()
+    from ..export import export_structures
+
+    count = export_structures(
+        output, group=group, ancestor=descendants_of, fmt=fmt, page_size=page_size
+    )
+    click.echo(f"Exported {count} structures to {output}")
+
+
+if __name__ == "__main__":
+    cli()
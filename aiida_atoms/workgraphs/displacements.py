@@ -0,0 +1,264 @@
+"""
+Compact storage of the displacement structures of phono3py calculations
+
+Instead of one StructureData per displaced supercell, the whole displacement set is stored
+in a single ArrayData. For each order (fc3 and fc2) the node holds the base supercell and,
+in a CSR layout, the indices and displacement vectors of the atoms moved in each supercell:
+
+    {order}_cell, {order}_positions, {order}_numbers    the base supercell (Cartesian, Å)
+    {order}_ids                                         the file number of each supercell
+    {order}_offsets                                     start of each supercell in the arrays below
+    {order}_atoms, {order}_vectors                      displaced atoms and vectors (Cartesian, Å)
+
+The structures are materialized only when their calculations are submitted.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from aiida import orm
+import ase
+
+from ..arrays import read_array
+
+ORDERS = ("fc3", "fc2")
+# Smallest displacement (Å) considered as a moved atom
+DISPLACEMENT_TOLERANCE = 1e-6
+# Below this number of files the process pool costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+
+def get_displacement_key(order: str, file_id: int):
+    """Name of a displaced supercell in the same way as the files written by phono3py"""
+    if order == "fc2":
+        return f"POSCAR_FC2_{file_id:05d}"
+    return f"POSCAR_{file_id:05d}"
+
+
+def parse_displacement_key(key: str) -> Tuple[str, int]:
+    """Return the order and the file number of a displaced supercell name"""
+    order = "fc2" if "FC2" in key else "fc3"
+    return order, int(key.replace("-", "_").split("_")[-1])
+
+
+def read_poscar(path):
+    """Read the cell, fractional positions and atomic numbers of a POSCAR file"""
+    from pymatgen.core import Structure
+
+    structure = Structure.from_file(path)
+    return (
+        structure.lattice.matrix,
+        structure.frac_coords,
+        np.array(structure.atomic_numbers),
+    )
+
+
+def read_poscars(paths: Sequence, max_workers=None) -> List[tuple]:
+    """
+    Read many POSCAR files, in parallel with a process pool for large sets.
+
+    The workers are started with the `spawn` method so that no database connection or
+    event loop of the parent process is inherited.
+    """
+    paths = [str(path) for path in paths]
+    if len(paths) < PARALLEL_THRESHOLD:
+        return [read_poscar(path) for path in paths]
+    max_workers = max_workers or min(os.cpu_count() or 1, 16)
+    chunksize = max(1, len(paths) // (max_workers * 4))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return list(executor.map(read_poscar, paths, chunksize=chunksize))
+
+
+def set_displacement_arrays(
+    node: orm.ArrayData,
+    order: str,
+    cell: np.ndarray,
+    positions: np.ndarray,
+    numbers: np.ndarray,
+    displaced: Dict[int, np.ndarray],
+    total: Optional[int] = None,
+    random: bool = False,
+):
+    """
+    Store the displaced supercells of one order relative to their base supercell.
+
+    :param cell: The cell of the base supercell.
+    :param positions: The fractional positions of the base supercell.
+    :param numbers: The atomic numbers of the base supercell.
+    :param displaced: The fractional positions of the displaced supercells keyed by their
+        file numbers.
+    :param total: The number of supercells in the displacement dataset, including those
+        skipped by a pair cutoff. Defaults to the largest file number.
+    :param random: Whether the supercells are random snapshots rather than systematic
+        displacements, stored as the ``{order}_random`` attribute. A snapshot may move
+        as few atoms as a systematic displacement, so this must be given by the caller.
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    file_ids = np.array(sorted(displaced), dtype=int)
+    offsets = [0]
+    atoms = []
+    vectors = []
+    for file_id in file_ids:
+        delta = np.asarray(displaced[file_id], dtype=float) - positions
+        # Minimum image displacements in Cartesian coordinates
+        delta = (delta - np.round(delta)) @ cell
+        moved = np.flatnonzero(np.linalg.norm(delta, axis=1) > DISPLACEMENT_TOLERANCE)
+        atoms.append(moved)
+        vectors.append(delta[moved])
+        offsets.append(offsets[-1] + len(moved))
+
+    node.set_array(f"{order}_cell", cell)
+    node.set_array(f"{order}_positions", positions @ cell)
+    node.set_array(f"{order}_numbers", np.asarray(numbers, dtype=int))
+    node.set_array(f"{order}_ids", file_ids)
+    node.set_array(f"{order}_offsets", np.array(offsets, dtype=int))
+    node.set_array(
+        f"{order}_atoms",
+        np.concatenate(atoms) if atoms else np.zeros(0, dtype=int),
+    )
+    node.set_array(
+        f"{order}_vectors",
+        np.concatenate(vectors) if vectors else np.zeros((0, 3)),
+    )
+    if total is None:
+        total = int(file_ids.max()) if len(file_ids) else 0
+    node.base.attributes.set(f"{order}_count", len(file_ids))
+    node.base.attributes.set(f"{order}_total", total)
+    node.base.attributes.set(f"{order}_random", bool(random))
+
+
+def get_displacement_vectors(
+    node: orm.ArrayData, order: str, total: Optional[int] = None
+) -> np.ndarray:
+    """
+    Return the displacements of all atoms with the shape (total, natoms, 3).
+
+    Supercells that are not stored, e.g. those skipped by a pair cutoff, have zero
+    displacements.
+    """
+    total = total or node.base.attributes.get(f"{order}_total")
+    file_ids = read_array(node, f"{order}_ids")
+    offsets = read_array(node, f"{order}_offsets")
+    atoms = read_array(node, f"{order}_atoms")
+    vectors = read_array(node, f"{order}_vectors")
+    natoms = len(read_array(node, f"{order}_numbers"))
+
+    result = np.zeros((total, natoms, 3))
+    # Index of the supercell of each stored displaced atom
+    supercells = np.repeat(file_ids - 1, np.diff(offsets))
+    result[supercells, atoms] = vectors
+    return result
+
+
+def get_displacement_keys(node: orm.ArrayData) -> List[str]:
+    """Return the names of all displaced supercells stored in a node"""
+    keys = []
+    for order in ORDERS:
+        if f"{order}_ids" in node.get_arraynames():
+            keys.extend(
+                get_displacement_key(order, file_id)
+                for file_id in read_array(node, f"{order}_ids").tolist()
+            )
+    return keys
+
+
+class DisplacementSet:
+    """
+    The displaced supercells of a node, with the arrays of each order read only once
+
+    Use it to materialize many supercells of the same node, `materialize_displacement`
+    reads the arrays again for every supercell.
+    """
+
+    def __init__(self, node: orm.ArrayData):
+        self.node = node
+        self._arrays = {}
+
+    def get_arrays(self, order: str) -> Dict[str, np.ndarray]:
+        """The arrays of an order, read on first use"""
+        if order not in self._arrays:
+            self._arrays[order] = {
+                name: np.array(read_array(self.node, f"{order}_{name}"))
+                for name in (
+                    "ids",
+                    "offsets",
+                    "atoms",
+                    "vectors",
+                    "positions",
+                    "numbers",
+                    "cell",
+                )
+            }
+        return self._arrays[order]
+
+    def materialize(self, key: str) -> orm.StructureData:
+        """Build the (unstored) StructureData of a displaced supercell"""
+        order, file_id = parse_displacement_key(key)
+        arrays = self.get_arrays(order)
+        file_ids = arrays["ids"]
+        index = int(np.searchsorted(file_ids, file_id))
+        if index == len(file_ids) or file_ids[index] != file_id:
+            raise KeyError(f"No displaced supercell {key} in {self.node}")
+        start, end = arrays["offsets"][index], arrays["offsets"][index + 1]
+
+        positions = arrays["positions"].copy()
+        positions[arrays["atoms"][start:end]] += arrays["vectors"][start:end]
+        structure = orm.StructureData(
+            ase=ase.Atoms(
+                numbers=arrays["numbers"],
+                positions=positions,
+                cell=arrays["cell"],
+                pbc=True,
+            )
+        )
+        structure.label = key
+        return structure
+
+
+def materialize_displacement(node: orm.ArrayData, key: str) -> orm.StructureData:
+    """Build the (unstored) StructureData of a displaced supercell"""
+    return DisplacementSet(node).materialize(key)
+
+
+def parse_displacement_folder(
+    dirpath: Path, max_workers=None, random: bool = False
+) -> orm.ArrayData:
+    """
+    Parse the SPOSCAR and POSCAR files written by ``phono3py -d`` into a single node.
+
+    :param random: Whether the FC3 supercells are random snapshots, the FC2 supercells
+        are always systematic displacements.
+    """
+    dirpath = Path(dirpath)
+    node = orm.ArrayData()
+    for order, base_name, pattern in (
+        ("fc3", "SPOSCAR", "POSCAR-*"),
+        ("fc2", "SPOSCAR_FC2", "POSCAR_FC2-*"),
+    ):
+        paths = sorted(dirpath.glob(pattern))
+        if not paths:
+            continue
+        cell, positions, numbers = read_poscar(dirpath / base_name)
+        results = read_poscars(paths, max_workers=max_workers)
+        displaced = {
+            parse_displacement_key(path.name)[1]: result[1]
+            for path, result in zip(paths, results)
+        }
+        set_displacement_arrays(
+            node,
+            order,
+            cell,
+            positions,
+            numbers,
+            displaced,
+            random=random and order == "fc3",
+        )
+    return node
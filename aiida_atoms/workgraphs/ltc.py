@@ -0,0 +1,189 @@
+"""
+Lattice thermal conductivity stage of the phono3py workflow
+
+The thermal conductivity is computed from the ``phono3py_params.yaml`` of
+`run_phono3py_rs_zb` as a shell job running ``python -m aiida_atoms.ltc`` on the
+computer of a code. For interactive runs it can also be computed in the workflow
+process with a pool of worker processes, which would otherwise occupy a daemon worker
+for the whole calculation. The results are stored as an `ArrayData` with the
+``kappa``, the ``temperatures`` and the times of the chunks.
+
+The chunks of the calculations in the workflow process are checkpointed in the
+``AIIDA_ATOMS_LTC_CHECKPOINT_DIR`` directory, by default ``aiida_atoms/ltc/<profile>``
+in the AiiDA configuration directory.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import typing as t
+
+from aiida_workgraph import namespace, shelljob, task
+import numpy as np
+
+from aiida import orm
+from aiida.common.log import AIIDA_LOGGER
+from aiida.engine import calcfunction
+
+from ..ltc import format_chunk_timings, get_ltc_settings, run_ltc
+from .phono3py import run_phono3py_rs_zb
+
+LOGGER = AIIDA_LOGGER.getChild("ltc")
+
+# Settings that do not change the results
+_RUNTIME_SETTINGS = ("workers", "mpi", "checkpoint_dir")
+
+
+def to_kappa_node(result: dict) -> orm.ArrayData:
+    """Store the results of `run_ltc` in an `ArrayData`"""
+    node = orm.ArrayData()
+    for name in ("kappa", "temperatures", "mesh", "chunk_times", "chunk_grid_points"):
+        node.set_array(name, np.asarray(result[name]))
+    node.base.attributes.set("chunk_timings", format_chunk_timings(result))
+    return node
+
+
+def get_checkpoint_root() -> Path:
+    """Directory of the checkpoints of the calculations in the workflow process"""
+    if os.environ.get("AIIDA_ATOMS_LTC_CHECKPOINT_DIR"):
+        return Path(os.environ["AIIDA_ATOMS_LTC_CHECKPOINT_DIR"])
+    from aiida.manage import get_manager
+    from aiida.manage.configuration import get_config
+
+    profile = get_manager().get_profile()
+    name = profile.name if profile is not None else "default"
+    return Path(get_config().dirpath) / "aiida_atoms" / "ltc" / name
+
+
+def get_checkpoint_dir(content: bytes, settings: dict) -> Path:
+    """Directory of the chunk results of a calculation, shared by its reruns"""
+    if settings.get("checkpoint_dir"):
+        return Path(settings["checkpoint_dir"])
+    key = {k: v for k, v in settings.items() if k not in _RUNTIME_SETTINGS}
+    digest = hashlib.sha256(content + json.dumps(key, sort_keys=True).encode())
+    return get_checkpoint_root() / digest.hexdigest()[:16]
+
+
+@calcfunction
+def compute_thermal_conductivity(phono3py_params: orm.SinglefileData, settings: orm.Dict):
+    """
+    Compute the lattice thermal conductivity in the current process
+
+    The chunks are checkpointed in a directory derived from the inputs, so a failed
+    calculation continues with the remaining chunks when it is run again.
+    """
+    settings = get_ltc_settings(settings.get_dict())
+    content = phono3py_params.get_content(mode="rb")
+    checkpoint_dir = get_checkpoint_dir(content, settings)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    params_path = checkpoint_dir / "phono3py_params.yaml"
+    params_path.write_bytes(content)
+    result = run_ltc(
+        params_path, settings, checkpoint_dir / "chunks", log=LOGGER.info
+    )
+    LOGGER.info(format_chunk_timings(result))
+    return to_kappa_node(result)
+
+
+@calcfunction
+def read_kappa(kappa: orm.SinglefileData):
+    """Store the results written by ``python -m aiida_atoms.ltc`` in an `ArrayData`"""
+    with kappa.open(mode="rb") as handle:
+        with np.load(handle) as data:
+            return to_kappa_node({name: data[name] for name in data.files})
+
+
+ThermalConductivityTask = task(compute_thermal_conductivity)
+ReadKappaTask = task(read_kappa)
+
+
+@task.graph
+def run_ltc_stage(
+    phono3py_params: orm.SinglefileData,
+    settings: t.Optional[dict] = None,
+    code: t.Optional[orm.Code] = None,
+    local: bool = False,
+) -> t.Annotated[dict, namespace(kappa=t.Any)]:
+    """
+    Compute the lattice thermal conductivity from a ``phono3py_params.yaml``.
+
+    :param settings: The settings, see `aiida_atoms.ltc.DEFAULT_LTC_SETTINGS`.
+    :param code: A Python code with aiida-atoms and phono3py installed, which runs the
+        calculation as a job.
+    :param local: Run the calculation in the workflow process instead, for interactive
+        runs only since it occupies a daemon worker for the whole calculation.
+    """
+    settings = get_ltc_settings(
+        settings.get_dict() if isinstance(settings, orm.Dict) else settings
+    )
+    local = getattr(local, "value", local)
+    if code is None and not local:
+        raise ValueError(
+            "A code is needed to run the thermal conductivity as a job, or set local "
+            "to run it in the workflow process"
+        )
+    if code is None:
+        return {
+            "kappa": ThermalConductivityTask(
+                phono3py_params=phono3py_params, settings=orm.Dict(settings)
+            ).result
+        }
+
+    settings_node = orm.SinglefileData.from_string(
+        json.dumps(settings), filename="ltc_settings.json"
+    )
+    out = shelljob(
+        command=code,
+        arguments=[
+            "-m",
+            "aiida_atoms.ltc",
+            "{phono3py_params}",
+            "--settings",
+            "{settings}",
+            "--output",
+            "kappa.npz",
+        ],
+        nodes={"phono3py_params": phono3py_params, "settings": settings_node},
+        outputs=["kappa.npz"],
+        metadata={"options": {"withmpi": bool(settings["mpi"])}},
+    )
+    return {"kappa": ReadKappaTask(kappa=out.kappa_npz).result}
+
+
+@task.graph
+def run_phono3py_ltc(
+    initial_structure,
+    kind: str,
+    mp_id: str,
+    phono3py_code: orm.Code,
+    ltc_settings: t.Optional[dict] = None,
+    ltc_code: t.Optional[orm.Code] = None,
+    ltc_local: bool = False,
+    cutoff_pair_distance: t.Optional[float] = None,
+    number_of_snapshots: t.Optional[int] = None,
+    random_seed: t.Optional[int] = None,
+    packing: t.Optional[dict] = None,
+    workchains: t.Optional[dict] = None,
+) -> t.Annotated[dict, namespace(phono3py_params=t.Any, kappa=t.Any)]:
+    """
+    Run `run_phono3py_rs_zb` followed by the thermal conductivity stage
+
+    The thermal conductivity runs as a job of `ltc_code`, or in the workflow process if
+    `ltc_local` is set (see `run_ltc_stage`).
+    """
+    params = run_phono3py_rs_zb(
+        initial_structure=initial_structure,
+        kind=kind,
+        mp_id=mp_id,
+        phono3py_code=phono3py_code,
+        cutoff_pair_distance=cutoff_pair_distance,
+        number_of_snapshots=number_of_snapshots,
+        random_seed=random_seed,
+        packing=packing,
+        workchains=workchains,
+    ).result
+    kappa = run_ltc_stage(
+        phono3py_params=params, settings=ltc_settings, code=ltc_code, local=ltc_local
+    ).kappa
+    return {"phono3py_params": params, "kappa": kappa}
@@ -0,0 +1,207 @@
+"""
+Packing of many small VASP calculations into a single scheduler allocation
+
+The VASP inputs of K displaced supercells are written into one tar archive, which is
+unpacked and run by a bash script inside one job, either one after another or all at
+once. Only the vasprun.xml and the output of each calculation are kept, in a folder
+named after the displaced supercell together with the exit status of the run, so that
+each one is retrieved as its own FolderData.
+
+The packed calculations have no error handling of their own: a calculation that fails
+(see `is_packed_calculation_ok`) is meant to be run again as a `VaspWorkChain`.
+"""
+
+import io
+import tarfile
+import typing as t
+
+from aiida import orm
+
+# Settings of the packed calculations, for each order in the `packing` dictionary
+DEFAULT_PACKING_SETTINGS = {
+    # Number of calculations per allocation
+    "size": 1,
+    # Run the calculations of an allocation at the same time instead of one after another
+    "concurrent": False,
+    # Command running a single calculation, defaults to the mpirun command of the code
+    "run_command": None,
+}
+
+# Avoid writing large files that are not retrieved
+PACKED_INCAR_OVERRIDES = {"lwave": False, "lcharg": False}
+
+# File with the exit status of the run command in the folder of each calculation
+PACKED_STATUS_FILE = "exit_status"
+
+
+def _get_value(value):
+    """Return the python value of a node"""
+    if isinstance(value, orm.Dict):
+        return value.get_dict()
+    return getattr(value, "value", value)
+
+
+def chunk_keys(keys: t.Sequence[str], size: int) -> t.List[t.List[str]]:
+    """Split the keys into chunks of at most `size` items"""
+    size = max(1, int(size))
+    return [list(keys[i : i + size]) for i in range(0, len(keys), size)]
+
+
+def get_vasp_input_files(structure: orm.StructureData, inputs: dict) -> t.Dict[str, str]:
+    """
+    Write the INCAR, POSCAR, KPOINTS and POTCAR files of a VaspWorkChain input dictionary.
+    """
+    from aiida_vasp.data.potcar import PotcarData
+    from pymatgen.io.vasp import Incar, Poscar
+
+    incar = dict(_get_value(inputs["parameters"])["incar"])
+    incar.update(PACKED_INCAR_OVERRIDES)
+    poscar = Poscar(structure.get_pymatgen(), sort_structure=False)
+
+    potcars = PotcarData.get_potcars_dict(
+        elements=list(dict.fromkeys(poscar.site_symbols)),
+        family_name=_get_value(inputs["potential_family"]),
+        mapping=_get_value(inputs["potential_mapping"]),
+    )
+    potcar = ""
+    for symbol in poscar.site_symbols:
+        content = potcars[symbol].get_content()
+        potcar += content.decode() if isinstance(content, bytes) else content
+
+    return {
+        "INCAR": str(Incar({key.upper(): value for key, value in incar.items()})),
+        "POSCAR": str(poscar),
+        "KPOINTS": get_kpoints_file(inputs["kpoints"]),
+        "POTCAR": potcar,
+    }
+
+
+def get_kpoints_file(kpoints: orm.KpointsData) -> str:
+    """
+    The KPOINTS file of a mesh, with its offset, or of an explicit list of k-points.
+
+    The offset of a mesh is in units of the grid spacing, as the shift of a
+    Gamma-centred mesh in VASP.
+    """
+    try:
+        mesh, offset = kpoints.get_kpoints_mesh()
+    except AttributeError:
+        points, weights = kpoints.get_kpoints(also_weights=True, cartesian=False)
+        lines = ["Explicit k-points", str(len(points)), "Reciprocal"]
+        lines += [
+            " ".join(f"{value:.10f}" for value in point) + f" {weight:.10f}"
+            for point, weight in zip(points, weights)
+        ]
+        return "\n".join(lines) + "\n"
+    lines = [
+        "Automatic mesh",
+        "0",
+        "Gamma",
+        " ".join(str(int(value)) for value in mesh),
+        " ".join(f"{float(value):g}" for value in (offset or (0, 0, 0))),
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def pack_vasp_inputs(
+    structures: t.Dict[str, orm.StructureData], inputs: dict
+) -> orm.SinglefileData:
+    """Pack the VASP inputs of many structures into a tar archive, one folder each"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for key, structure in structures.items():
+            for name, content in get_vasp_input_files(structure, inputs).items():
+                data = content.encode()
+                info = tarfile.TarInfo(f"work_{key}/{name}")
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return orm.SinglefileData(buffer, filename="inputs.tar.gz")
+
+
+def get_run_command(code: orm.Code, options: dict, size: int, concurrent: bool):
+    """
+    Command running a single calculation with the mpirun command of the code.
+
+    In concurrent mode the MPI processes of the allocation are shared between the
+    calculations. The ``mpirun_extra_params`` of the options are passed on, and codes
+    that do not use MPI are run directly.
+    """
+    executable = code.get_executable()
+    if getattr(code, "with_mpi", None) is False or not options.get("withmpi", True):
+        return str(executable)
+    resources = options.get("resources", {})
+    nprocs = resources.get("tot_num_mpiprocs", 1)
+    if concurrent:
+        nprocs = max(1, nprocs // size)
+    mpirun = " ".join(code.computer.get_mpirun_command()).format(
+        tot_num_mpiprocs=nprocs,
+        num_machines=1,
+        num_mpiprocs_per_machine=nprocs,
+        num_cores_per_mpiproc=resources.get("num_cores_per_mpiproc", 1),
+        num_cores_per_machine=nprocs * resources.get("num_cores_per_mpiproc", 1),
+    )
+    extra = " ".join(str(value) for value in options.get("mpirun_extra_params", []))
+    return " ".join(part for part in (mpirun, extra, str(executable)) if part)
+
+
+def get_packed_script(
+    keys: t.Sequence[str],
+    run_command: str,
+    concurrent: bool = False,
+    prepend_text: t.Optional[str] = None,
+    append_text: t.Optional[str] = None,
+) -> orm.SinglefileData:
+    """
+    Bash script running the packed calculations.
+
+    A failed calculation does not stop the others. Its exit status is written to its
+    folder and it may have no vasprun.xml, see `is_packed_calculation_ok`.
+
+    :param prepend_text: The prepend text of the code, e.g. loading its modules.
+    :param append_text: The append text of the code.
+    """
+    lines = ["#!/bin/bash"]
+    if prepend_text:
+        lines.append(prepend_text)
+    lines += [
+        "tar xzf inputs.tar.gz",
+        "run_one() {",
+        '    (cd "work_$1" && { ' + run_command + "; } > vasp.out 2> vasp.err)",
+        "    local status=$?",
+        '    mkdir -p "$1"',
+        f'    echo "$status" > "$1/{PACKED_STATUS_FILE}"',
+        '    mv "work_$1/vasprun.xml" "$1/" 2> /dev/null',
+        '    mv "work_$1/vasp.out" "work_$1/vasp.err" "$1/" 2> /dev/null',
+        '    rm -rf "work_$1"',
+        "}",
+    ]
+    for key in keys:
+        lines.append(f"run_one {key}" + (" &" if concurrent else ""))
+    if concurrent:
+        lines.append("wait")
+    if append_text:
+        lines.append(append_text)
+    return orm.SinglefileData.from_string(
+        "\n".join(lines) + "\n", filename="run_packed.sh"
+    )
+
+
+def is_packed_calculation_ok(folder: orm.FolderData) -> bool:
+    """Whether a packed calculation exited successfully and wrote its vasprun.xml"""
+    names = folder.base.repository.list_object_names()
+    if "vasprun.xml" not in names:
+        return False
+    if PACKED_STATUS_FILE in names:
+        status = folder.base.repository.get_object_content(PACKED_STATUS_FILE)
+        return status.strip() == "0"
+    return True
+
+
+def get_packed_options(options: dict, size: int, concurrent: bool) -> dict:
+    """Scheduler options of a packed job, the wall time scales with sequential runs"""
+    options = dict(options)
+    options.pop("parser_name", None)
+    if not concurrent and "max_wallclock_seconds" in options:
+        options["max_wallclock_seconds"] = options["max_wallclock_seconds"] * size
+    return options
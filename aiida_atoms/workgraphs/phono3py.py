@@ -3,56 +3,394 @@ This is an example script to generate 2nd and 3rd order force constants using ph
 One will typically want to modify this script to fit their own needs, for example, customize the inputs and protocols for VASP calculations.
 """
 
-import click
+import copy
+import functools
+import hashlib
+import importlib
+import json
+import tempfile
 import typing as t
+from xml.etree import ElementTree
 
 from aiida_workgraph import task
 from aiida_workgraph import dynamic, namespace
 
-from aiida_vasp.workchains.v2.vasp import VaspWorkChain
-from aiida_vasp.workchains.v2.relax import VaspRelaxWorkChain
-from aiida_vasp.protocols.generator import VaspInputGenerator, VaspRelaxInputGenerator
-
 from aiida_workgraph import shelljob
 from aiida import orm
-from pymatgen.core import Structure
+from aiida.common.links import LinkType
+from aiida.engine import calcfunction
 from pathlib import Path
 import ase
+import numpy as np
+
+from ..arrays import read_array
+from ..resources import (
+    DEFAULT_RELAX_STEPS,
+    apply_resource_plan,
+    get_cluster_profile,
+    plan_vasp_inputs,
+)
+from ..reuse import find_finished_relaxation, get_structure_hash, get_vasp_inputs_key
+from .displacements import (
+    ORDERS,
+    DisplacementSet,
+    get_displacement_key,
+    get_displacement_keys,
+    get_displacement_vectors,
+    parse_displacement_folder,
+    parse_displacement_key,
+    set_displacement_arrays,
+)
+from .templates import (
+    find_displacement_template,
+    get_template_key,
+    mark_displacement_template,
+    set_template_arrays,
+)
+from .phono3py_batch import MATERIAL_ID_EXTRA
+from .packing import (
+    DEFAULT_PACKING_SETTINGS,
+    chunk_keys,
+    get_packed_options,
+    get_packed_script,
+    get_run_command,
+    is_packed_calculation_ok,
+    pack_vasp_inputs,
+)
+
+if t.TYPE_CHECKING:
+    from pymatgen.core import Structure
+
+# Workchains running the single point and relaxation calculations, given by their
+# import paths so that they can be passed to the graphs as the `workchains` argument
+VASP_WORKCHAINS = {
+    "vasp": "aiida_vasp.workchains.v2.vasp:VaspWorkChain",
+    "relax": "aiida_vasp.workchains.v2.relax:VaspRelaxWorkChain",
+}
+# The ASE-based stand-ins, e.g. for benchmarking
+MOCK_VASP_WORKCHAINS = {
+    "vasp": "aiida_atoms.mock.vasp:MockVaspWorkChain",
+    "relax": "aiida_atoms.mock.vasp:MockVaspRelaxWorkChain",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_workchain_task(path: str):
+    """The task of a workchain given by its import path"""
+    module, _, name = path.partition(":")
+    return task(getattr(importlib.import_module(module), name))
+
 
-VaspTask = task(VaspWorkChain)
-VaspRelaxTask = task(VaspRelaxWorkChain)
+def get_vasp_task(name: str, workchains: t.Optional[dict] = None):
+    """
+    The task of the ``vasp`` or ``relax`` workchain, see `VASP_WORKCHAINS`
+
+    :param workchains: Import paths replacing those of `VASP_WORKCHAINS`.
+    """
+    if hasattr(workchains, "get_dict"):
+        workchains = workchains.get_dict()
+    return _get_workchain_task({**VASP_WORKCHAINS, **(workchains or {})}[name])
 
 
 def parse_displacements(dirpath: Path):
     """
-    Parse the outputs from a folder after running phono3py -d command as StructureData and SingleFileData
+    Parse the outputs from a folder after running phono3py -d command as ArrayData and SingleFileData
     """
-    # Read the files are StructureData
-    outputs = {}
-    for file in Path(dirpath).glob("POSCAR*"):
-        structure = orm.StructureData(pymatgen=Structure.from_file(file))
-        outputs[file.stem.replace("-", "_")] = structure
+    import phono3py
+
+    ph3 = phono3py.load(
+        str(dirpath / "phono3py_disp.yaml"), produce_fc=False, log_level=0
+    )
+    # Random snapshots are stored with the displacements of all atoms
+    random = "displacements" in ph3.dataset
+    # Read the displaced supercells in parallel into a single node
+    outputs = {"displacements": parse_displacement_folder(dirpath, random=random)}
     # Save the phono3py_disp.yaml
     yaml_data = orm.SinglefileData(file=dirpath / "phono3py_disp.yaml")
     outputs["phono3py_disp"] = yaml_data
     return outputs
 
 
+def to_phonopy_atoms(atoms: ase.Atoms):
+    """Convert an ase.Atoms to a PhonopyAtoms"""
+    from phonopy.structure.atoms import PhonopyAtoms
+
+    return PhonopyAtoms(
+        symbols=atoms.get_chemical_symbols(),
+        cell=atoms.get_cell()[:],
+        scaled_positions=atoms.get_scaled_positions(),
+    )
+
+
+def build_phono3py(
+    atoms: ase.Atoms,
+    dim3: int = 2,
+    dim2: int = 4,
+    amplitude: float = 0.03,
+    cutoff_pair_distance: t.Optional[float] = None,
+    number_of_snapshots: t.Optional[int] = None,
+    random_seed: t.Optional[int] = None,
+):
+    """
+    Set up a Phono3py object and generate its displacements.
+
+    :param cutoff_pair_distance: Skip the FC3 displacement pairs further apart than this
+        distance (Å).
+    :param number_of_snapshots: Generate this number of supercells with random
+        displacements of all atoms for FC3 instead of the systematic pairs.
+    :param random_seed: Seed of the random displacements.
+    """
+    from phono3py import Phono3py
+
+    ph3 = Phono3py(
+        to_phonopy_atoms(atoms),
+        supercell_matrix=[dim3] * 3,
+        phonon_supercell_matrix=[dim2] * 3,
+        primitive_matrix="F",
+    )
+    ph3.generate_displacements(
+        distance=amplitude,
+        cutoff_pair_distance=cutoff_pair_distance,
+        number_of_snapshots=number_of_snapshots,
+        random_seed=random_seed,
+    )
+    ph3.generate_fc2_displacements(distance=amplitude)
+    return ph3
+
+
+def count_displacements(atoms: ase.Atoms, **kwargs) -> t.Dict[str, int]:
+    """
+    Return the number of FC3 and FC2 supercell calculations for the given settings.
+
+    Takes the same keyword arguments as `build_phono3py`, pairs skipped by the
+    cutoff distance are not counted.
+    """
+    ph3 = build_phono3py(atoms, **kwargs)
+    return {
+        "fc3": sum(
+            1 for cell in ph3.supercells_with_displacements if cell is not None
+        ),
+        "fc2": len(ph3.phonon_supercells_with_displacements),
+    }
+
+
+@calcfunction
+def generate_displacements_local(
+    structure: orm.StructureData,
+    dim3: orm.Int,
+    dim2: orm.Int,
+    amplitude: orm.Float,
+    cutoff_pair_distance: orm.Float = None,
+    number_of_snapshots: orm.Int = None,
+    random_seed: orm.Int = None,
+):
+    """
+    Generate the displacement structures with the phono3py API
+
+    The displaced supercells are stored in a single ArrayData in the same layout as
+    the one parsed from the files written by ``phono3py -d``, together with the
+    phono3py_disp.yaml file. The displacements are marked as the template of the
+    prototype of the structure (see `aiida_atoms.workgraphs.templates`).
+    """
+    settings = {
+        "dim3": dim3.value,
+        "dim2": dim2.value,
+        "amplitude": amplitude.value,
+        "cutoff_pair_distance": getattr(cutoff_pair_distance, "value", None),
+        "number_of_snapshots": getattr(number_of_snapshots, "value", None),
+        "random_seed": getattr(random_seed, "value", None),
+    }
+    atoms = structure.get_ase()
+    ph3 = build_phono3py(atoms, **settings)
+
+    displacements = orm.ArrayData()
+    for order, base, cells in (
+        ("fc3", ph3.supercell, ph3.supercells_with_displacements),
+        ("fc2", ph3.phonon_supercell, ph3.phonon_supercells_with_displacements),
+    ):
+        # Supercells skipped by the pair cutoff are returned as None
+        displaced = {
+            i: cell.scaled_positions
+            for i, cell in enumerate(cells, start=1)
+            if cell is not None
+        }
+        set_displacement_arrays(
+            displacements,
+            order,
+            base.cell,
+            base.scaled_positions,
+            base.numbers,
+            displaced,
+            total=len(cells),
+            random=order == "fc3" and settings["number_of_snapshots"] is not None,
+        )
+    mark_displacement_template(displacements, get_template_key(atoms, **settings))
+    outputs = {"displacements": displacements}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_disp.yaml"
+        ph3.save(str(yaml_path))
+        outputs["phono3py_disp"] = orm.SinglefileData(file=yaml_path)
+    return outputs
+
+
+GenerateDisplacementsTask = task(
+    outputs=namespace(displacements=t.Any, phono3py_disp=t.Any)
+)(generate_displacements_local)
+
+
+@calcfunction
+def instantiate_displacement_template(
+    structure: orm.StructureData,
+    template: orm.ArrayData,
+    template_disp: orm.SinglefileData,
+):
+    """
+    Make the displacements of a structure from the template of its prototype
+
+    The supercells of the structure are built with the supercell matrices of the
+    template, and the displacements of the template are used as they are, so only the
+    lattice constant and the species differ from the template.
+    """
+    import phono3py
+    from phono3py import Phono3py
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_disp.yaml"
+        yaml_path.write_bytes(template_disp.get_content(mode="rb"))
+        reference = phono3py.load(str(yaml_path), produce_fc=False, log_level=0)
+    ph3 = Phono3py(
+        to_phonopy_atoms(structure.get_ase()),
+        supercell_matrix=reference.supercell_matrix,
+        phonon_supercell_matrix=reference.phonon_supercell_matrix,
+        primitive_matrix="F",
+    )
+    ph3.dataset = reference.dataset
+    ph3.phonon_dataset = reference.phonon_dataset
+
+    displacements = orm.ArrayData()
+    for order, base in (("fc3", ph3.supercell), ("fc2", ph3.phonon_supercell)):
+        set_template_arrays(
+            displacements,
+            template,
+            order,
+            base.cell,
+            base.scaled_positions,
+            base.numbers,
+        )
+    outputs = {"displacements": displacements}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_disp.yaml"
+        ph3.save(str(yaml_path))
+        outputs["phono3py_disp"] = orm.SinglefileData(file=yaml_path)
+    return outputs
+
+
+InstantiateTemplateTask = task(
+    outputs=namespace(displacements=t.Any, phono3py_disp=t.Any)
+)(instantiate_displacement_template)
+
+
 @task.graph
 def generate_displacements(
-    code: orm.Code,
+    code: t.Optional[orm.Code],
     structure: orm.StructureData,
     dim3: int = 2,
     dim2: int = 4,
     amplitude: float = 0.03,
+    cutoff_pair_distance: t.Optional[float] = None,
+    number_of_snapshots: t.Optional[int] = None,
+    random_seed: t.Optional[int] = None,
+    use_template: bool = True,
 ) -> t.Annotated[
     dict,
     namespace(phono3py_out=dynamic(t.Any)),
 ]:
     """
     Returns the displacement structures generated by phono3py.
+
+    The displacements are generated with the phono3py API in a calcfunction task if
+    `code` is None, otherwise the command line interface of the phono3py code is run
+    as a shell job.
+    The number of FC3 calculations can be reduced with a pair cutoff distance or by
+    using a number of randomly displaced supercells (snapshots) instead.
+
+    If `use_template` is set and the displacements of a structure of the same prototype
+    have been generated in-process before (without a phono3py code), they are rescaled
+    and substituted instead of being generated again (see
+    `aiida_atoms.workgraphs.templates`).
     """
+    # Deserialize if needed
+    (
+        dim3,
+        dim2,
+        amplitude,
+        cutoff_pair_distance,
+        number_of_snapshots,
+        random_seed,
+    ) = (
+        getattr(value, "value", value)
+        for value in (
+            dim3,
+            dim2,
+            amplitude,
+            cutoff_pair_distance,
+            number_of_snapshots,
+            random_seed,
+        )
+    )
+    if getattr(use_template, "value", use_template):
+        atoms = structure if isinstance(structure, ase.Atoms) else structure.get_ase()
+        key = get_template_key(
+            atoms,
+            dim3=dim3,
+            dim2=dim2,
+            amplitude=amplitude,
+            cutoff_pair_distance=cutoff_pair_distance,
+            number_of_snapshots=number_of_snapshots,
+            random_seed=random_seed,
+        )
+        template = find_displacement_template(key) if key is not None else None
+        if template is not None:
+            if isinstance(structure, ase.Atoms):
+                structure = orm.StructureData(ase=structure)
+            return {
+                "phono3py_out": InstantiateTemplateTask(
+                    structure=structure,
+                    template=template["displacements"],
+                    template_disp=template["phono3py_disp"],
+                )
+            }
+    if code is None:
+        if isinstance(structure, ase.Atoms):
+            structure = orm.StructureData(ase=structure)
+        options = {}
+        if cutoff_pair_distance is not None:
+            options["cutoff_pair_distance"] = orm.Float(cutoff_pair_distance)
+        if number_of_snapshots is not None:
+            options["number_of_snapshots"] = orm.Int(number_of_snapshots)
+        if random_seed is not None:
+            options["random_seed"] = orm.Int(random_seed)
+        return {
+            "phono3py_out": GenerateDisplacementsTask(
+                structure=structure,
+                dim3=orm.Int(dim3),
+                dim2=orm.Int(dim2),
+                amplitude=orm.Float(amplitude),
+                **options,
+            )
+        }
+
+    extra_arguments = []
+    if cutoff_pair_distance is not None:
+        extra_arguments += ["--cutoff-pair", str(cutoff_pair_distance)]
+    if number_of_snapshots is not None:
+        extra_arguments += ["--rd", str(number_of_snapshots)]
+    if random_seed is not None:
+        extra_arguments += ["--random-seed", str(random_seed)]
+
     if isinstance(structure, ase.Atoms):
+        from pymatgen.core import Structure
+
         structure = Structure.from_ase_atoms(structure)
     elif isinstance(structure, orm.StructureData):
         structure = structure.get_pymatgen()
@@ -78,14 +416,15 @@ def generate_displacements(
             str(amplitude),
             "--pa",
             "F",
-        ],
+        ]
+        + extra_arguments,
         nodes={
             "poscar_node": poscar_node,
         },
         parser=parse_displacements,
         metadata={
             "options": {
-                "additional_retrieve": ["POSCAR*", "*.yaml"],
+                "additional_retrieve": ["POSCAR*", "SPOSCAR*", "*.yaml"],
                 "prepend_text": "conda deactivate\nconda deactivate\nunset PYTHONPATH\nenv",
             }
         },
@@ -93,24 +432,142 @@ def generate_displacements(
     return {"phono3py_out": out}
 
 
-def get_inputs_relax(structure, kind, mp_id, protocol="balanced@phonondb"):
+# Protocol-resolved inputs keyed by the stage, the protocol, the elements and the number
+# of sites, shared by all materials built in the same process
+_INPUT_TEMPLATES = {}
+
+
+def _copy_inputs(inputs):
+    """Copy the nested input dictionaries and other values, the nodes are shared"""
+    if isinstance(inputs, orm.Data):
+        return inputs
+    if isinstance(inputs, dict):
+        return {key: _copy_inputs(value) for key, value in inputs.items()}
+    return copy.deepcopy(inputs)
+
+
+def get_cached_inputs(stage: str, structure, protocol: str, factory, label: str):
+    """
+    Return the inputs of a calculation from a cached template.
+
+    The template is built by ``factory(structure)`` the first time a stage, protocol,
+    set of elements and number of sites is seen. Later calls get a copy of the template
+    with the structure and the label replaced, only the input nodes are shared.
+    """
+    key = (
+        stage,
+        protocol,
+        tuple(sorted(structure.get_symbols_set())),
+        len(structure.sites),
+    )
+    if key not in _INPUT_TEMPLATES:
+        _INPUT_TEMPLATES[key] = factory(structure)
+    inputs = _copy_inputs(_INPUT_TEMPLATES[key])
+    inputs.setdefault("metadata", {})["label"] = label
+    inputs["structure"] = structure
+    return inputs
+
+
+# Resource plans keyed by everything the plan depends on (see `_get_plan_key`), shared
+# by the displaced structures of a material
+_RESOURCE_PLANS = {}
+
+
+def _get_plan_key(stage: str, inputs: dict, steps: int, profile) -> tuple:
+    """
+    Key of a resource plan: the structure apart from its positions, the k-points, the
+    input parameters and options, and the cluster profile with its calibration.
+    """
+    vasp = inputs["vasp"] if "vasp" in inputs else inputs
+    structure = inputs["structure"]
+
+    def identify(value):
+        if isinstance(value, orm.Node):
+            return value.uuid
+        return json.dumps(value, sort_keys=True, default=str)
+
+    return (
+        stage,
+        steps,
+        tuple(sorted(structure.get_symbols_set())),
+        len(structure.sites),
+        tuple(np.round(np.array(structure.cell), 4).ravel()),
+        identify(vasp.get("kpoints", vasp.get("kpoints_spacing", None))),
+        identify(vasp["parameters"]),
+        identify(vasp["options"]),
+        profile,
+    )
+
+
+def get_planned_inputs(stage: str, inputs: dict, steps: int = 1):
+    """
+    Return the inputs with the resources, wallclock, NCORE and KPAR planned from the
+    size of the structure (see `aiida_atoms.resources`).
+
+    The plan is made once for structures that only differ by their positions, so the
+    displaced structures share the same option and parameter nodes. A new calibration
+    of the cluster profile gives a new plan.
+    """
+    vasp = inputs["vasp"] if "vasp" in inputs else inputs
+    profile = get_cluster_profile(vasp["code"].computer)
+    key = _get_plan_key(stage, inputs, steps, profile)
+    if key not in _RESOURCE_PLANS:
+        plan = plan_vasp_inputs(inputs, steps=steps, profile=profile)
+        _RESOURCE_PLANS[key] = apply_resource_plan(inputs, plan)
+    planned = _RESOURCE_PLANS[key]
+    inputs = dict(inputs)
+    for name in ("vasp", "options", "parameters"):
+        if name in planned:
+            inputs[name] = planned[name]
+    return inputs
+
+
+def get_inputs_relax(
+    structure, kind, mp_id, protocol="balanced@phonondb", auto_resources=True
+):
     """
     Get builder for the initial geometry optimisation calculation
+
+    The resources are planned from the structure if `auto_resources` is set, otherwise
+    the fixed resources of the template are used.
     """
-    upd = VaspRelaxInputGenerator(protocol)
-    upd.get_builder(
-        structure,
-        options={
-            "max_wallclock_seconds": 3600 * 8,
-            "resources": {"tot_num_mpiprocs": 4, "num_machines": 1},
-        },
-        code="vasp-6.5.0-std@catapult",
+
+    def build(structure):
+        from aiida_vasp.protocols.generator import VaspRelaxInputGenerator
+
+        upd = VaspRelaxInputGenerator(protocol)
+        upd.get_builder(
+            structure,
+            options={
+                "max_wallclock_seconds": 3600 * 8,
+                "resources": {"tot_num_mpiprocs": 4, "num_machines": 1},
+            },
+            code="vasp-6.5.0-std@catapult",
+        )
+        upd.set_incar(algo="all")
+        upd.set_relax_settings(force_cutoff=0.001)
+        upd.set_kspacing(0.03)
+        return upd.builder._inputs(prune=True)
+
+    inputs = get_cached_inputs(
+        "relax", structure, protocol, build, f"{kind} {mp_id} PhononDB RELAX PBE_54"
     )
-    upd.set_label(f"{kind} {mp_id} PhononDB RELAX PBE_54")
-    upd.set_incar(algo="all")
-    upd.set_relax_settings(force_cutoff=0.001)
-    upd.set_kspacing(0.03)
-    return upd.builder._inputs(prune=True)
+    if auto_resources:
+        inputs = get_planned_inputs("relax", inputs, steps=DEFAULT_RELAX_STEPS)
+    return inputs
+
+
+def find_relaxed_structure(structure: orm.StructureData, inputs: dict):
+    """
+    Return the relaxed structure of an earlier relaxation with the same inputs, if any
+
+    Unstored structures are matched by the hash of their content, the inputs of the
+    ``vasp`` namespace and the relaxation settings as in `find_finished_relaxation`.
+    """
+    node = find_finished_relaxation(structure, inputs["vasp"], inputs["relax_settings"])
+    if node is None:
+        return None
+    return node.outputs.relax.structure
 
 
 second_order_overrides = {
@@ -132,23 +589,17 @@ third_order_overrides = {
 }
 
 
-@task.graph
-def launch_second_third_order_calculations(
-    disp_out: t.Annotated[dict, dynamic(t.Any)],
-    kind: str,
-) -> t.Annotated[dict, namespace(calc_retrieved=dynamic(t.Any))]:
+def get_inputs_second_order(
+    structure, kind, fname, protocol="balanced@phonondb", auto_resources=True
+):
     """
-    Launch second and third order calculations
+    Get builder for second order force constants calculations
     NOTE: you may want to define your own input settings for VASP calculations here
     """
-    # Deserialize if needed
-    if hasattr(kind, "value"):
-        kind = kind.value
 
-    def get_inputs_second_order(structure, kind, fname, protocol="balanced@phonondb"):
-        """
-        Get builder for second order force constants calculations
-        """
+    def build(structure):
+        from aiida_vasp.protocols.generator import VaspInputGenerator
+
         upd = VaspInputGenerator()
         upd.get_builder(
             structure,
@@ -169,14 +620,24 @@ def launch_second_third_order_calculations(
             },
         )
         upd.set_kpoints_mesh((1, 1, 1))  # For RS and ZB use gamma only
-        upd.set_label(f"{kind} {fname}")
         del upd.builder.magmom_mapping
         return upd.builder._inputs(prune=True)
 
-    def get_inputs_third_order(structure, kind, fname, protocol="balanced@phonondb"):
-        """
-        Get builder for third order force constants calculations
-        """
+    inputs = get_cached_inputs("fc2", structure, protocol, build, f"{kind} {fname}")
+    return get_planned_inputs("fc2", inputs) if auto_resources else inputs
+
+
+def get_inputs_third_order(
+    structure, kind, fname, protocol="balanced@phonondb", auto_resources=True
+):
+    """
+    Get builder for third order force constants calculations
+    NOTE: you may want to define your own input settings for VASP calculations here
+    """
+
+    def build(structure):
+        from aiida_vasp.protocols.generator import VaspInputGenerator
+
         upd = VaspInputGenerator()
         upd.get_builder(
             structure,
@@ -190,29 +651,496 @@ def launch_second_third_order_calculations(
             },
         )
         upd.set_kpoints_mesh((2, 2, 2))  # Gamma-centred 222 grid
-        upd.set_label(f"{kind} {fname}")
-        # upd.set_label(f'{kind} {fname}')
         del upd.builder.magmom_mapping
         return upd.builder._inputs(prune=True)
 
+    inputs = get_cached_inputs("fc3", structure, protocol, build, f"{kind} {fname}")
+    return get_planned_inputs("fc3", inputs) if auto_resources else inputs
+
+
+# Inputs of the calculations of each order
+DISPLACEMENT_INPUTS = {"fc2": get_inputs_second_order, "fc3": get_inputs_third_order}
+
+
+@task.graph
+def launch_second_third_order_calculations(
+    disp_out: t.Annotated[dict, dynamic(t.Any)],
+    kind: str,
+    packing: t.Optional[dict] = None,
+    with_fc2_preview: bool = True,
+    auto_resources: bool = True,
+    workchains: t.Optional[dict] = None,
+) -> t.Annotated[
+    dict, namespace(calc_retrieved=dynamic(t.Any), fc2_preview=t.Any)
+]:
+    """
+    Launch second and third order calculations
+
+    The `packing` settings, e.g. ``{"fc2": {"size": 20, "concurrent": False}}``, run the
+    calculations of an order in packs of ``size`` per scheduler allocation (see
+    `aiida_atoms.workgraphs.packing`). Each calculation still has its own retrieved folder,
+    and the calculations that fail in a pack are run again as a `VaspWorkChain`.
+
+    The forces of each calculation are extracted into a checkpoint node as soon as it
+    finishes, which are returned in place of the retrieved folders. When rerun, only the
+    displacements without checkpointed forces are calculated. A preview of the FC2 is
+    computed once all FC2 forces are available if `with_fc2_preview` is set.
+
+    The resources, wallclock, NCORE and KPAR are planned from the size of the supercells
+    if `auto_resources` is set (see `aiida_atoms.resources`). The `workchains` replace
+    the import paths of `VASP_WORKCHAINS`.
+    """
+    # Deserialize if needed
+    if hasattr(kind, "value"):
+        kind = kind.value
+    if hasattr(packing, "get_dict"):
+        packing = packing.get_dict()
+    if hasattr(with_fc2_preview, "value"):
+        with_fc2_preview = with_fc2_preview.value
+    if hasattr(auto_resources, "value"):
+        auto_resources = auto_resources.value
+    if hasattr(workchains, "get_dict"):
+        workchains = workchains.get_dict()
+    packing = {
+        order: {**DEFAULT_PACKING_SETTINGS, **settings}
+        for order, settings in (packing or {}).items()
+    }
+
+    def launch_packed(keys, structures, inputs, settings):
+        """
+        Launch the calculations of the keys packed in a single shell job
+        """
+        options = inputs["options"]
+        options = options.get_dict() if hasattr(options, "get_dict") else options
+        code = inputs["code"]
+        run_command = settings["run_command"] or get_run_command(
+            code, options, len(keys), settings["concurrent"]
+        )
+        out = shelljob(
+            command="bash",
+            arguments=["run_packed.sh"],
+            nodes={
+                "inputs": pack_vasp_inputs(
+                    {key: structures[key] for key in keys}, inputs
+                ),
+                "script": get_packed_script(
+                    keys,
+                    run_command,
+                    settings["concurrent"],
+                    prepend_text=code.prepend_text,
+                    append_text=code.append_text,
+                ),
+            },
+            outputs=list(keys),
+            metadata={
+                "computer": code.computer,
+                "label": f"{kind} {keys[0]}-{keys[-1]}",
+                "options": get_packed_options(
+                    options, len(keys), settings["concurrent"]
+                ),
+            },
+        )
+        return {key: getattr(out, key) for key in keys}
+
+    displacements = disp_out["displacements"]
+    order_keys = {"fc2": [], "fc3": []}
+    for key in get_displacement_keys(displacements):
+        order_keys["fc2" if "POSCAR_FC2" in key else "fc3"].append(key)
+
+    displacement_set = DisplacementSet(displacements)
     calc_retrieved = {}
-    second_order_inputs = None
-    third_order_inputs = None
-    for key, value in disp_out.items():
-        if "POSCAR_FC2" in key:
-            if second_order_inputs is None:
-                second_order_inputs = get_inputs_second_order(value, kind, key)
-            second_order_inputs["structure"] = value
-            second_order_inputs["metadata"]["label"] = f"{kind} {key}"
-            calc_retrieved[key] = VaspTask(**second_order_inputs).retrieved
-        # Third order calculations
-        elif "POSCAR_" in key:
-            if third_order_inputs is None:
-                third_order_inputs = get_inputs_third_order(value, kind, key)
-            third_order_inputs["structure"] = value
-            third_order_inputs["metadata"]["label"] = f"{kind} {key}"
-            calc_retrieved[key] = VaspTask(**third_order_inputs).retrieved
-    return {"calc_retrieved": calc_retrieved}
+    outputs = {"calc_retrieved": calc_retrieved}
+    for order, get_inputs in DISPLACEMENT_INPUTS.items():
+        keys = order_keys[order]
+        if not keys:
+            continue
+        # Only materialize the structures when their calculations are submitted
+        structures = {key: displacement_set.materialize(key) for key in keys}
+        # The inputs generated for the first structure are shared by all calculations
+        inputs = get_inputs(
+            structures[keys[0]], kind, keys[0], auto_resources=auto_resources
+        )
+
+        # Reuse the forces checkpointed by an earlier run, only launch the missing ones
+        checkpoint_keys = {
+            key: get_checkpoint_key(structure, inputs)
+            for key, structure in structures.items()
+        }
+        # Recorded for `get_partial_phono3py_param` while the calculations are running
+        displacements.base.extras.set(f"{order}_checkpoint_keys", checkpoint_keys)
+        checkpointed = find_checkpointed_forces(checkpoint_keys.values())
+        missing = []
+        for key in keys:
+            if checkpoint_keys[key] in checkpointed:
+                calc_retrieved[key] = checkpointed[checkpoint_keys[key]]
+            else:
+                missing.append(key)
+
+        retrieved = {}
+        if packing.get(order, {}).get("size", 1) > 1:
+            for chunk in chunk_keys(missing, packing[order]["size"]):
+                folders = launch_packed(chunk, structures, inputs, packing[order])
+                # Failed calculations of a pack are run again on their own
+                for key, folder in folders.items():
+                    calc_retrieved[key] = checkpoint_packed_calculation(
+                        folder=folder,
+                        structure=structures[key],
+                        order=order,
+                        kind=kind,
+                        key=key,
+                        checkpoint_key=checkpoint_keys[key],
+                        auto_resources=auto_resources,
+                        workchains=workchains,
+                    ).result
+        else:
+            for key in missing:
+                inputs["structure"] = structures[key]
+                inputs["metadata"]["label"] = f"{kind} {key}"
+                retrieved[key] = get_vasp_task("vasp", workchains)(**inputs).retrieved
+
+        # Checkpoint the forces of each calculation as soon as it finishes
+        for key, folder in retrieved.items():
+            calc_retrieved[key] = ExtractForcesTask(
+                retrieved=folder, checkpoint_key=orm.Str(checkpoint_keys[key])
+            ).result
+
+        if order == "fc2" and with_fc2_preview:
+            # Runs as soon as the FC2 set is complete, without waiting for FC3
+            outputs["fc2_preview"] = PreviewFC2Task(
+                phono3py_disp=disp_out["phono3py_disp"],
+                displacements=displacements,
+                **{key: calc_retrieved[key] for key in keys},
+            ).result
+    return outputs
+
+
+def parse_vasprun_forces(handle):
+    """
+    Stream the forces and the energy of the last ionic step from a vasprun.xml file.
+
+    Elements are discarded as soon as they have been processed, so at most one ionic step
+    is held in memory regardless of the size of the file.
+    """
+    forces = None
+    energy = None
+    tags = []
+    for event, elem in ElementTree.iterparse(handle, events=("start", "end")):
+        if event == "start":
+            tags.append(elem.tag)
+            continue
+        tags.pop()
+        if (
+            elem.tag == "varray"
+            and elem.get("name") == "forces"
+            and tags[-1:] == ["calculation"]
+        ):
+            forces = np.array([v.text.split() for v in elem], dtype=float)
+        elif (
+            elem.tag == "i"
+            and elem.get("name") == "e_fr_energy"
+            and tags[-2:] == ["calculation", "energy"]
+        ):
+            energy = float(elem.text)
+        if len(tags) <= 2:
+            # Children of the root and of each ionic step are no longer needed
+            elem.clear()
+    if forces is None:
+        raise ValueError("No forces found in the vasprun.xml file")
+    return forces, energy
+
+
+def format_forces_file(
+    file_ids: np.ndarray,
+    forces: np.ndarray,
+    total: int,
+    vectors: t.Optional[np.ndarray] = None,
+):
+    """
+    Format the forces in the FORCES_FC3/FORCES_FC2 format of phono3py.
+
+    Supercells not included in the calculations, e.g. those skipped by the pair cutoff,
+    are written with zero forces so that the entries line up with the displacement dataset.
+    If the displacement vectors of all atoms are given, e.g. for random displacements,
+    the type-2 format with the displacements and forces on each line is written.
+    """
+    forces_by_id = dict(zip(file_ids.tolist(), forces))
+    zeros = np.zeros(forces.shape[1:])
+    lines = []
+    for file_id in range(1, total + 1):
+        lines.append(f"# File: {file_id}")
+        force = forces_by_id.get(file_id, zeros)
+        if vectors is None:
+            rows = force
+        else:
+            rows = np.hstack([vectors[file_id - 1], force])
+        for row in rows:
+            lines.append(" ".join("%15.10f" % value for value in row))
+    return "\n".join(lines) + "\n"
+
+
+def get_displacement_forces(node: t.Union[orm.ArrayData, orm.FolderData]):
+    """Return the forces and energy of a checkpoint node or a retrieved folder"""
+    if isinstance(node, orm.ArrayData):
+        return read_array(node, "forces"), node.base.attributes.get("energy", None)
+    with node.base.repository.open("vasprun.xml", mode="rb") as handle:
+        return parse_vasprun_forces(handle)
+
+
+def get_checkpoint_key(structure: orm.StructureData, inputs: dict):
+    """
+    Key identifying the forces of a displaced structure calculated with given inputs
+
+    The structure is identified by the hash of its content and the inputs by
+    `get_vasp_inputs_key`: the parameters, k-points, potentials and code. The
+    parallelisation tags, e.g. NCORE and KPAR, do not change the forces and are left
+    out, so the forces are reused when the resources are planned differently.
+    """
+    content = json.dumps(
+        {"structure": get_structure_hash(structure), **get_vasp_inputs_key(inputs)},
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def find_checkpointed_forces(checkpoint_keys: t.Iterable[str]):
+    """Return the checkpointed forces of the given keys from earlier runs"""
+    checkpoint_keys = list(checkpoint_keys)
+    if not checkpoint_keys:
+        return {}
+    query = orm.QueryBuilder()
+    query.append(
+        orm.ArrayData,
+        filters={"attributes.checkpoint_key": {"in": checkpoint_keys}},
+        project=["attributes.checkpoint_key", "*"],
+    )
+    return dict(query.all())
+
+
+@calcfunction
+def extract_displacement_forces(retrieved: orm.FolderData, checkpoint_key: orm.Str):
+    """
+    Extract the forces and energy of a displacement calculation into a checkpoint node
+    """
+    with retrieved.base.repository.open("vasprun.xml", mode="rb") as handle:
+        forces, energy = parse_vasprun_forces(handle)
+    node = orm.ArrayData()
+    node.set_array("forces", forces)
+    node.base.attributes.set("energy", energy)
+    node.base.attributes.set("checkpoint_key", checkpoint_key.value)
+    return node
+
+
+@calcfunction
+def preview_fc2(
+    phono3py_disp: orm.SinglefileData, displacements: orm.ArrayData, **forces
+):
+    """
+    Compute the second order force constants from the FC2 forces alone
+
+    This gives a preview of the harmonic properties before the FC3 calculations finish.
+    """
+    import phono3py
+
+    total = displacements.base.attributes.get("fc2_total")
+    natoms = len(read_array(displacements, "fc2_numbers"))
+    phonon_forces = np.zeros((total, natoms, 3))
+    for key, node in forces.items():
+        phonon_forces[int(key.split("_")[-1]) - 1] = get_displacement_forces(node)[0]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_disp.yaml"
+        yaml_path.write_bytes(phono3py_disp.get_content(mode="rb"))
+        ph3 = phono3py.load(str(yaml_path), produce_fc=False, log_level=0)
+    ph3.phonon_forces = phonon_forces
+    ph3.produce_fc2(symmetrize_fc2=True)
+    node = orm.ArrayData()
+    node.set_array("fc2", ph3.fc2)
+    return node
+
+
+ExtractForcesTask = task(extract_displacement_forces)
+PreviewFC2Task = task(preview_fc2)
+
+
+@task.graph
+def checkpoint_packed_calculation(
+    folder: orm.FolderData,
+    structure: orm.StructureData,
+    order: str,
+    kind: str,
+    key: str,
+    checkpoint_key: str,
+    auto_resources: bool = True,
+    workchains: t.Optional[dict] = None,
+) -> t.Annotated[dict, namespace(result=t.Any)]:
+    """
+    Checkpoint the forces of a packed calculation
+
+    A calculation that failed in the pack is run again as a `VaspWorkChain`, with its
+    error handlers and restarts, before its forces are checkpointed.
+    """
+    # Deserialize if needed
+    order, kind, key, checkpoint_key, auto_resources = (
+        getattr(value, "value", value)
+        for value in (order, kind, key, checkpoint_key, auto_resources)
+    )
+    if not is_packed_calculation_ok(folder):
+        inputs = DISPLACEMENT_INPUTS[order](
+            structure, kind, key, auto_resources=auto_resources
+        )
+        folder = get_vasp_task("vasp", workchains)(**inputs).retrieved
+    return {
+        "result": ExtractForcesTask(
+            retrieved=folder, checkpoint_key=orm.Str(checkpoint_key)
+        ).result
+    }
+
+
+@calcfunction
+def collect_displacement_forces(displacements: orm.ArrayData, **retrieved):
+    """
+    Collect the forces of the displacement calculations into compact outputs
+
+    The forces and energies are taken from the checkpoints of each calculation or streamed
+    from the vasprun.xml of each retrieved folder, keyed as POSCAR_00001 or
+    POSCAR_FC2_00001, and stored in a single ArrayData together
+    with the FORCES_FC3 and FORCES_FC2 files read by phono3py. The displacement set gives
+    the total number of supercells and whether the displacements are random.
+    """
+    collected = {"fc3": {}, "fc2": {}}
+    for key, node in retrieved.items():
+        if not key.startswith("POSCAR"):
+            continue
+        collected["fc2" if "FC2" in key else "fc3"][int(key.split("_")[-1])] = (
+            get_displacement_forces(node)
+        )
+
+    forces_node = orm.ArrayData()
+    outputs = {"forces": forces_node}
+    for order, results in collected.items():
+        if not results:
+            continue
+        file_ids = np.array(sorted(results), dtype=int)
+        forces = np.array([results[file_id][0] for file_id in file_ids])
+        energies = np.array(
+            [
+                np.nan if results[file_id][1] is None else results[file_id][1]
+                for file_id in file_ids
+            ]
+        )
+        forces_node.set_array(f"{order}_ids", file_ids)
+        forces_node.set_array(f"{order}_forces", forces)
+        forces_node.set_array(f"{order}_energies", energies)
+        total = displacements.base.attributes.get(
+            f"{order}_total", int(file_ids.max())
+        )
+        vectors = None
+        if displacements.base.attributes.get(f"{order}_random", False):
+            vectors = get_displacement_vectors(displacements, order, total)
+        outputs[f"forces_{order}"] = orm.SinglefileData.from_string(
+            format_forces_file(file_ids, forces, total, vectors),
+            filename=f"FORCES_{order.upper()}",
+        )
+    return outputs
+
+
+CollectForcesTask = task(
+    outputs=namespace(forces=t.Any, forces_fc3=t.Any, forces_fc2=t.Any)
+)(collect_displacement_forces)
+
+
+@calcfunction
+def generate_partial_phono3py_param(
+    phono3py_disp: orm.SinglefileData, displacements: orm.ArrayData, **forces
+):
+    """
+    Write the phono3py_params.yaml of the forces calculated so far
+
+    All FC2 forces are needed. Random FC3 snapshots without forces are left out of the
+    dataset, while systematic FC3 displacements must all have their forces.
+    """
+    import phono3py
+
+    collected = {order: {} for order in ORDERS}
+    for key, node in forces.items():
+        order, file_id = parse_displacement_key(key)
+        collected[order][file_id] = get_displacement_forces(node)[0]
+    random = displacements.base.attributes.get("fc3_random", False)
+    for order in ORDERS:
+        missing = [
+            get_displacement_key(order, file_id)
+            for file_id in read_array(displacements, f"{order}_ids").tolist()
+            if file_id not in collected[order]
+        ]
+        if missing and (order == "fc2" or not random):
+            raise ValueError(f"The forces of {len(missing)} supercells are missing")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_disp.yaml"
+        yaml_path.write_bytes(phono3py_disp.get_content(mode="rb"))
+        ph3 = phono3py.load(str(yaml_path), produce_fc=False, log_level=0)
+
+    for order in ORDERS:
+        total = displacements.base.attributes.get(f"{order}_total")
+        natoms = len(read_array(displacements, f"{order}_numbers"))
+        if order == "fc3" and random:
+            done = sorted(collected[order])
+            ph3.dataset = {
+                "displacements": np.asarray(ph3.dataset["displacements"])[
+                    np.array(done, dtype=int) - 1
+                ],
+                "forces": np.array([collected[order][file_id] for file_id in done]),
+            }
+            continue
+        # Supercells skipped by the pair cutoff have zero forces
+        order_forces = np.zeros((total, natoms, 3))
+        for file_id, value in collected[order].items():
+            order_forces[file_id - 1] = value
+        if order == "fc2":
+            ph3.phonon_forces = order_forces
+        else:
+            ph3.forces = order_forces
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yaml_path = Path(tmpdir) / "phono3py_params.yaml"
+        ph3.save(str(yaml_path))
+        return orm.SinglefileData(file=yaml_path)
+
+
+def find_displacement_outputs(process: orm.ProcessNode):
+    """The displacements and the phono3py_disp.yaml generated in a workflow"""
+    for node in process.called_descendants:
+        outputs = {
+            link.link_label: link.node
+            for link in node.base.links.get_outgoing(link_type=LinkType.CREATE).all()
+        }
+        if "displacements" in outputs and "phono3py_disp" in outputs:
+            return outputs["displacements"], outputs["phono3py_disp"]
+    raise ValueError(f"No displacements have been generated by {process}")
+
+
+def get_partial_phono3py_param(process: orm.ProcessNode) -> orm.SinglefileData:
+    """
+    Write the phono3py_params.yaml of a workflow from the forces checkpointed so far.
+
+    This does not wait for straggling displacement calculations, e.g. to compute the
+    thermal conductivity from the random snapshots that have finished. The forces are
+    found through the checkpoint keys recorded on the displacements, so forces reused
+    from earlier runs are included.
+    """
+    displacements, phono3py_disp = find_displacement_outputs(process)
+    forces = {}
+    for order in ORDERS:
+        checkpoint_keys = displacements.base.extras.get(f"{order}_checkpoint_keys", {})
+        found = find_checkpointed_forces(checkpoint_keys.values())
+        forces.update(
+            {
+                key: found[checkpoint_key]
+                for key, checkpoint_key in checkpoint_keys.items()
+                if checkpoint_key in found
+            }
+        )
+    return generate_partial_phono3py_param(phono3py_disp, displacements, **forces)
 
 
 @task.graph
@@ -221,39 +1149,25 @@ def generate_phono3py_param(
     code: orm.Code,
     disps: t.Annotated[dict, dynamic(t.Any)],
 ) -> t.Annotated[dict, namespace(phono3py_out=t.Any)]:
-    """Generate phono3py parameters with phono3py_disp.yaml and calculations results as inputs"""
-    # Write the vasprun.xml files
-    # Run phono3py commandline
-
-    arguments_fc3 = [
-        "--cf3",
-    ]
-    arguments_fc2 = [
-        "--cf2",
-    ]
+    """
+    Generate phono3py parameters with phono3py_disp.yaml and calculations results as inputs
+
+    The results can be the checkpointed forces (ArrayData) or the retrieved folders.
+    """
+    # Collect the forces into the FORCES_FC3 and FORCES_FC2 files instead of copying
+    # every vasprun.xml to the phono3py calculation, as a task run by the scheduler
+    forces = CollectForcesTask(displacements=disps["displacements"], **retrieved)
     files = {
         "phono3py_disp": disps["phono3py_disp"]
     }  # Include the phono3py_disp.yaml file in the submission folder
-    # Include the vasprun.xml files as POSCAR-00000.xml and POSCAR_FC2-000.xml
-    for key, value in retrieved.items():
-        if key.startswith("POSCAR"):
-            node = orm.SinglefileData.from_string(
-                value.get_object_content("vasprun.xml"), filename=key + ".xml"
-            )
-            files[key] = node
-            if "FC2" in key:
-                arguments_fc2.append(key + ".xml")
-            else:
-                arguments_fc3.append(key + ".xml")
-    # Sort the arguments in the order of POSCAR_00001.xml, POSCAR_00002.xml etc
-    arguments_fc3 = arguments_fc3[:1] + sorted(arguments_fc3[1:])
-    arguments_fc2 = arguments_fc2[:1] + sorted(arguments_fc2[1:])
-    # Run the shell job
+    orders = {"fc2" if "FC2" in key else "fc3" for key in retrieved}
+    for order in ("fc3", "fc2"):
+        if order in orders:
+            files[f"FORCES_{order.upper()}"] = getattr(forces, f"forces_{order}")
+    # Run the shell job, the FORCES files are read together with phono3py_disp.yaml
     out = shelljob(
         command=code,
-        arguments=arguments_fc2
-        + arguments_fc3
-        + ["--sp", "--fc-symmetry", "--pa", "F"],
+        arguments=["--sp", "--fc-symmetry", "--pa", "F"],
         nodes=files,
         outputs=[
             "phono3py_params.yaml"
@@ -274,24 +1188,48 @@ def run_phono3py_rs_zb(
     kind: str,
     mp_id: str,
     phono3py_code: orm.Code,
+    cutoff_pair_distance: t.Optional[float] = None,
+    number_of_snapshots: t.Optional[int] = None,
+    random_seed: t.Optional[int] = None,
+    packing: t.Optional[dict] = None,
+    auto_resources: bool = True,
+    workchains: t.Optional[dict] = None,
 ):
     """
     Run phono3py calculation for rocksalt or zincblende structures
 
     Returns a SingleFileData node of the phono3py_params.yaml file which contains the force constants needed to run LTC calculation
+
+    The pair cutoff distance and the number of random snapshots are passed to
+    `generate_displacements` to reduce the number of FC3 calculations. The `packing`
+    settings of each order are passed to `launch_second_third_order_calculations`.
+    The resources of the VASP calculations are planned from the size of the structures
+    if `auto_resources` is set. The `workchains` replace the import paths of
+    `VASP_WORKCHAINS`, e.g. `MOCK_VASP_WORKCHAINS` to run the ASE-based stand-ins.
     """
 
-    # Perform relaxation
-    relaxed = VaspRelaxTask(
-        **get_inputs_relax(initial_structure, kind, mp_id)
-    ).relax.structure
-    # Generate displacement
+    # Perform relaxation, unless the structure has been relaxed with the same inputs
+    relax_inputs = get_inputs_relax(
+        initial_structure, kind, mp_id, auto_resources=auto_resources
+    )
+    relaxed = find_relaxed_structure(initial_structure, relax_inputs)
+    if relaxed is None:
+        relaxed = get_vasp_task("relax", workchains)(**relax_inputs).relax.structure
+    # Generate displacement with the phono3py API
     gen_disps = generate_displacements(
-        structure=relaxed, code=phono3py_code
+        code=None,
+        structure=relaxed,
+        cutoff_pair_distance=cutoff_pair_distance,
+        number_of_snapshots=number_of_snapshots,
+        random_seed=random_seed,
     ).phono3py_out  # Make gen_disps an output of a task instead of a graph
     # Launch calculations in parallel
     retrieved = launch_second_third_order_calculations(
-        disp_out=gen_disps, kind=kind
+        disp_out=gen_disps,
+        kind=kind,
+        packing=packing,
+        auto_resources=auto_resources,
+        workchains=workchains,
     ).calc_retrieved
     # Generate phono3py_param.yaml
     return generate_phono3py_param(
@@ -299,28 +1237,77 @@ def run_phono3py_rs_zb(
     ).phono3py_out
 
 
-@click.command()
-@click.argument("material_id")
-@click.argument("structure_file", type=click.Path(exists=True))
-@click.argument("phono3py_code")
-@click.option("--max-concurrent", default=50, help="Maximum number of concurrent jobs")
-def main(structure_file, material_id, phono3py_code, max_concurrent=50):
+def get_process_label(formula: str, material_id: str):
+    """Label of the WorkGraph of a material"""
+    return formula + " " + material_id + " FC23"
+
+
+def get_packing_settings(pack_fc2=1, pack_fc3=1, pack_concurrent=False):
+    """Packing settings from the command line options"""
+    return {
+        order: {"size": size, "concurrent": pack_concurrent}
+        for order, size in (("fc2", pack_fc2), ("fc3", pack_fc3))
+        if size > 1
+    }
+
+
+def submit_phono3py(
+    structure: "Structure",
+    material_id: str,
+    phono3py_code: orm.Code,
+    max_concurrent: int = 50,
+    ltc_settings: t.Optional[dict] = None,
+    ltc_code: t.Optional[orm.Code] = None,
+    **kwargs,
+):
     """
-    Launch a workflow to generate 2nd and 3rd order force constants using phono3py for a given structure file.
+    Submit the WorkGraph of a material, the keyword arguments are passed to `run_phono3py_rs_zb`
+
+    The thermal conductivity is computed after the force constants as a job of
+    `ltc_code` if `ltc_settings` are given.
     """
-    structure = Structure.from_file(structure_file)
     formula = structure.composition.reduced_formula
-    wg = run_phono3py_rs_zb.build(
+    graph = run_phono3py_rs_zb
+    if ltc_settings is not None:
+        from .ltc import run_phono3py_ltc
+
+        if ltc_code is None:
+            raise ValueError("The thermal conductivity of a submitted run needs a code")
+        graph = run_phono3py_ltc
+        kwargs.update(ltc_settings=ltc_settings, ltc_code=ltc_code)
+    wg = graph.build(
         orm.StructureData(pymatgen=structure),
         formula,
         material_id,
-        phono3py_code=orm.load_code(phono3py_code),
+        phono3py_code=phono3py_code,
+        **kwargs,
     )
     wg.max_number_jobs = max_concurrent  # Limit the concurrent tasks
     process = wg.submit()
-    process.label = formula + " " + material_id + " FC23"
+    process.label = get_process_label(formula, material_id)
+    process.base.extras.set(MATERIAL_ID_EXTRA, material_id)
     return process
 
 
+def main():
+    """
+    Run the ``phono3py`` command of `aiida_atoms.workgraphs.cli`
+
+    Kept for running this module as a script, use ``aiida-atoms phono3py`` instead. The
+    cli module is imported here as it imports this module when its commands run.
+    """
+    import warnings
+
+    from .cli import phono3py_command
+
+    warnings.warn(
+        "Running aiida_atoms.workgraphs.phono3py as a script is deprecated, "
+        "use `aiida-atoms phono3py` instead",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    return phono3py_command()  # pylint: disable=no-value-for-parameter
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,144 @@
+"""
+Batch submission of phono3py WorkGraphs for many materials.
+
+The materials are read from a directory of structure files (the file stem is used as the
+material ID) or from a CSV file with the ``material_id`` and ``structure_file`` columns.
+The WorkGraphs are admitted one by one under a global cap on the number of concurrent
+VASP jobs, counted across the whole database, instead of only limiting the jobs of each
+WorkGraph. Materials with a finished or running WorkGraph, found by the material ID in
+its extras or by its label, are skipped.
+"""
+
+import csv
+import typing as t
+from pathlib import Path
+
+from aiida import orm
+
+# Process types of the calculations counted against the global cap
+JOB_PROCESS_TYPES = (
+    "aiida.calculations:vasp.vasp",
+    "aiida.calculations:core.shell",
+)
+ACTIVE_STATES = ("created", "waiting", "running")
+# Extras key of the material ID of a submitted WorkGraph
+MATERIAL_ID_EXTRA = "material_id"
+
+
+def read_materials(source: Path) -> t.List[t.Tuple[str, Path]]:
+    """
+    Return the material IDs and structure files from a directory or a CSV file.
+    """
+    source = Path(source)
+    if source.is_dir():
+        return [
+            (path.stem, path)
+            for path in sorted(source.iterdir())
+            if path.is_file() and not path.name.startswith(".")
+        ]
+    with open(source, newline="") as handle:
+        return [
+            (row["material_id"], source.parent / row["structure_file"])
+            for row in csv.DictReader(handle)
+        ]
+
+
+def _get_job_filters() -> dict:
+    """Filters of the active VASP jobs"""
+    return {
+        "process_type": {"in": list(JOB_PROCESS_TYPES)},
+        "attributes.process_state": {"in": list(ACTIVE_STATES)},
+    }
+
+
+def get_job_statistics() -> t.Dict[str, int]:
+    """
+    Count the active VASP jobs in the database by their scheduler state.
+    """
+    query = orm.QueryBuilder()
+    query.append(
+        orm.CalcJobNode,
+        filters=_get_job_filters(),
+        project=["attributes.scheduler_state"],
+    )
+    stats = {"active": 0, "queued": 0, "running": 0}
+    for (state,) in query.iterall():
+        stats["active"] += 1
+        if state in ("queued", "running"):
+            stats[state] += 1
+    return stats
+
+
+def count_active_jobs(process: orm.ProcessNode) -> int:
+    """Count the active VASP jobs launched by a workflow"""
+    query = orm.QueryBuilder()
+    query.append(orm.WorkflowNode, filters={"id": process.pk}, tag="workflow")
+    query.append(
+        orm.CalcJobNode, with_ancestors="workflow", filters=_get_job_filters()
+    )
+    return query.count()
+
+
+def get_existing_processes(
+    materials: t.Iterable[t.Tuple[str, str]],
+) -> t.Dict[str, orm.ProcessNode]:
+    """
+    Return the processes of materials that finished successfully or are active.
+
+    :param materials: The material IDs and the labels of their WorkGraphs.
+    :returns: The processes keyed by material ID.
+    """
+    labels = dict(materials)
+    material_ids = {label: material_id for material_id, label in labels.items()}
+    query = orm.QueryBuilder()
+    query.append(
+        orm.WorkflowNode,
+        filters={
+            "or": [
+                {f"extras.{MATERIAL_ID_EXTRA}": {"in": list(labels)}},
+                {"label": {"in": list(material_ids)}},
+            ]
+        },
+        project=["label", f"extras.{MATERIAL_ID_EXTRA}", "*"],
+    )
+    existing = {}
+    for label, material_id, node in query.iterall():
+        material_id = material_id if material_id in labels else material_ids[label]
+        if node.is_finished_ok or not node.is_terminated:
+            existing[material_id] = node
+    return existing
+
+
+class AdmissionController:
+    """
+    Decide when the next WorkGraph can be submitted under the global job cap.
+
+    Each WorkGraph can run up to `per_material` jobs at once. Every submitted WorkGraph
+    that has not terminated reserves the part of its share that it is not using yet,
+    since it may launch more jobs at any time.
+    """
+
+    def __init__(self, max_jobs: int, per_material: int):
+        self.max_jobs = max_jobs
+        self.per_material = per_material
+        self.submitted: t.List[int] = []
+
+    def reserved(self) -> int:
+        """Number of jobs reserved for the unused share of the submitted WorkGraphs"""
+        # Reload the nodes to see the state changes made by the daemon
+        nodes = [orm.load_node(pk) for pk in self.submitted]
+        nodes = [node for node in nodes if not node.is_terminated]
+        self.submitted = [node.pk for node in nodes]
+        return sum(
+            max(0, self.per_material - count_active_jobs(node)) for node in nodes
+        )
+
+    def can_submit(self, active_jobs: int) -> bool:
+        """Whether another WorkGraph can be submitted"""
+        return active_jobs + self.reserved() + self.per_material <= max(
+            self.max_jobs, self.per_material
+        )
+
+    def record(self, process: orm.ProcessNode):
+        """Record a submission"""
+        self.submitted.append(process.pk)
@@ -0,0 +1,168 @@
+"""
+Displacement templates shared by the materials of the same prototype
+
+Materials of the same prototype, e.g. rocksalt compounds given in the same conventional
+cell, differ only by their lattice constant and species. Their displacement datasets are
+identical in Cartesian coordinates, since phono3py picks the displacements from the
+symmetry and uses the same amplitude in Å. The displacements generated for the first
+material are marked as a template with the prototype key in their extras, and the
+displacements of later materials are made from the template by rescaling the supercells
+and substituting the species (see
+`aiida_atoms.workgraphs.phono3py.instantiate_displacement_template`).
+
+The prototype key covers the cell shape, the fractional positions and the pattern of
+the species in the order of the sites, the space group and the displacement settings.
+Displacements with a pair cutoff distance (in Å, so the pairs depend on the lattice
+constant) and unseeded random snapshots are never shared.
+"""
+
+import hashlib
+import json
+import typing as t
+
+import ase
+import numpy as np
+
+from aiida import orm
+from aiida.common.exceptions import NotExistent
+
+from ..arrays import read_array
+
+TEMPLATE_VERSION = 1
+EXTRAS_KEY = "displacement_template"
+# Decimals of the normalised cell and the fractional positions in the key
+KEY_DECIMALS = 4
+
+# Templates found in this process, keyed by the prototype key
+_TEMPLATES = {}
+
+
+def get_species_pattern(numbers: t.Sequence[int]) -> t.List[int]:
+    """The index of the species of each site in the order of first appearance"""
+    species = {}
+    return [species.setdefault(int(number), len(species)) for number in numbers]
+
+
+def _round(values) -> list:
+    """Rounded values without negative zeros"""
+    return (np.round(np.asarray(values, dtype=float), KEY_DECIMALS) + 0.0).tolist()
+
+
+def get_template_key(
+    atoms: ase.Atoms,
+    dim3: int,
+    dim2: int,
+    amplitude: float,
+    cutoff_pair_distance: t.Optional[float] = None,
+    number_of_snapshots: t.Optional[int] = None,
+    random_seed: t.Optional[int] = None,
+) -> t.Optional[str]:
+    """
+    The prototype key of the displacements of a structure.
+
+    :returns: The key or None if the displacements cannot be shared.
+    """
+    if cutoff_pair_distance is not None:
+        return None
+    if number_of_snapshots is not None and random_seed is None:
+        return None
+    cell = np.asarray(atoms.cell[:])
+    scale = abs(np.linalg.det(cell)) ** (1 / 3)
+    positions = np.round(atoms.get_scaled_positions() % 1, KEY_DECIMALS) % 1
+    try:
+        import spglib
+
+        spacegroup = spglib.get_symmetry_dataset(
+            (cell, atoms.get_scaled_positions(), atoms.numbers)
+        )
+        spacegroup = int(getattr(spacegroup, "number", None) or spacegroup["number"])
+    except (ImportError, TypeError):
+        spacegroup = None
+    payload = {
+        "version": TEMPLATE_VERSION,
+        "spacegroup": spacegroup,
+        "cell": _round(cell / scale),
+        "positions": _round(positions),
+        "species": get_species_pattern(atoms.numbers),
+        "dim3": int(dim3),
+        "dim2": int(dim2),
+        "amplitude": round(float(amplitude), 6),
+        "number_of_snapshots": number_of_snapshots,
+        "random_seed": random_seed,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def find_displacement_template(key: str) -> t.Optional[t.Dict[str, orm.Data]]:
+    """
+    The displacements and the phono3py_disp.yaml of the template of a prototype key.
+
+    :returns: A dictionary with the ``displacements`` and ``phono3py_disp`` nodes of the
+        earliest template, or None if there is no template yet.
+    """
+    if key in _TEMPLATES:
+        try:
+            return {name: orm.load_node(pk) for name, pk in _TEMPLATES[key].items()}
+        except NotExistent:
+            # The template has been deleted since, look for another one
+            del _TEMPLATES[key]
+    query = orm.QueryBuilder()
+    query.append(
+        orm.ArrayData,
+        filters={f"extras.{EXTRAS_KEY}": key},
+        project="id",
+        tag="displacements",
+    )
+    query.append(orm.ProcessNode, with_outgoing="displacements", tag="creator")
+    query.append(
+        orm.SinglefileData,
+        with_incoming="creator",
+        edge_filters={"label": "phono3py_disp"},
+        project="id",
+    )
+    query.order_by({"displacements": {"ctime": "asc"}}).limit(1)
+    row = query.first()
+    if row is None:
+        return None
+    _TEMPLATES[key] = {"displacements": row[0], "phono3py_disp": row[1]}
+    return {name: orm.load_node(pk) for name, pk in _TEMPLATES[key].items()}
+
+
+def mark_displacement_template(displacements: orm.ArrayData, key: t.Optional[str]):
+    """Mark the displacements of a structure as the template of its prototype"""
+    if key is not None:
+        displacements.base.extras.set(EXTRAS_KEY, key)
+
+
+def set_template_arrays(
+    node: orm.ArrayData,
+    template: orm.ArrayData,
+    order: str,
+    cell: np.ndarray,
+    positions: np.ndarray,
+    numbers: np.ndarray,
+):
+    """
+    Store the displaced supercells of a template for another base supercell.
+
+    The displaced atoms and the displacement vectors (Cartesian, Å) are those of the
+    template, the base supercell is replaced.
+
+    :param cell: The cell of the base supercell.
+    :param positions: The fractional positions of the base supercell.
+    :param numbers: The atomic numbers of the base supercell.
+    """
+    cell = np.asarray(cell, dtype=float)
+    if len(numbers) != len(read_array(template, f"{order}_numbers")):
+        raise ValueError(f"The {order} supercell does not match {template}")
+    node.set_array(f"{order}_cell", cell)
+    node.set_array(f"{order}_positions", np.asarray(positions, dtype=float) @ cell)
+    node.set_array(f"{order}_numbers", np.asarray(numbers, dtype=int))
+    for name in ("ids", "offsets", "atoms", "vectors"):
+        array = np.array(read_array(template, f"{order}_{name}"))
+        node.set_array(f"{order}_{name}", array)
+    for name in ("count", "total", "random"):
+        node.base.attributes.set(
+            f"{order}_{name}", template.base.attributes.get(f"{order}_{name}")
+        )
+
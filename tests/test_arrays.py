@@ -0,0 +1,66 @@
+"""
+Test reading arrays without loading them into memory
+"""
+
+import io
+
+import numpy as np
+
+from aiida import orm
+
+from aiida_atoms import arrays
+from aiida_atoms.arrays import (
+    iter_array_chunks,
+    read_array,
+    read_array_slice,
+    read_npy_header,
+)
+
+
+def test_read_npy_header():
+    """The header length points at the start of the data"""
+    array = np.arange(24.0).reshape(4, 3, 2)
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    buffer.seek(0)
+    shape, fortran_order, dtype, header_length = read_npy_header(buffer)
+    assert shape == (4, 3, 2)
+    assert not fortran_order
+    data = np.frombuffer(buffer.getvalue()[header_length:], dtype=dtype)
+    assert np.array_equal(data.reshape(shape), array)
+
+
+def test_read_array(clear_database):  # pylint: disable=unused-argument
+    """Stored and unstored arrays are read in full, in slices and in chunks"""
+    array = np.random.default_rng(0).random((10, 4, 3))
+    node = orm.ArrayData()
+    node.set_array("forces", array)
+    assert np.array_equal(read_array(node, "forces"), array)
+
+    node.store()
+    assert np.array_equal(read_array(node, "forces"), array)
+    assert np.array_equal(read_array(node, "forces", mmap=False), array)
+    assert np.array_equal(read_array_slice(node, "forces", slice(2, 9, 3)), array[2:9:3])
+    assert np.array_equal(read_array_slice(node, "forces", -1), array[-1])
+    chunks = list(iter_array_chunks(node, "forces", chunk_size=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert np.array_equal(np.concatenate(chunks), array)
+
+
+def test_read_array_stream(
+    clear_database, monkeypatch
+):  # pylint: disable=unused-argument
+    """Without a location on disk the rows are read from the file stream"""
+    array = np.random.default_rng(0).random((10, 4, 3))
+    node = orm.ArrayData()
+    node.set_array("forces", array)
+    node.set_array("fortran", np.asfortranarray(array))
+    node.store()
+    # E.g. another repository backend or other disk-objectstore internals
+    monkeypatch.setattr(arrays, "get_array_location", lambda node, name: None)
+
+    for index in (slice(2, 9, 3), slice(None, None, -2), slice(5, 2), 0, -1):
+        assert np.array_equal(read_array_slice(node, "forces", index), array[index])
+        assert np.array_equal(read_array_slice(node, "fortran", index), array[index])
+    chunks = list(iter_array_chunks(node, "forces", chunk_size=4))
+    assert np.array_equal(np.concatenate(chunks), array)
@@ -0,0 +1,87 @@
+"""
+Test the compact storage of displacement structures
+"""
+
+from ase.build import bulk
+import numpy as np
+import pytest
+
+from aiida import orm
+
+from aiida_atoms.workgraphs.displacements import (
+    DisplacementSet,
+    get_displacement_keys,
+    materialize_displacement,
+    parse_displacement_folder,
+    set_displacement_arrays,
+)
+from aiida_atoms.workgraphs.phono3py import generate_displacements_local
+
+
+def test_displacement_roundtrip(tmp_path):
+    """Parse POSCAR files into a single node and rebuild the displaced supercells"""
+    base = bulk("MgO", "rocksalt", a=4.2, cubic=True).repeat(2)
+    base.write(tmp_path / "SPOSCAR", format="vasp")
+
+    rng = np.random.default_rng(0)
+    expected = {}
+    for file_id in (1, 2, 4):
+        displaced = base.copy()
+        # Include an atom wrapped across the cell boundary
+        displaced.positions[file_id] += rng.normal(scale=0.03, size=3)
+        displaced.positions[0] -= [0.01, 0.0, 0.0]
+        displaced.write(tmp_path / f"POSCAR-{file_id:05d}", format="vasp", direct=True)
+        expected[f"POSCAR_{file_id:05d}"] = displaced.positions
+
+    node = parse_displacement_folder(tmp_path)
+    assert get_displacement_keys(node) == list(expected)
+    assert node.get_array("fc3_offsets").tolist() == [0, 2, 4, 6]
+    for key, positions in expected.items():
+        structure = materialize_displacement(node, key).get_ase()
+        assert np.allclose(structure.positions, positions, atol=1e-6)
+        assert (structure.numbers == base.numbers).all()
+
+    displacement_set = DisplacementSet(node)
+    for key, positions in expected.items():
+        structure = displacement_set.materialize(key).get_ase()
+        assert np.allclose(structure.positions, positions, atol=1e-6)
+    with pytest.raises(KeyError):
+        displacement_set.materialize("POSCAR_00003")
+
+
+def test_random_attribute():
+    """Random snapshots are marked as given, whatever the number of moved atoms"""
+    base = bulk("MgO", "rocksalt", a=4.2, cubic=True)
+    displaced = base.get_scaled_positions()
+    displaced[0] += 0.01
+    node = orm.ArrayData()
+    for order, random in (("fc3", True), ("fc2", False)):
+        set_displacement_arrays(
+            node,
+            order,
+            base.cell,
+            base.get_scaled_positions(),
+            base.numbers,
+            {1: displaced},
+            random=random,
+        )
+        assert node.base.attributes.get(f"{order}_random") is random
+
+
+@pytest.mark.parametrize("snapshots", [None, 2])
+def test_generated_random_attribute(
+    clear_database, snapshots
+):  # pylint: disable=unused-argument
+    """The generated FC3 supercells are random if snapshots are asked for"""
+    structure = orm.StructureData(ase=bulk("MgO", "rocksalt", a=4.2, cubic=True))
+    outputs = generate_displacements_local(
+        structure,
+        orm.Int(1),
+        orm.Int(1),
+        orm.Float(0.03),
+        number_of_snapshots=None if snapshots is None else orm.Int(snapshots),
+        random_seed=orm.Int(1),
+    )
+    attributes = outputs["displacements"].base.attributes
+    assert attributes.get("fc3_random") is (snapshots is not None)
+    assert attributes.get("fc2_random") is False
@@ -0,0 +1,148 @@
+"""
+Test the helper functions of the elastic workflow
+"""
+
+import numpy as np
+from pymatgen.analysis.elasticity import DeformedStructureSet, ElasticTensor, Strain
+from pymatgen.core import Lattice, Structure
+
+from aiida import orm
+
+from aiida_atoms.workflows.elastic import (
+    fit_elastic_tensor,
+    fit_elastic_tensor_arrays,
+    get_strain_levels,
+    is_fit_converged,
+    materialize_deformed_structure,
+)
+
+
+class MiscStub:  # pylint: disable=too-few-public-methods
+    """Stand-in for the `misc` output of a relaxation"""
+
+    def __init__(self, stress):
+        self.stress = stress
+
+    def get_dict(self):
+        """Return the content in the same format as the `misc` output"""
+        return {"stress": self.stress}
+
+
+def get_deformations():
+    """Deformations of a cubic cell without symmetry reduction"""
+    structure = Structure(
+        Lattice.cubic(4.0), ["Mg", "O"], [[0, 0, 0], [0.5, 0.5, 0.5]]
+    )
+    deformed = DeformedStructureSet(
+        structure,
+        norm_strains=[-0.01, -0.005, 0.005, 0.01],
+        shear_strains=[-0.06, -0.03, 0.03, 0.06],
+        symmetry=False,
+    )
+    return np.array(deformed.deformations)
+
+
+def get_miscs(deformations, voigt):
+    """Generate `misc` outputs with linear elastic stresses in kBar with the VASP sign convention"""
+    miscs = {}
+    for i, deformation in enumerate(deformations):
+        strain = Strain.from_deformation(deformation)
+        stress_voigt = voigt @ strain.voigt
+        stress = np.zeros((3, 3))
+        for (row, col), value in zip(
+            [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)], stress_voigt
+        ):
+            stress[row, col] = stress[col, row] = value
+        miscs[f"workchain_deformed_structure_{i}"] = MiscStub(
+            (-stress * 10).tolist()
+        )
+    return miscs
+
+
+def test_strain_levels():
+    """Test ranking the deformations by the strain magnitudes"""
+    levels = get_strain_levels(get_deformations())
+    assert len(levels) == 24
+    assert np.bincount(levels).tolist() == [12, 12]
+
+
+def test_fit_elastic_tensor():
+    """Test fitting the elastic tensor to linear elastic stresses"""
+    voigt = np.zeros((6, 6))
+    voigt[:3, :3] = 100.0
+    voigt[np.arange(3), np.arange(3)] = 250.0
+    voigt[np.arange(3, 6), np.arange(3, 6)] = 80.0
+
+    deformations = get_deformations()
+    fitted, diagnostics = fit_elastic_tensor(
+        deformations, **get_miscs(deformations, voigt)
+    )
+    assert np.allclose(fitted, voigt)
+    assert diagnostics["residuals"].shape == (24, 6)
+    assert diagnostics["rms_residual"] < 1e-8
+    assert diagnostics["rank"] == 21
+    assert np.isfinite(diagnostics["condition_number"])
+
+
+def test_first_level_converged():
+    """The fit of the smallest strains alone converges if the stresses are linear"""
+    voigt = np.diag([250.0] * 3 + [80.0] * 3)
+    deformations = get_deformations()
+    levels = get_strain_levels(deformations)
+    miscs = {
+        key: misc
+        for key, misc in get_miscs(deformations, voigt).items()
+        if levels[int(key.split("_")[-1])] == 0
+    }
+    fitted, diagnostics = fit_elastic_tensor(deformations, **miscs)
+    fit = {
+        "elastic_tensor": fitted.tolist(),
+        "residual": diagnostics["rms_residual"],
+        "max_change": float("nan"),
+        "rank": diagnostics["rank"],
+    }
+    assert is_fit_converged([fit], 0.5)
+    assert not is_fit_converged([{**fit, "residual": 1.0}], 0.5)
+    assert not is_fit_converged([{**fit, "rank": 15}], 0.5)
+    assert is_fit_converged([fit, {**fit, "max_change": 0.1}], 0.5)
+    assert not is_fit_converged([fit, {**fit, "max_change": 1.0}], 0.5)
+
+
+def test_fit_elastic_tensor_arrays():
+    """Test the least-squares fit against pymatgen's finite difference fit"""
+    rng = np.random.default_rng(0)
+    voigt = rng.uniform(-20, 20, (6, 6))
+    voigt = voigt + voigt.T + np.diag([300.0] * 3 + [100.0] * 3)
+
+    deformations = get_deformations()
+    strains = np.array([Strain.from_deformation(d) for d in deformations])
+    stresses = np.array(
+        [ElasticTensor.from_voigt(voigt).calculate_stress(s) for s in strains]
+    )
+    fitted, _ = fit_elastic_tensor_arrays(strains, stresses)
+    reference = ElasticTensor.from_diff_fit(list(strains), list(stresses)).voigt
+    assert np.allclose(fitted, reference, atol=1e-6)
+
+
+def test_materialize_deformed_structure(
+    clear_database,
+):  # pylint: disable=unused-argument
+    """The compact deformed structures are materialized with provenance"""
+    deformations = get_deformations()[:2]
+    cell = 4.0 * np.eye(3)
+    trajectory = orm.TrajectoryData()
+    trajectory.set_trajectory(
+        symbols=["Mg", "O"],
+        positions=np.array([[[0, 0, 0], [2.0, 2.0, 2.0]]] * 2),
+        cells=np.array([cell @ deformation.T for deformation in deformations]),
+    )
+    trajectory.store()
+
+    unstored = materialize_deformed_structure(trajectory, 1, store=False)
+    assert not unstored.is_stored
+    structure = materialize_deformed_structure(trajectory, 1)
+    assert structure.is_stored
+    assert np.allclose(structure.cell, unstored.cell)
+    creator = structure.creator
+    assert creator.inputs.trajectory.pk == trajectory.pk
+    assert creator.inputs.index.value == 1
@@ -0,0 +1,44 @@
+"""
+Test the derived elastic properties
+"""
+
+import numpy as np
+
+from aiida_atoms.elastic_analysis import compute_elastic_properties
+
+
+def isotropic_tensor(lame_lambda, lame_mu):
+    """Elastic tensor of an isotropic material in Voigt notation"""
+    voigt = np.zeros((6, 6))
+    voigt[:3, :3] = lame_lambda
+    voigt[np.arange(3), np.arange(3)] = lame_lambda + 2 * lame_mu
+    voigt[np.arange(3, 6), np.arange(3, 6)] = lame_mu
+    return voigt
+
+
+def test_isotropic_properties():
+    """The Voigt and Reuss bounds coincide for isotropic materials"""
+    lame = np.array([[50.0, 30.0], [100.0, 80.0]])
+    voigt = np.stack([isotropic_tensor(*pair) for pair in lame])
+    properties = compute_elastic_properties(voigt)
+
+    bulk = lame[:, 0] + 2 * lame[:, 1] / 3
+    shear = lame[:, 1]
+    for name in ("bulk_modulus_voigt", "bulk_modulus_reuss", "bulk_modulus_vrh"):
+        assert np.allclose(properties[name], bulk)
+    for name in ("shear_modulus_voigt", "shear_modulus_reuss", "shear_modulus_vrh"):
+        assert np.allclose(properties[name], shear)
+    assert np.allclose(
+        properties["poisson_ratio"], lame[:, 0] / (2 * (lame[:, 0] + lame[:, 1]))
+    )
+    assert np.allclose(properties["universal_anisotropy"], 0)
+    assert properties["is_stable"].all()
+
+
+def test_unstable_tensor():
+    """A tensor with a negative shear component violates the Born criteria"""
+    voigt = isotropic_tensor(50.0, 30.0)
+    voigt[3, 3] = -10.0
+    properties = compute_elastic_properties(voigt)
+    assert properties["min_eigenvalue"].shape == (1,)
+    assert not properties["is_stable"][0]
@@ -0,0 +1,59 @@
+"""
+Test the streaming export of structures
+"""
+
+from ase.build import bulk
+from ase.io import read
+import numpy as np
+import pytest
+
+from aiida import orm
+
+from aiida_atoms.export import export_structures
+
+
+def make_group(label, count):
+    """A group with rattled copper cells"""
+    group = orm.Group(label=label).store()
+    add_structures(group, count)
+    return group
+
+
+def add_structures(group, count):
+    """Add rattled copper cells to a group"""
+    nodes = []
+    for i in range(count):
+        atoms = bulk("Cu", cubic=True)
+        atoms.rattle(0.01, seed=i)
+        nodes.append(orm.StructureData(ase=atoms).store())
+    group.add_nodes(nodes)
+
+
+def test_export_extxyz_resume(clear_database, tmp_path):  # pylint: disable=unused-argument
+    """The export is written in pages and continues with new structures"""
+    group = make_group("export-extxyz", 3)
+    path = str(tmp_path / "structures.xyz")
+    assert export_structures(path, group=group, page_size=2) == 3
+    assert len(read(path, ":")) == 3
+
+    add_structures(group, 2)
+    assert export_structures(path, group=group, page_size=2) == 2
+    images = read(path, ":")
+    assert len(images) == 5
+    ids = [image.info["node_id"] for image in images]
+    assert ids == sorted(ids)
+
+
+def test_export_hdf5(clear_database, tmp_path):  # pylint: disable=unused-argument
+    """The per-atom arrays are concatenated and indexed by the number of atoms"""
+    h5py = pytest.importorskip("h5py")
+    group = make_group("export-hdf5", 3)
+    path = str(tmp_path / "structures.h5")
+    assert export_structures(path, group=group, page_size=2) == 3
+    assert export_structures(path, group=group, page_size=2) == 0
+
+    with h5py.File(path, "r") as handle:
+        assert handle.attrs["count"] == 3
+        assert list(handle["natoms"][:]) == [4, 4, 4]
+        assert handle["positions"].shape == (12, 3)
+        assert np.isnan(handle["energy"][:]).all()
@@ -0,0 +1,77 @@
+"""
+Test the structure fingerprints
+"""
+
+from ase.build import bulk
+import numpy as np
+
+from aiida import orm
+
+from aiida_atoms.fingerprint import (
+    compute_fingerprint,
+    find_equivalent_structures,
+    get_rdf_descriptor,
+    match_atoms,
+    store_fingerprint,
+)
+
+
+def get_variant(atoms, seed=0):
+    """Permuted, shifted and slightly rattled copy of the atoms"""
+    rng = np.random.default_rng(seed)
+    variant = atoms[rng.permutation(len(atoms))]
+    variant.translate([0.3, 0.1, 0.2])
+    variant.wrap()
+    variant.rattle(1e-3, seed=seed)
+    return variant
+
+
+def test_descriptor_invariance():
+    """The descriptor does not depend on the permutation, origin or supercell"""
+    atoms = bulk("MgO", "rocksalt", 4.2, cubic=True)
+    reference = get_rdf_descriptor(atoms)
+    assert np.allclose(get_rdf_descriptor(get_variant(atoms)), reference, atol=0.05)
+    assert np.allclose(get_rdf_descriptor(atoms.repeat((2, 1, 1))), reference)
+    assert compute_fingerprint(atoms)["formula"] == "MgO"
+
+
+def test_match_atoms():
+    """Equivalent structures match, different ones do not"""
+    atoms = bulk("MgO", "rocksalt", 4.2, cubic=True)
+    matched, rms = match_atoms(atoms, get_variant(atoms))
+    assert matched
+    assert rms < 0.01
+    assert not match_atoms(atoms, bulk("MgO", "rocksalt", 4.4, cubic=True))[0]
+    swapped = atoms.copy()
+    swapped.numbers[[0, 1]] = swapped.numbers[[1, 0]]
+    assert not match_atoms(atoms, swapped)[0]
+
+
+def test_find_equivalent_structures(clear_database):  # pylint: disable=unused-argument
+    """Stored structures are found by the fingerprint lookup"""
+    atoms = bulk("MgO", "rocksalt", 4.2, cubic=True)
+    node = orm.StructureData(ase=atoms).store()
+    store_fingerprint(node)
+    other = orm.StructureData(ase=bulk("MgO", "rocksalt", 4.6, cubic=True)).store()
+    store_fingerprint(other)
+
+    results = find_equivalent_structures(get_variant(atoms))
+    assert [result.pk for result, _ in results] == [node.pk]
+    # The loose space group of the rattled structure is the same
+    results = find_equivalent_structures(get_variant(atoms), verify=False)
+    assert [result.pk for result, _ in results] == [node.pk]
+
+
+def test_candidate_ids_fallback(clear_database):  # pylint: disable=unused-argument
+    """The SQL lookup is only used with PostgreSQL, the QueryBuilder otherwise"""
+    from aiida.manage import get_manager
+
+    from aiida_atoms.fingerprint import explain_candidate_query, find_candidate_ids
+
+    storage = get_manager().get_profile_storage()
+    ids = find_candidate_ids("MgO|8", 0.0, 100.0)
+    if "psql" in type(storage).__module__:
+        assert ids == []
+        assert explain_candidate_query()
+    else:
+        assert ids is None
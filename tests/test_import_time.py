@@ -0,0 +1,61 @@
+"""
+Test the import time of the package and its command line interface
+
+The budgets (in microseconds) can be adjusted with the AIIDA_ATOMS_IMPORT_BUDGET and
+AIIDA_ATOMS_CLI_IMPORT_BUDGET environment variables for slow machines.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+def get_import_times(module):
+    """
+    Import a module in a fresh interpreter with ``-X importtime``.
+
+    :returns: A dictionary of the cumulative import time (microseconds) of each module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "module,budget_variable,default_budget,heavy_modules",
+    [
+        (
+            "aiida_atoms",
+            "AIIDA_ATOMS_IMPORT_BUDGET",
+            200_000,
+            ("aiida_atoms.tracker", "ase.build", "aiida.engine", "packaging"),
+        ),
+        (
+            "aiida_atoms.workgraphs.cli",
+            "AIIDA_ATOMS_CLI_IMPORT_BUDGET",
+            300_000,
+            ("aiida_vasp", "aiida_workgraph", "pymatgen", "aiida.orm"),
+        ),
+    ],
+)
+def test_import_time(module, budget_variable, default_budget, heavy_modules):
+    """Importing the package and the CLI does not pull in the heavy dependencies"""
+    times = get_import_times(module)
+    for heavy_module in heavy_modules:
+        assert heavy_module not in times, f"{module} imports {heavy_module}"
+    budget = int(os.environ.get(budget_variable, default_budget))
+    assert times[module] < budget, (
+        f"Importing {module} took {times[module]} us, above the budget of {budget} us"
+    )
@@ -0,0 +1,35 @@
+"""
+Test combining the thermal conductivity chunks
+"""
+
+import numpy as np
+
+from aiida_atoms.ltc import combine_chunks, get_chunks, write_chunk
+
+
+def test_chunks_add_up(tmp_path):
+    """The sums of the chunks give the thermal conductivity of the whole mesh"""
+    grid_points = np.arange(5)
+    temperatures = [100.0, 200.0, 300.0]
+    chunks = get_chunks(grid_points, temperatures, 2, 2)
+    assert len(chunks) == 6
+    assert [len(points) for _, points, _, _ in chunks[::2]] == [2, 2, 1]
+
+    # Contributions of each grid point and temperature, with unit weights
+    rng = np.random.default_rng(0)
+    mode_kappa = rng.random((1, len(temperatures), len(grid_points), 6))
+    for name, points, start, temps in chunks:
+        write_chunk(
+            tmp_path,
+            name,
+            {
+                "mode_kappa_sum": mode_kappa[:, start : start + len(temps)][
+                    :, :, points
+                ].sum(axis=2),
+                "num_sampling_grid_points": len(points),
+                "time": 1.0,
+            },
+        )
+    result = combine_chunks(tmp_path, chunks, temperatures, [5, 1, 1])
+    assert np.allclose(result["kappa"], mode_kappa.mean(axis=2))
+    assert list(result["chunk_grid_points"]) == [2, 2, 2, 2, 1, 1]
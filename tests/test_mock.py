@@ -0,0 +1,45 @@
+"""
+Test the mock VASP calculations
+"""
+
+import importlib
+import io
+
+from ase.build import bulk
+from ase.units import GPa
+import numpy as np
+
+from aiida_atoms.mock.vasp import get_calculator, to_vasp_stress, write_vasprun
+from aiida_atoms.workgraphs.phono3py import MOCK_VASP_WORKCHAINS, parse_vasprun_forces
+
+
+def test_vasp_stress_convention():
+    """Compressed cells have a positive stress in kBar as reported by VASP"""
+    atoms = bulk("Cu", cubic=True)
+    atoms.set_cell(atoms.cell * 0.98, scale_atoms=True)
+    atoms.calc = get_calculator(atoms)
+    stress = to_vasp_stress(atoms)
+    assert (np.diag(stress) > 0).all()
+    # The conversion used by the elastic workflow recovers the ASE stress in GPa
+    assert np.allclose(-0.1 * stress, atoms.get_stress(voigt=False) / GPa)
+
+
+def test_vasprun_roundtrip():
+    """The forces and energy are read back from the mock vasprun.xml"""
+    atoms = bulk("Al", cubic=True)
+    atoms.rattle(0.05, seed=0)
+    atoms.calc = get_calculator(atoms, "emt")
+    energy = atoms.get_potential_energy()
+    forces = atoms.get_forces()
+    content = write_vasprun(atoms, energy, forces, to_vasp_stress(atoms))
+
+    parsed_forces, parsed_energy = parse_vasprun_forces(io.BytesIO(content.encode()))
+    assert np.allclose(parsed_forces, forces, atol=1e-7)
+    assert abs(parsed_energy - energy) < 1e-7
+
+
+def test_mock_workchain_paths():
+    """The stand-ins passed to the phono3py workflows can be imported"""
+    for path in MOCK_VASP_WORKCHAINS.values():
+        module, _, name = path.partition(":")
+        assert hasattr(importlib.import_module(module), name)
@@ -0,0 +1,79 @@
+"""
+Test packing many VASP calculations into one allocation
+"""
+
+import io
+import subprocess
+import tarfile
+
+import numpy as np
+
+from aiida import orm
+
+from aiida_atoms.workgraphs.packing import (
+    PACKED_STATUS_FILE,
+    chunk_keys,
+    get_kpoints_file,
+    get_packed_options,
+    get_packed_script,
+    is_packed_calculation_ok,
+)
+
+
+def test_chunk_keys():
+    """The keys are split into chunks of at most the given size"""
+    assert chunk_keys(["a", "b", "c"], 2) == [["a", "b"], ["c"]]
+    assert chunk_keys(["a"], 0) == [["a"]]
+
+
+def test_kpoints_file():
+    """Meshes keep their offset, explicit k-points are listed with their weights"""
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints_mesh([4, 4, 2], offset=[0.5, 0.5, 0])
+    lines = get_kpoints_file(kpoints).splitlines()
+    assert lines[2:] == ["Gamma", "4 4 2", "0.5 0.5 0"]
+
+    kpoints = orm.KpointsData()
+    kpoints.set_cell(np.eye(3))
+    kpoints.set_kpoints([[0, 0, 0], [0.5, 0, 0]], weights=[1.0, 3.0])
+    lines = get_kpoints_file(kpoints).splitlines()
+    assert lines[1:3] == ["2", "Reciprocal"]
+    assert [float(value) for value in lines[4].split()] == [0.5, 0, 0, 3.0]
+
+
+def test_packed_options():
+    """The wall time scales with the number of sequential calculations"""
+    options = {"max_wallclock_seconds": 100, "parser_name": "vasp.vasp"}
+    assert get_packed_options(options, 3, False) == {"max_wallclock_seconds": 300}
+    assert get_packed_options(options, 3, True) == {"max_wallclock_seconds": 100}
+
+
+def test_packed_script(tmp_path):
+    """A failed calculation does not stop the others and is recorded as failed"""
+    with tarfile.open(tmp_path / "inputs.tar.gz", mode="w:gz") as archive:
+        for key, content in (("POSCAR_00001", b"ok"), ("POSCAR_00002", b"fail")):
+            info = tarfile.TarInfo(f"work_{key}/INCAR")
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    # Stand-in for VASP, which fails for one of the calculations
+    run_command = "grep -q ok INCAR && echo '<modeling/>' > vasprun.xml"
+    script = get_packed_script(
+        ["POSCAR_00001", "POSCAR_00002"],
+        run_command,
+        prepend_text="export PACKED=prepended",
+        append_text="echo $PACKED > appended",
+    )
+    (tmp_path / "run_packed.sh").write_text(script.get_content())
+    subprocess.run(["bash", "run_packed.sh"], cwd=tmp_path, check=True)
+
+    assert (tmp_path / "appended").read_text().strip() == "prepended"
+    assert not list(tmp_path.glob("work_*"))
+    results = {}
+    for key in ("POSCAR_00001", "POSCAR_00002"):
+        folder = orm.FolderData()
+        for path in (tmp_path / key).iterdir():
+            folder.base.repository.put_object_from_file(str(path), path.name)
+        results[key] = folder
+    assert (tmp_path / "POSCAR_00002" / PACKED_STATUS_FILE).read_text().strip() != "0"
+    assert is_packed_calculation_ok(results["POSCAR_00001"])
+    assert not is_packed_calculation_ok(results["POSCAR_00002"])
@@ -0,0 +1,48 @@
+"""
+Test the helper functions of the phono3py workflow
+"""
+
+from ase.build import bulk
+
+from aiida import orm
+
+from aiida_atoms.workgraphs.phono3py import get_checkpoint_key
+
+
+def get_displaced(formula="MgO", a=4.2, index=0, shift=0.03):
+    """An unstored supercell with one displaced atom"""
+    atoms = bulk(formula, "rocksalt", a=a, cubic=True)
+    atoms.positions[index, 0] += shift
+    return orm.StructureData(ase=atoms)
+
+
+def test_checkpoint_key(aiida_localhost):
+    """Different displacements, materials and inputs get different keys"""
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints_mesh([4, 4, 4])
+    code = orm.InstalledCode(computer=aiida_localhost, filepath_executable="/bin/vasp")
+    inputs = {
+        "parameters": orm.Dict(dict={"incar": {"encut": 520, "ncore": 4}}),
+        "kpoints": kpoints,
+        "potential_family": orm.Str("PBE.54"),
+        "potential_mapping": orm.Dict(dict={"Mg": "Mg_pv"}),
+        "code": code.store(),
+    }
+    key = get_checkpoint_key(get_displaced(), inputs)
+    assert get_checkpoint_key(get_displaced(), inputs) == key
+    # The parallelisation tags are left out
+    parameters = {"incar": {"encut": 520, "ncore": 8, "kpar": 2}}
+    planned = {**inputs, "parameters": parameters}
+    assert get_checkpoint_key(get_displaced(), planned) == key
+
+    others = [
+        get_checkpoint_key(get_displaced(index=1), inputs),
+        get_checkpoint_key(get_displaced(shift=-0.03), inputs),
+        get_checkpoint_key(get_displaced("NaCl", a=5.6), inputs),
+        get_checkpoint_key(get_displaced(), {**inputs, "potential_family": "PBE.64"}),
+        get_checkpoint_key(
+            get_displaced(), {**inputs, "potential_mapping": {"Mg": "Mg_sv"}}
+        ),
+        get_checkpoint_key(get_displaced(), {**inputs, "code": None}),
+    ]
+    assert len({key, *others}) == len(others) + 1
@@ -0,0 +1,77 @@
+"""
+Test the profiling helpers
+"""
+
+from datetime import datetime, timedelta
+
+from aiida_atoms.profiling import (
+    get_repository_keys,
+    get_stage_name,
+    get_union_length,
+    set_end_times,
+    to_folded_stacks,
+)
+
+
+def test_union_length():
+    """Overlapping intervals are counted once"""
+    assert get_union_length([]) == 0
+    assert get_union_length([(0, 2), (1, 3), (5, 6)]) == 4
+    assert get_union_length([(0, 10), (2, 3)]) == 10
+
+
+def test_stage_name_and_keys():
+    """Numbered calls share a stage and nested repository keys are collected"""
+    assert get_stage_name("fc3_12") == "fc3"
+    assert get_stage_name("deformation-3") == "deformation"
+    assert get_stage_name("full_relax") == "full_relax"
+    metadata = {"o": {"a": {"k": "1"}, "b": {"o": {"c": {"k": "2"}}}}}
+    assert sorted(get_repository_keys(metadata)) == ["1", "2"]
+
+
+def test_folded_stacks():
+    """Each time category of each process is a leaf of the stack of its callers"""
+    report = {
+        "processes": [
+            {
+                "pk": 1,
+                "parent": None,
+                "link_label": "ROOT",
+                "process_label": "WorkGraph",
+                "times": {"self": 1.0},
+            },
+            {
+                "pk": 2,
+                "parent": 1,
+                "link_label": "relax",
+                "process_label": "VaspCalculation",
+                "times": {"queue": 2.0, "run": 0.5},
+            },
+        ]
+    }
+    lines = to_folded_stacks(report).splitlines()
+    assert lines == [
+        "WorkGraph<1>;self 1000",
+        "WorkGraph<1>;relax:VaspCalculation;queue 2000",
+        "WorkGraph<1>;relax:VaspCalculation;run 500",
+    ]
+
+
+def test_end_times():
+    """The end comes from the outputs and the called processes, not the mtime"""
+    start = datetime(2024, 1, 1)
+
+    def record(children=(), outputs=(), mtime=100):
+        return {
+            "ctime": start,
+            "mtime": start + timedelta(seconds=mtime),
+            "children": list(children),
+            "outputs": [{"ctime": start + timedelta(seconds=out)} for out in outputs],
+        }
+
+    records = {1: record(children=[2, 3]), 2: record(outputs=[5, 7]), 3: record()}
+    set_end_times(records)
+    assert records[2]["end"] == start + timedelta(seconds=7)
+    # Without outputs or called processes the mtime is the only bound
+    assert records[3]["end"] == start + timedelta(seconds=100)
+    assert records[1]["end"] == records[3]["end"]
@@ -0,0 +1,119 @@
+"""
+Test planning the resources of VASP calculations
+"""
+
+from ase.build import bulk
+
+from aiida import orm
+
+from aiida_atoms.resources import (
+    CALIBRATION_PROPERTY,
+    ClusterProfile,
+    _get_job_record,
+    apply_resource_plan,
+    count_electrons,
+    count_kpoints,
+    get_cluster_profile,
+    get_cost_units,
+    get_valence_electrons,
+    plan_resources,
+)
+
+PROFILE = ClusterProfile("test", cores_per_node=32, max_nodes=4)
+
+
+def test_plan_resources():
+    """Larger calculations get more whole nodes with consistent KPAR and NCORE"""
+    small = plan_resources(2, 16, 1, PROFILE)
+    assert small["resources"] == {"num_machines": 1, "tot_num_mpiprocs": 1}
+    assert small["max_wallclock_seconds"] == PROFILE.min_wallclock_seconds
+    assert small["kpar"] == 1
+
+    large = plan_resources(256, 2048, 20, PROFILE, steps=200)
+    mpiprocs = large["resources"]["tot_num_mpiprocs"]
+    assert mpiprocs > PROFILE.cores_per_node
+    assert mpiprocs % PROFILE.cores_per_node == 0
+    assert mpiprocs <= PROFILE.cores_per_node * PROFILE.max_nodes
+    assert mpiprocs % large["kpar"] == 0
+    assert (mpiprocs // large["kpar"]) % large["ncore"] == 0
+    assert large["kpar"] <= 20
+    assert large["max_wallclock_seconds"] <= PROFILE.max_wallclock_seconds
+    assert large["max_wallclock_seconds"] % 600 == 0
+
+
+def test_plan_resources_gpu():
+    """GPU runs use NCORE=1 and keep the cores of each MPI process"""
+    profile = ClusterProfile(
+        "gpu",
+        cores_per_node=16,
+        num_cores_per_mpiproc=8,
+        max_mpiprocs_per_node=2,
+        gpu=True,
+    )
+    plan = plan_resources(64, 512, 1, profile)
+    assert plan["ncore"] == 1
+    assert plan["resources"]["num_cores_per_mpiproc"] == 8
+    assert plan["resources"]["tot_num_mpiprocs"] <= 2
+
+
+def test_valence_electrons():
+    """Valence electrons outside the noble gas core"""
+    assert get_valence_electrons("Si") == 4
+    assert get_valence_electrons("Na") == 1
+    assert get_valence_electrons("Ga") == 13
+
+
+def test_apply_resource_plan():
+    """The plan is written into the vasp namespace keeping the other settings"""
+    inputs = {
+        "vasp": {
+            "options": orm.Dict(
+                dict={"resources": {"num_machines": 1}, "queue_name": "q"}
+            ),
+            "parameters": orm.Dict(dict={"incar": {"encut": 500, "npar": 4}}),
+        },
+        "relax_settings": orm.Dict(),
+    }
+    plan = plan_resources(8, 64, 4, PROFILE)
+    planned = apply_resource_plan(inputs, plan)
+    options = planned["vasp"]["options"].get_dict()
+    incar = planned["vasp"]["parameters"].get_dict()["incar"]
+    assert options["queue_name"] == "q"
+    assert options["resources"] == plan["resources"]
+    assert incar == {"encut": 500, "ncore": plan["ncore"], "kpar": plan["kpar"]}
+    assert planned["relax_settings"] is inputs["relax_settings"]
+    assert "npar" in inputs["vasp"]["parameters"].get_dict()["incar"]
+
+
+def test_job_record():
+    """The calibration counts the electrons and k-points as the planning does"""
+    structure = orm.StructureData(ase=bulk("MgO", "rocksalt", 4.2))
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints_mesh([6, 6, 6])
+    calc = orm.CalcJobNode()
+    calc.base.attributes.set("last_job_info", {"wallclock_time_seconds": 100})
+    calc.base.attributes.set("resources", {"num_machines": 1, "tot_num_mpiprocs": 8})
+    run_status = {"last_iteration_index": [3, 10]}
+    valences = {"Mg": 8.0, "O": 6.0}
+
+    record = _get_job_record(calc, structure, kpoints, run_status, valences)
+    assert record["core_seconds"] == 800
+    nelect = count_electrons(structure, valences)
+    assert nelect == 14
+    nkpts = count_kpoints(structure, kpoints=kpoints)
+    assert record["units"] == get_cost_units(2, nelect, nkpts, steps=3)
+
+
+def test_saved_calibration(clear_database):  # pylint: disable=unused-argument
+    """The calibration saved on a computer is used by its profile"""
+    computer = orm.Computer(
+        label="catapult",
+        hostname="localhost",
+        transport_type="core.local",
+        scheduler_type="core.direct",
+    ).store()
+    assert get_cluster_profile("catapult").seconds_per_unit == 2e-7
+    computer.set_property(CALIBRATION_PROPERTY, 5e-7)
+    profile = get_cluster_profile(computer)
+    assert profile.seconds_per_unit == 5e-7
+    assert profile.cores_per_node == 64
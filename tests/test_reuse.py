@@ -0,0 +1,167 @@
+"""
+Test finding finished relaxations for reuse
+"""
+
+from ase.build import bulk
+
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida.engine import ProcessState
+
+from aiida_atoms.reuse import (
+    RELAX_PROCESS_LABEL,
+    clean_parameters,
+    find_finished_relaxation,
+    get_called_relaxations,
+    get_structure_hash,
+    is_equivalent_relaxation,
+)
+from aiida_atoms.workgraphs.phono3py import find_relaxed_structure
+
+PARAMETERS = {"incar": {"encut": 520, "ediff": 1e-6, "ncore": 4}}
+RELAX_SETTINGS = {"force_cutoff": 0.001, "label": "full relax"}
+
+
+def get_vasp_inputs(parameters=None, mesh=(4, 4, 4), potential_family="PBE.54"):
+    """Unstored inputs of the `vasp` namespace of a relaxation"""
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints_mesh(list(mesh))
+    return {
+        "parameters": orm.Dict(dict=parameters or PARAMETERS),
+        "kpoints": kpoints,
+        "potential_family": orm.Str(potential_family),
+        "potential_mapping": orm.Dict(dict={"Mg": "Mg_pv", "O": "O"}),
+    }
+
+
+def make_relaxation(
+    structure, vasp_inputs=None, relax_settings=None, exit_status=0, seal=True
+):
+    """
+    Store a finished `VaspRelaxWorkChain` node with the given inputs
+
+    Leave it unsealed with ``seal=False`` to add its outputs.
+    """
+    structure.store()
+    node = orm.WorkChainNode()
+    node.set_process_label(RELAX_PROCESS_LABEL)
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(exit_status)
+    inputs = {
+        f"vasp__{name}": value
+        for name, value in (vasp_inputs or get_vasp_inputs()).items()
+    }
+    inputs["structure"] = structure
+    inputs["relax_settings"] = orm.Dict(dict=relax_settings or RELAX_SETTINGS)
+    for label, value in inputs.items():
+        node.base.links.add_incoming(value.store(), LinkType.INPUT_WORK, label)
+    node.store()
+    if seal:
+        node.seal()
+    return node
+
+
+def get_structure(a=4.2):
+    """An unstored MgO structure"""
+    return orm.StructureData(ase=bulk("MgO", "rocksalt", a=a))
+
+
+def test_structure_hash(clear_database):  # pylint: disable=unused-argument
+    """Unstored structures are hashed by their content, as when they are stored"""
+    structure = get_structure()
+    structure_hash = get_structure_hash(structure)
+    assert structure_hash is not None
+    assert get_structure_hash(get_structure(a=4.3)) != structure_hash
+    assert get_structure_hash(structure.store()) == structure_hash
+
+
+def test_equivalent_relaxation(clear_database):  # pylint: disable=unused-argument
+    """The label and the parallelisation tags do not matter, the parameters do"""
+    node = make_relaxation(get_structure())
+    settings = {**RELAX_SETTINGS, "label": "another label"}
+    assert is_equivalent_relaxation(node, get_vasp_inputs(), settings)
+
+    parameters = {"incar": {**PARAMETERS["incar"], "ncore": 8, "kpar": 2}}
+    assert is_equivalent_relaxation(node, get_vasp_inputs(parameters), RELAX_SETTINGS)
+
+    parameters = {"incar": {**PARAMETERS["incar"], "encut": 600}}
+    vasp_inputs = get_vasp_inputs(parameters)
+    assert not is_equivalent_relaxation(node, vasp_inputs, RELAX_SETTINGS)
+    settings = {**RELAX_SETTINGS, "force_cutoff": 0.01}
+    assert not is_equivalent_relaxation(node, get_vasp_inputs(), settings)
+
+
+def test_equivalent_vasp_inputs(
+    clear_database, aiida_localhost
+):  # pylint: disable=unused-argument
+    """The k-points, potentials and code must be the same"""
+    node = make_relaxation(get_structure())
+    vasp_inputs = get_vasp_inputs(mesh=(6, 6, 6))
+    assert not is_equivalent_relaxation(node, vasp_inputs, RELAX_SETTINGS)
+    vasp_inputs = get_vasp_inputs(potential_family="PBE.64")
+    assert not is_equivalent_relaxation(node, vasp_inputs, RELAX_SETTINGS)
+    vasp_inputs = get_vasp_inputs()
+    vasp_inputs["potential_mapping"] = {"Mg": "Mg_sv", "O": "O"}
+    assert not is_equivalent_relaxation(node, vasp_inputs, RELAX_SETTINGS)
+
+    code = orm.InstalledCode(computer=aiida_localhost, filepath_executable="/bin/vasp")
+    vasp_inputs = get_vasp_inputs()
+    vasp_inputs["code"] = code.store()
+    assert not is_equivalent_relaxation(node, vasp_inputs, RELAX_SETTINGS)
+    node = make_relaxation(get_structure(), vasp_inputs=vasp_inputs)
+    assert is_equivalent_relaxation(node, {**vasp_inputs}, RELAX_SETTINGS)
+
+
+def test_find_finished_relaxation(clear_database):  # pylint: disable=unused-argument
+    """Relaxations are found by the hash of unstored structures with the same content"""
+    node = make_relaxation(get_structure())
+    make_relaxation(get_structure(), exit_status=400)
+
+    found = find_finished_relaxation(get_structure(), get_vasp_inputs(), RELAX_SETTINGS)
+    assert found.pk == node.pk
+    other = get_structure(a=4.3)
+    assert find_finished_relaxation(other, get_vasp_inputs(), RELAX_SETTINGS) is None
+    parameters = {"incar": {**PARAMETERS["incar"], "encut": 600}}
+    vasp_inputs = get_vasp_inputs(parameters)
+    found = find_finished_relaxation(get_structure(), vasp_inputs, RELAX_SETTINGS)
+    assert found is None
+
+
+def test_find_in_candidates(clear_database):  # pylint: disable=unused-argument
+    """Only the given candidates are considered"""
+    node = make_relaxation(get_structure())
+    other = make_relaxation(get_structure())
+    found = find_finished_relaxation(
+        get_structure(), get_vasp_inputs(), RELAX_SETTINGS, candidates=[node]
+    )
+    assert found.pk == node.pk
+    # Candidates relaxing other structures are not matched
+    different = make_relaxation(get_structure(a=4.3))
+    found = find_finished_relaxation(
+        get_structure(), get_vasp_inputs(), RELAX_SETTINGS, candidates=[different]
+    )
+    assert found is None
+    # The most recent relaxation is found in the whole database
+    found = find_finished_relaxation(get_structure(), get_vasp_inputs(), RELAX_SETTINGS)
+    assert found.pk == other.pk
+    assert not get_called_relaxations(node)
+
+
+def test_find_relaxed_structure(clear_database):  # pylint: disable=unused-argument
+    """The relaxed structure of an unstored input structure is found"""
+    node = make_relaxation(get_structure(), seal=False)
+    relaxed = get_structure(a=4.25).store()
+    relaxed.base.links.add_incoming(node, LinkType.RETURN, "relax__structure")
+    node.seal()
+
+    inputs = {"vasp": get_vasp_inputs(), "relax_settings": orm.Dict(RELAX_SETTINGS)}
+    assert find_relaxed_structure(get_structure(), inputs).pk == relaxed.pk
+    assert find_relaxed_structure(get_structure(a=4.3), inputs) is None
+    inputs["vasp"]["potential_family"] = orm.Str("PBE.64")
+    assert find_relaxed_structure(get_structure(), inputs) is None
+
+
+def test_clean_parameters():
+    """The parallelisation tags are removed whatever their case"""
+    parameters = {"incar": {"encut": 520, "NCORE": 4, "kpar": 2}, "extra": 1}
+    assert clean_parameters(parameters) == {"incar": {"encut": 520}, "extra": 1}
@@ -0,0 +1,78 @@
+"""
+Test the displacement templates shared by materials of the same prototype
+"""
+
+from ase.build import bulk
+import numpy as np
+
+from aiida import orm
+
+from aiida_atoms.workgraphs.displacements import (
+    materialize_displacement,
+    set_displacement_arrays,
+)
+from aiida_atoms.workgraphs import templates
+from aiida_atoms.workgraphs.templates import (
+    find_displacement_template,
+    get_template_key,
+    set_template_arrays,
+)
+
+SETTINGS = {"dim3": 2, "dim2": 4, "amplitude": 0.03}
+
+
+def test_template_key():
+    """Materials of the same prototype share the key, other settings do not"""
+    nacl = bulk("NaCl", "rocksalt", a=5.64, cubic=True)
+    kbr = bulk("KBr", "rocksalt", a=6.6, cubic=True)
+    assert get_template_key(nacl, **SETTINGS) == get_template_key(kbr, **SETTINGS)
+
+    zincblende = bulk("GaAs", "zincblende", a=5.65, cubic=True)
+    assert get_template_key(zincblende, **SETTINGS) != get_template_key(
+        nacl, **SETTINGS
+    )
+    assert get_template_key(nacl, **{**SETTINGS, "amplitude": 0.01}) != (
+        get_template_key(nacl, **SETTINGS)
+    )
+    # The pairs within a cutoff distance depend on the lattice constant
+    assert get_template_key(nacl, cutoff_pair_distance=4.0, **SETTINGS) is None
+    assert get_template_key(nacl, number_of_snapshots=10, **SETTINGS) is None
+
+
+def test_template_arrays():
+    """The displacements of a template are applied to a rescaled supercell"""
+    nacl = bulk("NaCl", "rocksalt", a=5.64, cubic=True).repeat(2)
+    kbr = bulk("KBr", "rocksalt", a=6.6, cubic=True).repeat(2)
+    displaced = nacl.get_scaled_positions()
+    displaced[3] += 0.03 / 11.28
+    template = orm.ArrayData()
+    set_displacement_arrays(
+        template,
+        "fc3",
+        nacl.cell[:],
+        nacl.get_scaled_positions(),
+        nacl.numbers,
+        {1: displaced},
+    )
+
+    node = orm.ArrayData()
+    set_template_arrays(
+        node, template, "fc3", kbr.cell[:], kbr.get_scaled_positions(), kbr.numbers
+    )
+    structure = materialize_displacement(node, "POSCAR_00001").get_ase()
+    delta = structure.positions - kbr.positions
+    assert np.allclose(delta[3], [0.03, 0.03, 0.03])
+    assert np.allclose(np.delete(delta, 3, axis=0), 0)
+    assert list(structure.numbers) == list(kbr.numbers)
+    assert node.base.attributes.get("fc3_total") == 1
+
+
+def test_deleted_template(
+    clear_database, monkeypatch
+):  # pylint: disable=unused-argument
+    """A cached template that no longer exists is looked up again"""
+    monkeypatch.setattr(
+        templates, "_TEMPLATES", {"key": {"displacements": -1, "phono3py_disp": -1}}
+    )
+    assert find_displacement_template("key") is None
+    assert "key" not in templates._TEMPLATES  # pylint: disable=protected-access
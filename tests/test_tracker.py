@@ -2,13 +2,20 @@
 Test the tracker
 """
 
+import threading
+
 from ase.build import bulk
 import numpy as np
 import pytest
 
 from aiida import orm
 
-from aiida_atoms.tracker import AtomsTracker
+from aiida_atoms.tracker import (
+    AtomsTracker,
+    ProvenanceError,
+    ProvenanceWriter,
+    get_thread_user,
+)
 
 
 def check_atoms_equality(a1, a2, tol=1e-10):
@@ -39,32 +46,48 @@ def check_atoms_inequality(a1, a2, tol=1e-10):
     )
 
 
-mgo = bulk("MgO", "rocksalt", 4.0)
+def get_mgo():
+    """Fresh MgO atoms, as the operations of the tests change them in place"""
+    return bulk("MgO", "rocksalt", 4.0)
+
+
+def hold_writer(writer):
+    """Block the thread of the writer until the returned event is set"""
+    started, release = threading.Event(), threading.Event()
+
+    def hold():
+        started.set()
+        release.wait()
+
+    writer.submit(hold)
+    started.wait()
+    return release
 
 
 @pytest.mark.parametrize(
-    ["inplace", "atoms", "method_name", "args", "kwargs"],
+    ["inplace", "method_name", "args", "kwargs"],
     [
-        [True, mgo, "translate", [(0.1, 0.1, 0.1)], {}],
-        [True, mgo, "center", [], {}],
-        [True, mgo, "wrap", [], {}],
-        [True, mgo, "rattle", [0.1], {}],
-        [True, mgo, "rattle", [], {"stdev": 0.1}],
-        [True, mgo, "set_cell", [np.diag([3, 3, 3])], {}],
-        [True, mgo, "set_cell", [np.diag([3, 3, 3])], {"scale_atoms": True}],
-        [True, mgo, "set_atomic_numbers", [[1, 1]], {}],
-        [True, mgo, "set_masses", [[1, 1]], {}],
-        [True, mgo, "set_distance", [0, 1], {"distance": 1.0}],
-        [False, mgo, "__mul__", [(2, 2, 2)], {}],
-        [False, mgo, "repeat", [(2, 2, 2)], {}],
-        [False, mgo, "__getitem__", [[0]], {}],
+        [True, "translate", [(0.1, 0.1, 0.1)], {}],
+        [True, "center", [], {}],
+        [True, "wrap", [], {}],
+        [True, "rattle", [0.1], {}],
+        [True, "rattle", [], {"stdev": 0.1}],
+        [True, "set_cell", [np.diag([3, 3, 3])], {}],
+        [True, "set_cell", [np.diag([3, 3, 3])], {"scale_atoms": True}],
+        [True, "set_atomic_numbers", [[1, 1]], {}],
+        [True, "set_masses", [[1, 1]], {}],
+        [True, "set_distance", [0, 1], {"distance": 1.0}],
+        [False, "__mul__", [(2, 2, 2)], {}],
+        [False, "repeat", [(2, 2, 2)], {}],
+        [False, "__getitem__", [[0]], {}],
     ],
 )
-def test_track_roundtrip(inplace, atoms, method_name, args, kwargs):
+def test_track_roundtrip(inplace, method_name, args, kwargs):
     """
     Perform tests for using the tracker to track in-place and out-of-place operations.
     Test round trip equality of the results.
     """
+    atoms = get_mgo()
     init_state = atoms.copy()
     tracker = AtomsTracker(atoms)
 
@@ -83,7 +106,7 @@ def test_track_roundtrip(inplace, atoms, method_name, args, kwargs):
 
 def test_tracker_wrap_node():
     """Test if a tracker can wrap methods of the node correctly"""
-    tracker1 = AtomsTracker(mgo)
+    tracker1 = AtomsTracker(get_mgo())
     assert tracker1.label == ""
 
     tracker1.label = "Node1"
@@ -102,8 +125,8 @@ def test_tracker_wrap_node():
 def test_tracker_construction():
     """Test `AtomsTracker` type"""
 
-    tracker1 = AtomsTracker(mgo)
-    mgo_node = orm.StructureData(ase=mgo)
+    tracker1 = AtomsTracker(get_mgo())
+    mgo_node = orm.StructureData(ase=get_mgo())
     tracker2 = AtomsTracker(mgo_node)
 
     check_atoms_equality(tracker1, tracker2)
@@ -119,7 +142,7 @@ def test_provenance_tracking(clear_database):
     """Test if the provenance graph created is correct"""
 
     # Perform a mixture of inplace and out-of-place operations with branching
-    tracker = AtomsTracker(mgo)
+    tracker = AtomsTracker(get_mgo())
     node_init = tracker.node
     _ = tracker.repeat((3, 3, 3))
     tracker = tracker.repeat((2, 2, 2))
@@ -138,3 +161,109 @@ def test_provenance_tracking(clear_database):
     assert len(node_1.get_incoming().one().node.get_incoming().all()) == 2
     assert len(node_2.get_incoming().one().node.get_incoming().all()) == 2
     assert len(node_3.get_incoming().one().node.get_incoming().all()) == 2
+
+
+def test_asynchronous_tracking(clear_database):
+    """The provenance written in the background matches the synchronous one"""
+    with AtomsTracker(get_mgo(), asynchronous=True) as tracker:
+        tracker.translate((0.1, 0.1, 0.1))
+        # The atoms are updated before the provenance is written
+        assert abs(tracker.atoms.positions[0] - 0.1).max() < 1e-10
+        supercell = tracker.repeat((2, 2, 2))
+        supercell.pop(0)
+
+    assert len(supercell.atoms) == 15
+    check_atoms_equality(supercell.node.get_ase(), supercell.atoms)
+    check_atoms_equality(tracker.node.get_ase(), tracker.atoms)
+    # pop <- repeat <- translate
+    creator = supercell.node.creator
+    parent = creator.inputs.node
+    assert parent.creator.inputs.node.pk == tracker.node.pk
+    assert tracker.node.creator.inputs.node.is_stored
+
+
+def test_node_access_writes(clear_database):
+    """Accessing the node waits for its record to be written"""
+    tracker = AtomsTracker(get_mgo(), asynchronous=True)
+    tracker.translate((0.1, 0.1, 0.1))
+    assert tracker.node.is_stored
+    assert tracker.node.creator.process_label == "translate"
+    check_atoms_equality(tracker.node.get_ase(), tracker.atoms)
+
+
+def test_trackers_share_writer(clear_database):
+    """Derived trackers share the writer of their tracker, not the other trackers"""
+    tracker = AtomsTracker(get_mgo(), asynchronous=True)
+    supercell = tracker.repeat((2, 2, 2))
+    assert supercell.writer is tracker.writer
+    assert AtomsTracker(get_mgo(), asynchronous=True).writer is not tracker.writer
+    assert AtomsTracker(get_mgo()).writer is None
+    tracker.flush()
+
+
+def test_discard_on_error(clear_database):
+    """The records not written yet are discarded when the block raises"""
+    with pytest.raises(ValueError):
+        with AtomsTracker(get_mgo(), asynchronous=True) as tracker:
+            # Hold the writer so that the operation stays queued
+            release = hold_writer(tracker.writer)
+            tracker.translate((0.1, 0.1, 0.1))
+            raise ValueError("failed")
+    release.set()
+    tracker.flush()
+    with pytest.raises(ProvenanceError, match="discarded"):
+        _ = tracker.node
+    assert not orm.QueryBuilder().append(orm.CalcFunctionNode).count()
+
+
+def test_writer_order(clear_database):
+    """The records are written in order, with the results of earlier records"""
+    writer = ProvenanceWriter(batch_size=2)
+    first = writer.submit(lambda: 1)
+    second = writer.submit(lambda value: value + 1, first)
+    writer.flush()
+    assert first.get() == 1
+    assert second.get() == 2
+
+
+def test_writer_batches(clear_database):
+    """The queued records of a batch are written in one transaction"""
+    writer = ProvenanceWriter(batch_size=2)
+    release = hold_writer(writer)
+    # Queued while the writer is held, the next records are written in two batches
+    stored = writer.submit(lambda: orm.Int(1, user=get_thread_user()).store().pk)
+
+    def fail():
+        raise ValueError("failed")
+
+    failed = writer.submit(fail)
+    last = writer.submit(lambda: orm.Int(2, user=get_thread_user()).store().pk)
+    release.set()
+    with pytest.raises(ProvenanceError):
+        writer.flush()
+
+    # The batch of the error is rolled back, the next one is written
+    assert failed.error is not None
+    assert stored.error is not None
+    query = orm.QueryBuilder().append(orm.Int, filters={"attributes.value": 1})
+    assert not query.count()
+    assert orm.load_node(last.get()).value == 2
+
+
+def test_asynchronous_error(clear_database):
+    """An error of the writer is raised by the next submission or flush"""
+
+    def fail():
+        raise ValueError("failed")
+
+    writer = ProvenanceWriter()
+    record = writer.submit(fail)
+    with pytest.raises(ProvenanceError):
+        writer.flush()
+    # The error is only raised once
+    writer.flush()
+    # Records depending on a failed one are not written
+    dependent = writer.submit(lambda value: value, record)
+    writer.flush()
+    with pytest.raises(ProvenanceError, match="input record"):
+        dependent.get()